@@ -1,30 +1,105 @@
 #!/usr/bin/env python
 
-# TODO:
-# Serialize/deseralize profiles (probably JSON)
-# Send profile to device
-# Record macros
-
+import os
 import sys
+import json
+import shlex
+import queue
+import threading
+import contextlib
 
+# only tables and profile handling, lib.hiddev and what it pulls in are
+# imported by open_device() for the commands which need the device
 from .lib import keys
-from .lib.hiddev import HIDDEV
 from .lib import eightkbd
+from .lib import trace
 MacroEventAction = eightkbd.MacroEventAction
 
+TRACE_FILENAME = "8kbdctl-trace.json"
+# lines of a streamed script sent together at most
+SCRIPT_BATCH = 64
+# how long a streamed script can stop before what's come so far is sent
+STREAM_IDLE = 0.2
+RECORD_NAME = "recorded"
+
+def open_device():
+    from .lib.hiddev import HIDDEV
+    return HIDDEV(eightkbd.VENDOR_ID, eightkbd.PRODUCT_ID, eightkbd.INTERFACE_NUM)
+
+def open_snapshot(use_cache):
+    # the profile snapshot from last time and where it's saved, the filename
+    # is None if there's nowhere to save it
+    from .lib import profilecache
+    filename = profilecache.get_snapshot_filename(eightkbd.VENDOR_ID, eightkbd.PRODUCT_ID,
+                                                  eightkbd.INTERFACE_NUM)
+    if filename is None or not use_cache:
+        return filename, profilecache.ProfileSnapshot()
+    return filename, profilecache.load_snapshot(filename)
+
+def invalidate_snapshot(filename):
+    # before changing the device, in case it doesn't finish
+    if filename is not None:
+        filename.unlink(missing_ok=True)
+
+def save_snapshot(filename, kbd):
+    from .lib import profilecache
+    if filename is not None:
+        kbd.update_snapshot()
+        try:
+            profilecache.save_snapshot(filename, kbd.snapshot)
+        except OSError as e:
+            print(f"WARNING: Failed to save profile cache: {e}")
+
+def save_profile(filename, profile):
+    from .lib import profilefile
+    try:
+        profilefile.save_profile(filename, profile)
+    except OSError as e:
+        print(f"Failed to save profile: {e}")
+        return False
+    return True
+
+def get_absolute_args(args):
+    # profile files are relative to here, not wherever the daemon is
+    args = list(args)
+    for num in range(len(args) - 1):
+        if args[num] in ('save-profile', 'load-profile'):
+            args[num+1] = os.path.abspath(args[num+1])
+    return args
+
 def usage(exe):
-    print(f"USAGE: {exe} [test|force|verbose]... <<command> [args]>...\n\n"
+    from .lib.keystate import RECORD_DELAY_QUANTUM
+    print(f"USAGE: {exe} [test|force|verbose|pipeline|trace|cache]... <<command> [args]>...\n\n"
            "test - Just go through the motions but do everything except actually updating\n"
            "       the device.  The device will still be accessed to get the profile.\n"
+           "       Prints each packet which would be sent and why.\n"
            "force - Don't get the profile from the device, making all changes happen\n"
            "        even if they would be redundant.\n"
-           "verbose - Get a lot of extra information about what's happening.\n\n"
+           "verbose - Get a lot of extra information about what's happening.\n"
+           "pipeline - Send more packets while waiting for earlier ones to be\n"
+           "           acknowledged.  Falls back to waiting on each packet if the\n"
+           "           device loses track.\n"
+           "trace - Time each exchange with the device, print a summary of round trip\n"
+          f"        times for each command and save a Chrome trace to {TRACE_FILENAME}.\n"
+           "        Doesn't go through the daemon.\n"
+           "cache - Reuse what was saved from the device last time instead of getting\n"
+           "        everything again, it's only gotten again if the name or the lists\n"
+           "        of mapped keys and macros change, so anything else changed\n"
+           "        without this program won't be noticed.\n\n"
            "Command may be:\n"
            "list-in-codes - List possible codes which relate to keys on the keyboard and\n"
            "    their names.\n"
            "list-out-codes - List possible codes which a key may be assigned to and their\n"
            "    names.\n"
-           "get-profile - Get the profile from the device.\n"
+           "get-profile [lines] - Get the profile from the device, printing each\n"
+           "    part as it's gotten.  With lines, print each part as a JSON object on\n"
+           "    its own line.\n"
+           "save-profile <file> - Get the profile from the device and save it to\n"
+           "    <file>, as JSON if it ends in .json, otherwise in a compact binary\n"
+           "    format.\n"
+           "load-profile <file> - Make the device's profile what's saved in <file>,\n"
+           "    keys it doesn't map go back to default and macros it doesn't have\n"
+           "    are deleted.  Only what's different is sent.\n"
            "set-name <name> - Set the profile name, as a quirk of the device, setting\n"
            "    the name to an empty string (\"\") will disable the profile button.\n"
            "set-key [<mod-key>+]<in-key> <out-key> - Set a mapping from in-key to\n"
@@ -39,13 +114,27 @@ def usage(exe):
            "up - Indicate a key release.\n"
            "end - Indicate the end of a macro, this is optional but necessary if\n"
            "      additional commands are to follow.\n"
-           "set-all-default - Restore all keys to defaults.")
+           "set-all-default - Restore all keys to defaults.\n"
+          f"record-macro <in-key> [name [repeats]] - Record what's typed as a macro\n"
+          f"    for <in-key>, named {RECORD_NAME} and played once by default.  Press\n"
+           "    <in-key> to stop and set it, or ctrl-c to give up.  Delays are\n"
+          f"    rounded to {RECORD_DELAY_QUANTUM} ms.\n"
+           "script <file|-> [stream [batch size]] - Run the commands in <file>, or\n"
+           "    from stdin with -, one or more to a line split like a shell would\n"
+           "    with # starting a comment.  Every line is checked and applied then\n"
+           "    it's all submitted at once.  With stream, lines are run as they\n"
+          f"    come, submitted every [batch size] (default {SCRIPT_BATCH}) lines or when\n"
+          f"    nothing's come for {STREAM_IDLE} s, a batch with a bad line is skipped.\n"
+           "daemon - Stay running with the device open and its profile in memory,\n"
+           "    other commands will go through the daemon while it's running.")
 
 def parse_macro_args(args):
     events = []
     for i in range(0, len(args), 3):
         if args[i] == 'end':
             return i + 1, events
+        if i + 3 > len(args):
+            raise ValueError(f"Incomplete macro event {' '.join(args[i:])}.")
 
         action, key, delay = args[i], keys.get_hut_code_from_name(args[i+1]), int(args[i+2])
         match action.lower():
@@ -66,11 +155,374 @@ def parse_macro_args(args):
             case x:
                 raise ValueError(f"Invalid event type {x}.")
         if delay != 0:
-            if delay < 0 or delay > 65535:
-                raise ValueError("Delay must be 0 to 65535.")
+            # longer delays are split up when the macro is set
+            if delay < 0:
+                raise ValueError("Delay must not be negative.")
             events.append((MacroEventAction.DELAY, delay))
     return len(args), events
 
+def parse_key_mapping(arg):
+    mod_key = keys.KEY_DISABLE
+    split = None
+    try:
+        split = arg.index('+')
+    except ValueError:
+        pass
+    # don't split on "kp+"
+    if split is not None and split != len(arg) - 1:
+        mod_key = keys.get_mod_code_from_name(arg[:split])
+        to_key = keys.get_hut_code_from_name(arg[split+1:], True)
+    else:
+        to_key = keys.get_hut_code_from_name(arg, True)
+    return to_key, mod_key
+
+def apply_commands(kbd, args):
+    # apply changes to kbd's new profile, False if the commands were bad
+    while len(args) > 0:
+        cmd = args[0]
+        args = args[1:]
+        if cmd == 'set-name':
+            if len(args) < 1:
+                print("Not enough args for a name.")
+                return False
+
+            kbd.set_name(args[0])
+            args = args[1:]
+        elif cmd == 'set-key':
+            if len(args) < 2:
+                print("Not enough arguments for a mapping.")
+                return False
+
+            from_key = eightkbd.get_key_code_from_name(args[0])
+            try:
+                to_key, mod_key = parse_key_mapping(args[1])
+            except ValueError as e:
+                print(e)
+                return False
+
+            kbd.set_key(from_key, to_key, mod_key)
+
+            args = args[2:]
+        elif cmd == 'set-macro':
+            # enough for 1 descriptor (name change)
+            # or a descriptor and single event which may just be 'end'
+            if len(args) < 3 or (len(args) > 4 and
+                                 len(args) < 6):
+                print("Not enough arguments for a macro.")
+                return False
+
+            from_key = eightkbd.get_key_code_from_name(args[0])
+            name = args[1]
+            try:
+                repeats = int(args[2])
+            except ValueError:
+                print("Repeats must be an integer.")
+                return False
+            try:
+                count, events = parse_macro_args(args[3:])
+                kbd.set_macro(from_key, name, repeats, events)
+            except ValueError as e:
+                print(e)
+                return False
+            args = args[count+3:]
+        elif cmd == 'set-all-default':
+            kbd.set_all_default()
+        elif cmd == 'load-profile':
+            if len(args) < 1:
+                print("Not enough args for a profile file.")
+                return False
+
+            from .lib import profilefile
+            try:
+                profile = profilefile.load_profile(args[0], kbd.packet_len)
+            except (OSError, ValueError) as e:
+                print(f"Failed to load profile: {e}")
+                return False
+
+            kbd.set_profile(profile)
+            args = args[1:]
+        else:
+            print(f"Unknown command {cmd}.")
+            return False
+    return True
+
+def submit_changes(kbd, test, verbose):
+    if test:
+        print(kbd.str_new_profile())
+        print(f"Would send {kbd.str_plan()}", end='')
+        if verbose:
+            print("These packets would be sent:")
+            kbd.submit(True)
+    else:
+        kbd.submit(False)
+
+def read_script(scriptfile):
+    # every line with a command on it as (line number, args)
+    lines = []
+    for lineno, line in enumerate(scriptfile, 1):
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError(f"Line {lineno}: {e}")
+        if len(args) > 0:
+            lines.append((lineno, args))
+    return lines
+
+def iter_script_batches(scriptfile, batch_size):
+    # lines as read_script() gives them, in batches of up to batch_size or
+    # whatever's come when the input stops for a bit.  Lines are read in a
+    # thread so waiting on them can time out.
+    lines = queue.Queue()
+    def read_lines():
+        for line in scriptfile:
+            lines.put(line)
+        lines.put(None)
+    threading.Thread(target=read_lines, daemon=True).start()
+
+    batch = []
+    lineno = 0
+    while True:
+        try:
+            line = lines.get(timeout=STREAM_IDLE if len(batch) > 0 else None)
+        except queue.Empty:
+            yield batch
+            batch = []
+            continue
+        if line is None:
+            break
+        lineno += 1
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            print(f"Line {lineno}: {e}", flush=True)
+            continue
+        if len(args) > 0:
+            batch.append((lineno, args))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def apply_script_batch(kbd, batch):
+    # False with nothing applied if any line was bad
+    for lineno, args in batch:
+        try:
+            ok = apply_commands(kbd, args)
+        except ValueError as e:
+            print(e)
+            ok = False
+        if not ok:
+            print(f"Line {lineno} is bad, not submitting lines {batch[0][0]} to {batch[-1][0]}.",
+                  flush=True)
+            kbd.discard_changes()
+            return False
+    return True
+
+def run_script_batches(batches, test, force, verbose, window, use_cache):
+    from .lib import daemon
+    ok = True
+    if trace.tracer is None and daemon.request({'ping': True}) is not None:
+        # the daemon already has everything, a batch is one request with
+        # its lines kept apart so each is checked on its own
+        for batch in batches:
+            lines = [(lineno, get_absolute_args(line)) for lineno, line in batch]
+            resp = daemon.request({'test': test, 'force': force, 'verbose': verbose,
+                                   'window': window, 'lines': lines})
+            if resp is None:
+                print("The daemon went away.")
+                return False
+            print(resp['output'], end='', flush=True)
+            ok = ok and resp['ok']
+        return ok
+
+    filename, snapshot = open_snapshot(use_cache)
+    with open_device() as hid:
+        kbd = eightkbd.EightKeyboard(hid, verbose, not force, window, True, snapshot)
+        for batch in batches:
+            if not apply_script_batch(kbd, batch):
+                ok = False
+                continue
+            if not test:
+                invalidate_snapshot(filename)
+            submit_changes(kbd, test, verbose)
+            if test:
+                kbd.discard_changes()
+            sys.stdout.flush()
+    save_snapshot(filename, kbd)
+    return ok
+
+def run_script(args, test, force, verbose, window, use_cache):
+    # script <file|-> [stream [batch size]]
+    stream = args[1:2] == ['stream']
+    batch_size = SCRIPT_BATCH
+    if stream and len(args) > 2:
+        try:
+            batch_size = int(args[2])
+        except ValueError:
+            print("Batch size must be an integer.")
+            return False
+
+    if args[0] == '-':
+        scriptfile = contextlib.nullcontext(sys.stdin)
+    else:
+        try:
+            scriptfile = open(args[0], 'r')
+        except OSError as e:
+            print(f"Failed to open script: {e}")
+            return False
+    with scriptfile as lines:
+        if stream:
+            batches = iter_script_batches(lines, batch_size)
+        else:
+            # everything's checked before the device is opened
+            try:
+                batches = [read_script(lines)]
+            except ValueError as e:
+                print(e)
+                return False
+        return run_script_batches(batches, test, force, verbose, window, use_cache)
+
+def events_to_args(events):
+    # macro events as set-macro takes them, each key event followed by the
+    # delay after it
+    args = []
+    for action, arg in events:
+        match action:
+            case MacroEventAction.DELAY:
+                args[-1] = str(int(args[-1]) + arg)
+            case MacroEventAction.PRESSED | MacroEventAction.MOD_PRESSED:
+                args.extend(('down', str(arg), '0'))
+            case MacroEventAction.RELEASED | MacroEventAction.MOD_RELEASED:
+                args.extend(('up', str(arg), '0'))
+    args.append('end')
+    return args
+
+def record_macro(args, test, force, verbose, window, use_cache):
+    # record-macro <in-key> [name [repeats]]
+    from .lib import daemon
+    from .lib.keystate import MacroRecorder
+
+    try:
+        from_key = eightkbd.get_key_code_from_name(args[0])
+    except ValueError as e:
+        print(e)
+        return False
+    if eightkbd.get_bitfield_code_from_key_code(from_key) is None:
+        print(f"{eightkbd.get_name_from_key_code(from_key)} can't be seen while recording to stop it.")
+        return False
+    name = RECORD_NAME
+    if len(args) > 1:
+        name = args[1]
+    repeats = 1
+    if len(args) > 2:
+        try:
+            repeats = int(args[2])
+        except ValueError:
+            print("Repeats must be an integer.")
+            return False
+
+    # reports can only be read here, but if the daemon's running the macro is
+    # set through it so it knows
+    use_daemon = trace.tracer is None and daemon.request({'ping': True}) is not None
+    recorder = MacroRecorder(from_key)
+    filename, snapshot = open_snapshot(use_cache)
+    with open_device() as hid:
+        kbd = eightkbd.EightKeyboard(hid, verbose, not (force or use_daemon), window, True, snapshot)
+        print(f"Recording, press {eightkbd.get_name_from_key_code(from_key)} to stop or ctrl-c to give up.",
+              flush=True)
+        kbd.record(recorder)
+        if not recorder.stopped:
+            print("Recording given up on.")
+            return False
+        events = recorder.get_events()
+        if len(events) == 0:
+            print("Nothing was recorded.")
+            return False
+        if len(events) > eightkbd.MAX_MACRO_EVENTS:
+            print(f"Recorded {len(events)} events but a macro can only have {eightkbd.MAX_MACRO_EVENTS}.")
+            return False
+        print(f"Recorded {len(events)} events.")
+
+        macro_args = ['set-macro', str(from_key), name, str(repeats)] + events_to_args(events)
+        if use_daemon:
+            resp = daemon.request({'test': test, 'force': force, 'verbose': verbose,
+                                   'window': window, 'args': macro_args})
+            if resp is None:
+                print("The daemon went away.")
+                return False
+            print(resp['output'], end='')
+            return resp['ok']
+
+        if not apply_commands(kbd, macro_args):
+            return False
+        if not test:
+            invalidate_snapshot(filename)
+        submit_changes(kbd, test, verbose)
+    save_snapshot(filename, kbd)
+    return True
+
+def entry_to_dict(kind, key, value):
+    match kind:
+        case "name":
+            return {"name": value}
+        case "key":
+            return {"key": eightkbd.get_name_from_key_code(key), "mapping": str(value)}
+        case "macro":
+            events = []
+            for action, arg in value.events:
+                action = MacroEventAction(action)
+                if action != MacroEventAction.DELAY:
+                    arg = keys.get_name_from_hut_code(arg)
+                events.append([action.name.lower(), arg])
+            return {"macro": eightkbd.get_name_from_key_code(key), "name": value.name,
+                    "repeats": value.repeats, "events": events}
+
+def print_profile(entries, lines):
+    # print each entry as it comes, as str(KeyboardProfile) would or as a JSON
+    # object per line
+    macros = False
+    for kind, key, value in entries:
+        if lines:
+            print(json.dumps(entry_to_dict(kind, key, value)), flush=True)
+            continue
+        match kind:
+            case "name":
+                print(f"Profile Name: {value}\nKey Mappings:", flush=True)
+            case "key":
+                print(f"{eightkbd.get_name_from_key_code(key)}: {value}", flush=True)
+            case "macro":
+                if not macros:
+                    print("Macros:")
+                    macros = True
+                print(f"Key: {eightkbd.get_name_from_key_code(key)}\n{value}", end='', flush=True)
+    if not lines:
+        if not macros:
+            print("Macros:")
+        print()
+
+def run_request(kbd, req):
+    # run by the daemon, output goes back to the client
+    kbd.verbose = req['verbose']
+    kbd.window = req['window']
+    if 'lines' in req:
+        # a script batch
+        if not apply_script_batch(kbd, req['lines']):
+            return False
+        submit_changes(kbd, req['test'], req['verbose'])
+        return True
+    args = req['args']
+    if args[0] == 'get-profile':
+        print_profile(kbd.profile.iter_entries(), args[1:] == ['lines'])
+        return True
+    if args[0] == 'save-profile' and len(args) > 1:
+        return save_profile(args[1], kbd.profile)
+    if not apply_commands(kbd, args):
+        usage("8kbdctl")
+        return False
+    submit_changes(kbd, req['test'], req['verbose'])
+    return True
+
 def main(args):
     exe = args[0]
     args = args[1:]
@@ -78,7 +530,8 @@ def main(args):
     test = False
     force = False
     verbose = False
-    error = False
+    window = 1
+    use_cache = False
 
     if len(args) < 1:
         usage(exe)
@@ -92,6 +545,12 @@ def main(args):
                     force = True
                 elif arg == 'verbose':
                     verbose = True
+                elif arg == 'pipeline':
+                    window = eightkbd.PIPELINE_WINDOW
+                elif arg == 'trace':
+                    trace.enable()
+                elif arg == 'cache':
+                    use_cache = True
                 else:
                     break
             args = args[1:]
@@ -104,90 +563,60 @@ def main(args):
         elif cmd == 'list-in-codes':
             for key in eightkbd.KEY_VALUES.keys():
                 print(f"{key}/0x{key:02X}: {eightkbd.get_name_from_key_code(key)}")
-        elif cmd == 'get-profile':
-            with HIDDEV(eightkbd.VENDOR_ID, eightkbd.PRODUCT_ID, eightkbd.INTERFACE_NUM) as hid:
-                kbd = eightkbd.EightKeyboard(hid, verbose)
-                print(kbd.str_profile())
+        elif cmd == 'daemon':
+            from .lib import daemon
+            daemon.serve(run_request)
+        elif cmd == 'script':
+            if len(args) < 2:
+                usage(exe)
+            else:
+                run_script(args[1:], test, force, verbose, window, use_cache)
+        elif cmd == 'record-macro':
+            if len(args) < 2:
+                usage(exe)
+            else:
+                record_macro(args[1:], test, force, verbose, window, use_cache)
         else:
-            with HIDDEV(eightkbd.VENDOR_ID, eightkbd.PRODUCT_ID, eightkbd.INTERFACE_NUM) as hid:
-                # get_profile flag being False means force all changes
-                kbd = eightkbd.EightKeyboard(hid, verbose, not force)
-
-                while len(args) > 1:
-                    cmd = args[0]
-                    args = args[1:]
-                    if cmd == 'set-name':
-                        if len(args) < 1:
-                            print("Not enough args for a name.")
-                            error = True
-                            break
-
-                        kbd.set_name(args[0])
-                        args = args[1:]
-                    elif cmd == 'set-key':
-                        if len(args) < 2:
-                            print("Not enough arguments for a mapping.")
-                            error = True
-                            break
-
-                        from_key = eightkbd.get_key_code_from_name(args[0])
-                        mod_key = keys.KEY_DISABLE
-                        to_key = keys.KEY_DISABLE
-                        split = None
-                        try:
-                            split = args[1].index('+')
-                        except ValueError:
-                            pass
-                        try:
-                            # don't split on "kp+"
-                            if split is not None and split != len(args[1]) - 1:
-                                mod_key = keys.get_mod_code_from_name(args[1][:split])
-                                to_key = keys.get_hut_code_from_name(args[1][split+1:], True)
-                            else:
-                                to_key = keys.get_hut_code_from_name(args[1], True)
-                        except ValueError as e:
-                            print(e)
-                            return
-
-                        kbd.set_key(from_key, to_key, mod_key)
-
-                        args = args[2:]
-                    elif cmd == 'set-macro':
-                        # enough for 1 descriptor (name change)
-                        # or a descriptor and single event which may just be 'end'
-                        if len(args) < 3 or (len(args) > 4 and
-                                             len(args) < 6):
-                            print("Not enough arguments for a macro.")
-                            error = True
-                            break
-
-                        from_key = eightkbd.get_key_code_from_name(args[0])
-                        name = args[1]
-                        try:
-                            repeats = int(args[2])
-                        except ValueError:
-                            raise ValueError("Repeats must be an integer.")
-                        count, events = parse_macro_args(args[3:])
-                        args = args[count+3:]
-
-                        kbd.set_macro(from_key, name, repeats, events)
-                    elif cmd == 'set-all-default':
-                        kbd.set_all_default()
-                    else:
-                        print(f"Unknown command {cmd}.")
-                        error = True
-                        break
+            from .lib import daemon
+            # a running daemon already has the device open and the profile,
+            # but tracing is about what this process does with the device
+            resp = None
+            if trace.tracer is None:
+                resp = daemon.request({'test': test, 'force': force, 'verbose': verbose,
+                                       'window': window, 'args': get_absolute_args(args)})
+            if resp is not None:
+                print(resp['output'], end='')
+            elif cmd == 'get-profile':
+                filename, snapshot = open_snapshot(use_cache)
+                with open_device() as hid:
+                    kbd = eightkbd.EightKeyboard(hid, verbose, False, window, False, snapshot)
+                    print_profile(kbd.iter_profile_from_device(), args[1:] == ['lines'])
+                save_snapshot(filename, kbd)
+            elif cmd == 'save-profile' and len(args) > 1:
+                filename, snapshot = open_snapshot(use_cache)
+                with open_device() as hid:
+                    kbd = eightkbd.EightKeyboard(hid, verbose, True, window, False, snapshot)
+                save_snapshot(filename, kbd)
+                save_profile(args[1], kbd.profile)
+            else:
+                filename, snapshot = open_snapshot(use_cache)
+                with open_device() as hid:
+                    # get_profile flag being False means force all changes,
+                    # otherwise only what the commands look at is gotten
+                    kbd = eightkbd.EightKeyboard(hid, verbose, not force, window, True, snapshot)
 
-                if error:
-                    usage(exe)
-                else:
-                    if test:
-                        print(kbd.str_new_profile())
-                        if verbose:
-                            print("These packets would be sent:")
-                            kbd.submit(True)
+                    if apply_commands(kbd, args):
+                        if not test:
+                            invalidate_snapshot(filename)
+                        submit_changes(kbd, test, verbose)
                     else:
-                        kbd.submit(False)
+                        usage(exe)
+                save_snapshot(filename, kbd)
+
+            if trace.tracer is not None:
+                print(trace.tracer.str_summary(), end='')
+                trace.tracer.save_chrome_trace(TRACE_FILENAME)
+                print(f"Trace saved to {TRACE_FILENAME}.")
 
 if __name__ == '__main__':
     main(sys.argv)
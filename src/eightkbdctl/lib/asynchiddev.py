@@ -0,0 +1,73 @@
+import os
+import time
+import asyncio
+
+from .hiddev import HIDDEV, print_report
+from . import trace
+from . import output
+
+class AsyncHIDDEV(HIDDEV):
+    # HIDDEV for use from an asyncio event loop.  Reports are read as the fd
+    # becomes readable and queued, listen() is a coroutine but otherwise
+    # behaves the same, with the same callbacks.
+    def __init__(self, vendor_id, product_id, interface_num, force_no_cache=False, fd=None, desc=None):
+        super().__init__(vendor_id, product_id, interface_num, force_no_cache, fd=fd, desc=desc)
+        self.queue = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.fd, self.on_readable)
+
+    def on_readable(self):
+        try:
+            buf = self.read()
+        except BlockingIOError:
+            return
+        if len(buf) > 0:
+            self.queue.put_nowait(buf)
+
+    async def get_report(self, timeout):
+        if timeout == 0:
+            # wait_for() with a 0 timeout never gets anything
+            return self.queue.get_nowait()
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    async def listen(self, count=-1, callback=None, cb_data=None, timeout=None):
+        if trace.tracer is None:
+            return await self.do_listen(count, callback, cb_data, timeout)
+        start = time.perf_counter()
+        ret = await self.do_listen(count, callback, cb_data, timeout)
+        trace.tracer.complete("listen", trace.TID_TRANSPORT, start, time.perf_counter(),
+                              {"timeout": timeout, "timed_out": not ret})
+        return ret
+
+    async def do_listen(self, count=-1, callback=None, cb_data=None, timeout=None):
+        if callback is None:
+            with output.report_dropped():
+                return await self.do_listen(count, print_report, None, timeout)
+        while count != 0:
+            try:
+                buf = await self.get_report(timeout)
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                return False
+            if not callback(self, cb_data, buf[0], buf[1:]):
+                break
+            if count > 0:
+                count -= 1
+
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
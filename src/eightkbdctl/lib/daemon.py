@@ -0,0 +1,183 @@
+import os
+import io
+import json
+import socket
+import select
+import pathlib
+import tempfile
+import functools
+import traceback
+import contextlib
+
+from .eightkbd import EightKeyboard, KeyboardProfile, VENDOR_ID, PRODUCT_ID, INTERFACE_NUM
+
+SOCKET_NAME = "8kbdctl.sock"
+REQUEST_TIMEOUT = 10
+# a daemon which doesn't answer a ping in time is taken as not being there,
+# one which doesn't finish a request in time is an error
+PING_TIMEOUT = 2
+REPLY_TIMEOUT = 60
+
+def get_socket_path():
+    from xdg_base_dirs import xdg_runtime_dir
+    runtime_dir = xdg_runtime_dir()
+    if runtime_dir is None:
+        return pathlib.Path(tempfile.gettempdir(), f"8kbdctl-{os.getuid()}.sock")
+    return runtime_dir.joinpath(SOCKET_NAME)
+
+def recv_all(sock):
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if len(chunk) == 0:
+            return data
+        data += chunk
+
+def request(req, path=None):
+    # returns None if there's no daemon to talk to
+    if path is None:
+        path = get_socket_path()
+    ping = req.get('ping', False)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(PING_TIMEOUT if ping else REPLY_TIMEOUT)
+        try:
+            sock.connect(str(path))
+            sock.sendall(json.dumps(req).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            return json.loads(recv_all(sock).decode('utf-8'))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        except TimeoutError:
+            if ping:
+                return None
+            return {'ok': False, 'output': f"The daemon didn't reply within {REPLY_TIMEOUT} s.\n"}
+
+class KeyboardDaemon:
+    # Keeps the device open and its profile in memory between requests.
+    # handler(kbd, req) applies a request to the keyboard, printing its
+    # output, and returns whether it succeeded.
+    def __init__(self, handler):
+        self.handler = handler
+        self.hid = None
+        self.kbd = None
+
+    def get_keyboard(self):
+        if self.hid is None:
+            from .hiddev import HIDDEV
+            self.hid = HIDDEV(VENDOR_ID, PRODUCT_ID, INTERFACE_NUM)
+        if self.kbd is None:
+            self.kbd = EightKeyboard(self.hid)
+        return self.kbd
+
+    def invalidate(self):
+        if self.hid is not None:
+            try:
+                self.hid.__exit__(None, None, None)
+            except OSError:
+                pass
+        self.hid = None
+        self.kbd = None
+
+    def device_event(self, action, device_node):
+        # the device went away or came back, whatever profile was known may
+        # not be what's on it any more.
+        if self.hid is not None and device_node == self.hid.path and \
+           action in ('add', 'remove'):
+            self.invalidate()
+
+    def handle(self, req):
+        output = io.StringIO()
+        ok = False
+        with contextlib.redirect_stdout(output):
+            try:
+                kbd = self.get_keyboard()
+                # nothing should be waiting but don't let anything left over
+                # get taken as a response
+                kbd.run(kbd.flush_input())
+                kbd.discard_changes()
+                if req['force']:
+                    kbd.profile = KeyboardProfile("", kbd.packet_len)
+                    kbd.default_profile = KeyboardProfile("", kbd.packet_len)
+                ok = self.handler(kbd, req)
+                if req['force']:
+                    # don't know what's on the device any more
+                    self.kbd = None
+            except OSError:
+                traceback.print_exc(file=output)
+                self.invalidate()
+            except Exception:
+                traceback.print_exc(file=output)
+                # could have failed part way through a submit
+                self.kbd = None
+        return {'ok': ok, 'output': output.getvalue()}
+
+def start_udev_monitor():
+    try:
+        import pyudev
+    except ImportError:
+        print("WARNING: pyudev isn't available, device replugs won't be noticed.")
+        return None
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by('hidraw')
+    monitor.start()
+    return monitor
+
+def serve_connection(daemon, conn):
+    with conn:
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            req = json.loads(recv_all(conn).decode('utf-8'))
+        except (OSError, ValueError) as e:
+            print(f"Bad request: {e}")
+            return
+        if req.get('ping', False):
+            resp = {'ok': True, 'output': ""}
+        else:
+            resp = daemon.handle(req)
+        try:
+            conn.sendall(json.dumps(resp).encode('utf-8'))
+        except OSError as e:
+            print(f"Failed to send response: {e}")
+
+def serve(handler, path=None):
+    if path is None:
+        path = get_socket_path()
+
+    # clear out a socket left behind, but not one something is listening on
+    if request({'ping': True}, path) is not None:
+        raise RuntimeError(f"A daemon is already listening on {path}.")
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    daemon = KeyboardDaemon(handler)
+    monitor = start_udev_monitor()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(str(path))
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        print(f"Listening on {path}.")
+
+        fds = [server]
+        if monitor is not None:
+            fds.append(monitor)
+
+        try:
+            while True:
+                readable = select.select(fds, (), ())[0]
+                if monitor is not None and monitor in readable:
+                    for device in iter(functools.partial(monitor.poll, 0), None):
+                        daemon.device_event(device.action, device.device_node)
+                if server in readable:
+                    conn, _ = server.accept()
+                    serve_connection(daemon, conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.invalidate()
+            os.unlink(path)
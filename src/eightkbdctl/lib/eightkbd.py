@@ -1,17 +1,34 @@
+import time
 import array
+import inspect
 import struct
 from enum import IntEnum
 import itertools
+import collections
+import collections.abc
 
 from .util import str_hex, bits_to_bytes
 from .keys import get_hut_code_from_name, get_name_from_hut_code, get_is_modifier, KEY_DISABLE, NO_MODIFIER, DISABLE_NAME
 from .util import arg_to_num
+from . import trace
+from . import output
 
 VENDOR_ID = 0x2dc8
 PRODUCT_ID = 0x5200
 INTERFACE_NUM = 2
 
-KBD_TIMEOUT = 5
+# bounds on how long to wait for a reply in seconds, in between the wait
+# adapts to measured round trip times, see RoundTripEstimator
+INITIAL_TIMEOUT = 0.25
+MIN_TIMEOUT = 0.05
+MAX_TIMEOUT = 2.0
+# times a get command is sent again when the reply doesn't arrive in time
+GET_RETRIES = 3
+# times to wait for an acknowledgement, backing off each time
+ACK_WAITS = 3
+# number of acknowledged transactions which may be outstanding at once when
+# pipelining is enabled
+PIPELINE_WINDOW = 4
 
 OUT_ID = 82
 IN_ID = 84
@@ -44,6 +61,14 @@ CMD_GET_MACROS = 0x82
 CMD_GET_KEY = 0x83
 CMD_GET_MACRO_NAME = 0x84
 CMD_GET_MACRO = 0x86
+# how much of a request its reply is known to start with, 06 from captures
+# and the key after the command for gets about one key, which is where the
+# key in their replies is.  Replies to anything else are taken as they come
+# with input flushed first.
+REPLY_ECHO_LENS = {0x06: 1,
+                   CMD_GET_KEY: 2,
+                   CMD_GET_MACRO_NAME: 2,
+                   CMD_GET_MACRO: 2}
 
 class MacroEventAction(IntEnum):
     DELAY = 0x0F
@@ -52,6 +77,17 @@ class MacroEventAction(IntEnum):
     MOD_PRESSED = 0x83
     MOD_RELEASED = 0x03
 
+# tables for bytes.translate(), MACRO_EVENT_ACTIONS makes valid actions
+# non-zero and MACRO_KEY_EVENTS makes actions with a key argument 0xFF
+MACRO_EVENT_ACTIONS = bytes(int(code in set(MacroEventAction)) for code in range(256))
+MACRO_KEY_EVENTS = bytes(0xFF if code in set(MacroEventAction) and code != MacroEventAction.DELAY
+                         else 0 for code in range(256))
+
+# longest a single delay event can be, in ms
+MAX_DELAY = 65535
+# the event count in MACRO_HDR is a byte
+MAX_MACRO_EVENTS = 255
+
 KEY_NAMES = {
     0x6C: "modifier-b",
     0x6D: "modifier-a",
@@ -119,21 +155,35 @@ def get_name_from_key_code(key):
         return KEY_NAMES[key]
     return get_name_from_hut_code(code)
 
-def get_name_from_bitfield_code(code):
+def get_key_code_from_bitfield_code(code):
+    # bit numbers in keymap mode reports skip the key codes between
     if code >= 50:
-        return get_name_from_key_code(code + 0x14)
-    return get_name_from_key_code(code + 4)
+        return code + 0x14
+    return code + 4
+
+def get_bitfield_code_from_key_code(key):
+    # None for keys which aren't in keymap mode reports
+    if key >= 50 + 0x14:
+        return key - 0x14
+    if key >= 4 and key < 50 + 4:
+        return key - 4
+    return None
 
-def get_key_code_from_name(name):
+def get_name_from_bitfield_code(code):
+    return get_name_from_key_code(get_key_code_from_bitfield_code(code))
+
+def get_key_code_from_name(name, numeric=True):
+    # with numeric False, names like "1" are always the key's name
     code = 0
-    try:
-        code = arg_to_num(name)
-    except ValueError:
-        pass
+    if numeric:
+        try:
+            code = arg_to_num(name)
+        except ValueError:
+            pass
     if code == 0:
         try:
             # try to get the HUT name from the key name
-            code = get_hut_code_from_name(name.lower())
+            code = get_hut_code_from_name(name.lower(), False, False)
             try_init_value_keys()
             # convert the HUT code to the key code.  This will
             # convert modifier HUT key values to the 8bitdo values
@@ -209,7 +259,15 @@ MACRO_EVENT = struct.Struct("<BH")
 MACRO_DELETE = struct.Struct("<BBB")
 
 class KeyMapping:
-    def __init__(self, to_key, mod_key):
+    __slots__ = ("to_key", "mod_key")
+
+    def __init__(self, to_key, mod_key, check=True):
+        if not check:
+            # already checked, as when it's from a KeyTable
+            self.mod_key = mod_key
+            self.to_key = to_key
+            return
+
         if not get_is_assignable(to_key, True):
             raise ValueError(f"Key code {to_key} is unassignable.")
 
@@ -244,15 +302,153 @@ class KeyMapping:
     def get_set_array(self, from_key, packet_len):
         buf = array.array('B', CMD_SET_KEY)
         # TODO: figure out mouse stuff and expand this
-        buf.extend(KEY_SET_HDR.pack(from_key, SET_TYPE_KBD))
-        buf.extend(MAP_KEY.pack(self.mod_key, self.to_key))
+        buf.frombytes(KEY_SET_HDR.pack(from_key, SET_TYPE_KBD) +
+                      MAP_KEY.pack(self.mod_key, self.to_key))
         # extend to packet length
-        buf.extend(itertools.repeat(0, packet_len - len(buf)))
+        buf.frombytes(bytes(packet_len - len(buf)))
 
         return buf
 
 MAP_DISABLED = KeyMapping(KEY_DISABLE, KEY_DISABLE)
 
+def get_default_mapping(key):
+    return KeyMapping(KEY_VALUES[key], KEY_DISABLE)
+
+# key codes are a byte
+KEY_TABLE_SIZE = 256
+
+class KeyTable(collections.abc.MutableMapping):
+    # Behaves like a dict of key codes to KeyMappings, but the to_key and
+    # mod_key of each key are kept in tables indexed by key code with a bitmap
+    # of which keys are set, so whole profiles are built, copied and compared
+    # a table at a time.  The KeyMappings looked up are made from the tables.
+    def __init__(self):
+        self.to_keys = array.array('B', bytes(KEY_TABLE_SIZE))
+        self.mod_keys = array.array('B', bytes(KEY_TABLE_SIZE))
+        self.present = 0
+
+    def copy(self):
+        table = KeyTable()
+        table.to_keys[:] = self.to_keys
+        table.mod_keys[:] = self.mod_keys
+        table.present = self.present
+        return table
+
+    def __getitem__(self, key):
+        if (self.present >> key) & 1 == 0:
+            raise KeyError(key)
+        return KeyMapping(self.to_keys[key], self.mod_keys[key], False)
+
+    def __setitem__(self, key, mapping):
+        self.to_keys[key] = mapping.to_key
+        self.mod_keys[key] = mapping.mod_key
+        self.present |= 1 << key
+
+    def __delitem__(self, key):
+        if (self.present >> key) & 1 == 0:
+            raise KeyError(key)
+        # keep the tables of two equal profiles the same
+        self.to_keys[key] = 0
+        self.mod_keys[key] = 0
+        self.present &= ~(1 << key)
+
+    def __contains__(self, key):
+        return key >= 0 and (self.present >> key) & 1 == 1
+
+    def __iter__(self):
+        # lowest key code first
+        present = self.present
+        while present != 0:
+            lowest = present & -present
+            yield lowest.bit_length() - 1
+            present ^= lowest
+
+    def __len__(self):
+        return self.present.bit_count()
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyTable):
+            return super().__eq__(other)
+        return self.present == other.present and \
+               self.to_keys == other.to_keys and \
+               self.mod_keys == other.mod_keys
+
+    def is_default(self, key):
+        return self.to_keys[key] == DEFAULT_KEYS.to_keys[key] and \
+               self.mod_keys[key] == DEFAULT_KEYS.mod_keys[key]
+
+    def get_changed(self, current, default):
+        # keys set here which would change something over current, where a
+        # key current doesn't have is what's in default.  current may be any
+        # mapping, such as a LazyMapping.
+        if isinstance(current, KeyTable):
+            if self == current:
+                return []
+            # where current has nothing, compare with default
+            to_keys = array.array('B', default.to_keys)
+            mod_keys = array.array('B', default.mod_keys)
+            for key in current:
+                to_keys[key] = current.to_keys[key]
+                mod_keys[key] = current.mod_keys[key]
+            return [key for key in self
+                    if self.to_keys[key] != to_keys[key] or self.mod_keys[key] != mod_keys[key]]
+        changed = []
+        for key in self:
+            if key in current:
+                mapping = current[key]
+                to_key, mod_key = mapping.to_key, mapping.mod_key
+            else:
+                to_key, mod_key = default.to_keys[key], default.mod_keys[key]
+            if self.to_keys[key] != to_key or self.mod_keys[key] != mod_key:
+                changed.append(key)
+        return changed
+
+DEFAULT_KEYS = KeyTable()
+for key in KEY_VALUES.keys():
+    DEFAULT_KEYS[key] = get_default_mapping(key)
+
+def optimize_macro_events(events):
+    # Shrink a list of (action, arg) events without changing what the host
+    # sees or when: delays next to each other are merged and empty ones left
+    # out, a modifier let go of and pressed again straight away is just left
+    # held and pressing a modifier which is already held does nothing.
+    # Delays too long for one event are split after merging.
+    merged = []
+    held = set()
+    for action, arg in events:
+        match action:
+            case MacroEventAction.DELAY:
+                if arg < 0:
+                    raise ValueError(f"Delay value {arg} out of range!")
+                if len(merged) > 0 and merged[-1][0] == MacroEventAction.DELAY:
+                    merged[-1] = (MacroEventAction.DELAY, merged[-1][1] + arg)
+                elif arg > 0:
+                    merged.append((MacroEventAction.DELAY, arg))
+            case MacroEventAction.MOD_PRESSED:
+                if arg in held:
+                    continue
+                held.add(arg)
+                if len(merged) > 0 and merged[-1] == (MacroEventAction.MOD_RELEASED, arg):
+                    merged.pop()
+                    continue
+                merged.append((action, arg))
+            case MacroEventAction.MOD_RELEASED:
+                # may be letting go of a modifier held down on the keyboard,
+                # so it's always kept
+                held.discard(arg)
+                merged.append((action, arg))
+            case _:
+                merged.append((action, arg))
+
+    optimized = []
+    for action, arg in merged:
+        if action == MacroEventAction.DELAY:
+            while arg > MAX_DELAY:
+                optimized.append((MacroEventAction.DELAY, MAX_DELAY))
+                arg -= MAX_DELAY
+        optimized.append((action, arg))
+    return optimized
+
 class KeyboardMacro:
     def __init__(self, name : str, repeats : int, packet_len : int):
         if repeats < 0 or repeats > 65535:
@@ -261,10 +457,11 @@ class KeyboardMacro:
         self.encoded_name = try_encode_name(name, self.packet_len - MACRO_NAME_HDR.size)
         self.name = name
         self.repeats = repeats
-        self.events = []
+        # the events as they're sent to the device, MACRO_EVENT after MACRO_EVENT
+        self.eventsbuf = bytearray()
 
     def set_name(self, name):
-        self.encoded_name = try_encode_name(self.name, self.packet_len - MACRO_NAME_HDR.size)
+        self.encoded_name = try_encode_name(name, self.packet_len - MACRO_NAME_HDR.size)
         self.name = name
 
     def set_repeats(self, repeats):
@@ -273,38 +470,59 @@ class KeyboardMacro:
     def add_event(self, event, arg):
         match event:
             case MacroEventAction.DELAY:
-                if arg < 0 or arg > 65535:
-                    raise ValueError("Delay value {arg} out of range!")
-                self.events.append((event, arg))
+                if arg < 0 or arg > MAX_DELAY:
+                    raise ValueError(f"Delay value {arg} out of range!")
             case MacroEventAction.PRESSED:
                 if arg < 0 or arg > 255:
                     raise ValueError("Key value {arg} out of range!")
-                self.events.append((event, arg))
             case MacroEventAction.RELEASED:
                 if arg < 0 or arg > 255:
                     raise ValueError("Key value {arg} out of range!")
-                self.events.append((event, arg))
             case MacroEventAction.MOD_PRESSED:
                 if arg < 0 or arg > 255:
                     raise ValueError("Key value {arg} out of range!")
-                self.events.append((event, arg))
             case MacroEventAction.MOD_RELEASED:
                 if arg < 0 or arg > 255:
                     raise ValueError("Key value {arg} out of range!")
-                self.events.append((event, arg))
             case _:
                 raise ValueError("Unsupported event {event}!")
+        if len(self.eventsbuf) >= MAX_MACRO_EVENTS * MACRO_EVENT.size:
+            raise ValueError(f"A macro can't have more than {MAX_MACRO_EVENTS} events!")
+        self.eventsbuf += MACRO_EVENT.pack(event, arg)
 
     def add_events(self, events):
         for event in events:
             self.add_event(event[0], event[1])
 
+    def add_events_buf(self, eventsbuf):
+        # events already packed, as gotten from the device, checked all at
+        # once rather than one at a time
+        if len(eventsbuf) % MACRO_EVENT.size != 0:
+            raise ValueError("Macro data isn't a whole number of events!")
+        actions = bytes(eventsbuf[0::MACRO_EVENT.size])
+        if 0 in actions.translate(MACRO_EVENT_ACTIONS):
+            raise ValueError("Unsupported event in macro data!")
+        # only delays go over a byte, so the high byte of every other event's
+        # argument must be 0
+        high = bytes(eventsbuf[2::MACRO_EVENT.size])
+        if int.from_bytes(actions.translate(MACRO_KEY_EVENTS), 'little') & \
+           int.from_bytes(high, 'little') != 0:
+            raise ValueError("Key value out of range!")
+        if len(self.eventsbuf) + len(eventsbuf) > MAX_MACRO_EVENTS * MACRO_EVENT.size:
+            raise ValueError(f"A macro can't have more than {MAX_MACRO_EVENTS} events!")
+        self.eventsbuf += eventsbuf
+
+    @property
+    def events(self):
+        # (action, arg) for each event, made from eventsbuf each time
+        return list(MACRO_EVENT.iter_unpack(self.eventsbuf))
+
     def clear_events(self):
-        self.events = []
+        self.eventsbuf = bytearray()
 
     def str_event_list(self):
         ret = ""
-        for num, event in enumerate(self.events):
+        for event in MACRO_EVENT.iter_unpack(self.eventsbuf):
             match event[0]:
                 case MacroEventAction.DELAY:
                     ret += f"Delay: {event[1]} ms\n"
@@ -330,19 +548,13 @@ class KeyboardMacro:
         # only compare data, not names
         if self.repeats != other.repeats:
             return False
-        if len(self.events) != len(other.events):
-            return False
-        for num, event in enumerate(self.events):
-            if event[0] != other.events[num][0] or event[1] != other.events[num][1]:
-                return False
-        return True
+        return self.eventsbuf == other.eventsbuf
 
     def generate_macro_data(self):
         buf = array.array('B', MACRO_HDR.pack(CMD_MACRO_CONST,
                                               self.repeats,
-                                              len(self.events)))
-        for event in self.events:
-            buf.extend(MACRO_EVENT.pack(event[0].value, event[1]))
+                                              len(self.eventsbuf) // MACRO_EVENT.size))
+        buf.frombytes(self.eventsbuf)
 
         return buf
 
@@ -361,50 +573,86 @@ class KeyboardMacro:
         # extend to packet length
         namebuf.extend(itertools.repeat(0, self.packet_len - len(namebuf)))
 
-        if len(self.events) == 0:
+        if len(self.eventsbuf) == 0:
             return namebuf, ()
 
+        return namebuf, self.get_event_packets(from_key)
+
+    def get_event_packets(self, from_key):
         eventsbuf = self.generate_macro_data()
+        # chunks end on an event, the first also has the macro header as the
+        # vendor app sends it
+        first_len = MACRO_HDR.size + \
+                    (self.packet_len - MACRO_PKT_HDR.size - MACRO_HDR.size) // MACRO_EVENT.size * MACRO_EVENT.size
+        chunk_len = (self.packet_len - MACRO_PKT_HDR.size) // MACRO_EVENT.size * MACRO_EVENT.size
 
         bufs = []
-
         pos = 0
         while pos < len(eventsbuf):
-            this_len = 6 # every packet length
-            items_len = 0
+            this_len = chunk_len
             if pos == 0:
-                items_len += 4 # first packet additional
-            this_items = (self.packet_len - this_len - items_len) // 3 # event length
-            items_len += this_items * 3
-            this_len += items_len
+                this_len = first_len
+            chunk = eventsbuf[pos:pos+this_len]
             more = CMD_MACRO_MORE
-            if pos + items_len >= len(eventsbuf):
-                items_len = len(eventsbuf) - pos
+            if pos + this_len >= len(eventsbuf):
                 more = 0
             buf = array.array('B', MACRO_PKT_HDR.pack(CMD_SET_MACRO,
                                                       from_key,
                                                       more,
                                                       pos,
-                                                      items_len))
-            buf.extend(eventsbuf[pos:pos+items_len])
+                                                      len(chunk)))
+            buf.extend(chunk)
             # extend to packet length
             buf.extend(itertools.repeat(0, self.packet_len - len(buf)))
             bufs.append(buf)
-            pos += items_len
-        return namebuf, bufs
+            pos += len(chunk)
+        return bufs
+
+# not yet gotten from the device
+NOT_FETCHED = object()
+
+class LazyMapping(collections.abc.MutableMapping):
+    # Behaves like a dict of keys which are known up front, values are only
+    # gotten with fetch(key) the first time they're looked up.
+    def __init__(self, keys, fetch):
+        self.fetch = fetch
+        self.values = dict.fromkeys(keys, NOT_FETCHED)
+
+    def __getitem__(self, key):
+        value = self.values[key]
+        if value is NOT_FETCHED:
+            value = self.fetch(key)
+            self.values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        del self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_fetched(self):
+        return {key: value for key, value in self.values.items() if value is not NOT_FETCHED}
 
 class KeyboardProfile:
     def __init__(self, name : str, packet_len : int):
         self.packet_len = packet_len
         self.encoded_name = try_encode_name(name, self.packet_len - NAME_HDR.size)
         self.name = name
-        self.keys = {}
+        self.keys = KeyTable()
         self.macros = {}
 
     def set_all_default(self):
-        self.keys = {}
-        for key in KEY_VALUES.keys():
-            self.keys[key] = KeyMapping(KEY_VALUES[key], KEY_DISABLE)
+        self.keys = DEFAULT_KEYS.copy()
         self.macros = {}
 
     def set_name(self, name):
@@ -467,6 +715,15 @@ class KeyboardProfile:
         packets.extend(self.get_all_macro_packets())
         return packets
 
+    def iter_entries(self):
+        # ("name", None, name), then ("key", key, KeyMapping) for each mapping
+        # and ("macro", key, KeyboardMacro) for each macro
+        yield ("name", None, self.name)
+        for key in self.keys.keys():
+            yield ("key", key, self.keys[key])
+        for key in self.macros.keys():
+            yield ("macro", key, self.macros[key])
+
     def __str__(self):
         ret = f"Profile Name: {self.name}\nKey Mappings:\n"
         for key in self.keys.keys():
@@ -478,7 +735,7 @@ class KeyboardProfile:
 
 def listen_response(hid, success, report_id, data):
     if success[0]:
-        print(hid.decode(report_id, data))
+        output.write(hid.decode(report_id, data))
 
     if report_id != IN_ID:
         # keep listening
@@ -490,227 +747,521 @@ def listen_response(hid, success, report_id, data):
             success[1][0] = False
     return False
 
+def get_reply_echo(buf):
+    # what a reply starts with, only checked for commands it's been seen for
+    return tuple(buf[:REPLY_ECHO_LENS.get(buf[0], 0)])
+
+def reply_matches(data_return, data):
+    # anything else is left over from an earlier request which timed out.  A
+    # response packet instead means the device rejected the request, the
+    # callbacks stop with nothing returned for that.
+    return tuple(data[:len(data_return[2])]) == data_return[2]
+
 def get_data_once(hid, data_return, report_id, data):
     if data_return[0]:
-        print(hid.decode(report_id, data))
+        output.write(hid.decode(report_id, data))
 
     if report_id == IN_ID:
-        data_return[1].append(data)
-        return False
+        if data[0] == RESPONSE_CODE:
+            del data_return[1][:]
+            return False
+        if reply_matches(data_return, data):
+            data_return[1].append(data)
+            return False
 
     return True
 
 def get_data_list(hid, data_return, report_id, data):
     if data_return[0]:
-        print(hid.decode(report_id, data))
+        output.write(hid.decode(report_id, data))
 
     if report_id == IN_ID:
-        data_return[1].append(data[:-1])
-        if data[-1] == 0:
+        if data[0] == RESPONSE_CODE:
+            del data_return[1][:]
             return False
+        if reply_matches(data_return, data):
+            data_return[1].append(data[:-1])
+            if data[-1] == 0:
+                return False
 
     return True
 
 def get_data_macrolist(hid, data_return, report_id, data):
     if data_return[0]:
-        print(hid.decode(report_id, data))
+        output.write(hid.decode(report_id, data))
 
     if report_id == IN_ID:
+        if data[0] == RESPONSE_CODE:
+            del data_return[1][:]
+            return False
+        if not reply_matches(data_return, data):
+            return True
         _, _, _, pos, size = MACRO_PKT_HDR.unpack(data[0:MACRO_PKT_HDR.size])
-        if len(data_return[1]) == pos:
-            data_return[1].extend(data[MACRO_PKT_HDR.size:MACRO_PKT_HDR.size+size])
-        else:
-            raise ValueError("Only support appending macro data buffers!")
+        if len(data_return[1]) != pos:
+            if len(data_return[1]) == 0:
+                # the rest of a reply which was given up on
+                return True
+            # a packet went missing, no need to wait to ask again
+            data_return[3][0] = True
+            return False
+        data_return[1].extend(data[MACRO_PKT_HDR.size:MACRO_PKT_HDR.size+size])
         if data[CMD_MACRO_MORE_POS] == 0:
             return False
 
     return True
 
-def decode_macro_data(macrobuf):
-    _, repeats, count = MACRO_HDR.unpack(macrobuf[:MACRO_HDR.size])
-
-    events = []
-    for pos in range(MACRO_HDR.size,
-                     MACRO_HDR.size+(count*MACRO_EVENT.size),
-                     MACRO_EVENT.size):
-        events.append(MACRO_EVENT.unpack(macrobuf[pos:pos+MACRO_EVENT.size]))
-
-    return repeats, events
-
-class EightKeyboard:
-    def get_profile_from_device(self):
-        buf = array.array('B', itertools.repeat(0, self.packet_len))
+def discard_input(hid, verbose, report_id, data):
+    if verbose:
+        output.write("Discarded: ", hid.decode(report_id, data))
+    return True
 
-        # get name
-        buf[0] = CMD_GET_NAME
-        if self.verbose:
-            print(self.hid.decode(OUT_ID, buf))
-        self.hid.write(self.hid.generate_report(OUT_ID, buf))
+def record_report(hid, recorder, report_id, data):
+    # keymap mode reports go to a MacroRecorder until it says to stop
+    if report_id != IN_ID or data[0] == RESPONSE_CODE:
+        return True
+    return recorder.feed(data)
+
+def group_transactions(packets):
+    # group packets in to runs ending with a packet the device acknowledges,
+    # like macro data chunks which are only acknowledged after the last one
+    transactions = []
+    bufs = []
+    for buf, wait in packets:
+        bufs.append(buf)
+        if wait:
+            transactions.append((bufs, True))
+            bufs = []
+    if len(bufs) > 0:
+        transactions.append((bufs, False))
+    return transactions
 
-        data_return = (self.verbose, [])
-        if not self.hid.listen(-1, get_data_once, data_return, KBD_TIMEOUT):
-            raise RuntimeError("Failed to get profile name from device.")
+def decode_macro_data(macrobuf):
+    # the events are left packed, for KeyboardMacro.add_events_buf()
+    _, repeats, count = MACRO_HDR.unpack(macrobuf[:MACRO_HDR.size])
 
-        _, str_size = NAME_HDR.unpack(data_return[1][0][:NAME_HDR.size])
-        name = decode_name(data_return[1][NAME_HDR.size:NAME_HDR.size+str_size])
+    return repeats, bytes(macrobuf[MACRO_HDR.size:MACRO_HDR.size+(count*MACRO_EVENT.size)])
 
-        self.profile = KeyboardProfile(name, self.packet_len)
+class RoundTripEstimator:
+    # how long to wait for a reply, worked out from measured round trip
+    # times like TCP's retransmission timeout in RFC 6298
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_TIMEOUT
 
-        # get list of mappings
-        buf[0] = CMD_GET_KEYS
-        if self.verbose:
-            print(self.hid.decode(OUT_ID, buf))
-        self.hid.write(self.hid.generate_report(OUT_ID, buf))
-
-        data_return = (self.verbose, [])
-        if not self.hid.listen(-1, get_data_list, data_return, KBD_TIMEOUT):
-            raise RuntimeError("Failed to get key mappings list from device.")
-
-        mapped_keys = []
-        for item in data_return[1]:
-            for i in range(1, len(item)-2, 2):
-                key = item[i]
-                if key == 0:
-                    break
-                mapped_keys.append(key)
-
-        # get list of macros
-        buf[0] = CMD_GET_MACROS
-        if self.verbose:
-            print(self.hid.decode(OUT_ID, buf))
-        self.hid.write(self.hid.generate_report(OUT_ID, buf))
-
-        data_return = (self.verbose, [])
-        if not self.hid.listen(-1, get_data_list, data_return, KBD_TIMEOUT):
-            raise RuntimeError("Failed to get key mappings list from device.")
-
-        macros = []
-        for item in data_return[1]:
-            for i in range(1, len(item)-2, 4):
-                macro = item[i]
-                if macro == 0:
-                    break
-                macros.append(macro)
-
-        # get mappings
-        buf[0] = CMD_GET_KEY
-
-        for key in mapped_keys:
-            buf[1] = key
-            if self.verbose:
-                print(self.hid.decode(OUT_ID, buf))
-            self.hid.write(self.hid.generate_report(OUT_ID, buf))
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.srtt + 4 * self.rttvar))
 
-            data_return = (self.verbose, [])
-            if not self.hid.listen(-1, get_data_once, data_return, KBD_TIMEOUT):
-                raise RuntimeError("Failed to get key mapping from device.")
+    def backoff(self):
+        self.rto = min(MAX_TIMEOUT, self.rto * 2)
 
-            _, from_key, map_type = KEY_HDR.unpack(data_return[1][0][:KEY_HDR.size])
+class LatencyModel:
+    # An estimator for each command byte, as lists and macros take longer to
+    # come back than single replies, falling back on one for the whole session
+    # for commands which haven't had a reply yet.
+    def __init__(self):
+        self.session = RoundTripEstimator()
+        self.commands = {}
 
-            if from_key != key:
-                raise ValueError(f"Got mapping for key {from_key} instead of {key}?")
-            if map_type != SET_TYPE_KBD:
-                raise ValueError(f"Unrecognized mapping type {map_type}.")
+    def get_estimator(self, cmd):
+        return self.commands.get(cmd, self.session)
 
-            mod_key, to_key = MAP_KEY.unpack(data_return[1][0][KEY_HDR.size:KEY_HDR.size+MAP_KEY.size])
+    def timeout(self, cmd):
+        return self.get_estimator(cmd).rto
 
-            mapping = KeyMapping(to_key, mod_key)
-            self.profile.set_key(key, mapping)
+    def sample(self, cmd, rtt):
+        self.session.sample(rtt)
+        if cmd not in self.commands:
+            self.commands[cmd] = RoundTripEstimator()
+        self.commands[cmd].sample(rtt)
 
-        # get macro names
-        buf[0] = CMD_GET_MACRO_NAME
+    def backoff(self, cmd):
+        self.get_estimator(cmd).backoff()
 
-        macronames = {}
+class EightKeyboard:
+    # Anything which talks to the device is written as a generator which
+    # yields the arguments for each HIDDEV.listen it needs and is sent back
+    # the result, so the same code can be driven by HIDDEV or AsyncHIDDEV.
+    # Verbose output is written on another thread, it's all written out
+    # before returning so it comes before anything printed after.  An
+    # operation which is stopped part way, like by ctrl-c, is closed so it
+    # can clean up.
+    def run(self, operation):
+        if self.is_async:
+            operation.close()
+            raise TypeError("An AsyncHIDDEV needs async_run().")
+        try:
+            listen_args = next(operation)
+            while True:
+                listen_args = operation.send(self.hid.listen(-1, *listen_args))
+        except StopIteration as e:
+            return e.value
+        finally:
+            operation.close()
+            output.flush()
+
+    async def async_run(self, operation):
+        try:
+            listen_args = next(operation)
+            while True:
+                listen_args = operation.send(await self.hid.listen(-1, *listen_args))
+        except StopIteration as e:
+            return e.value
+        finally:
+            operation.close()
+            output.flush()
+
+    def request(self, buf, callback, data, error):
+        # get commands don't change anything so they're just sent again if
+        # the reply doesn't arrive in time
+        cmd = buf[0]
+        lost = [False]
+        data_return = (self.verbose, data, get_reply_echo(buf), lost)
+        for attempt in range(GET_RETRIES + 1):
+            if attempt > 0:
+                if trace.tracer is not None:
+                    trace.tracer.retry(cmd)
+                del data[:]
+                lost[0] = False
+            # drop anything left over, like a partial reply
+            yield from self.flush_input()
 
-        for macro in macros:
-            buf[1] = macro
             if self.verbose:
-                print(self.hid.decode(OUT_ID, buf))
+                output.write(self.hid.decode(OUT_ID, buf))
+            start = time.perf_counter()
             self.hid.write(self.hid.generate_report(OUT_ID, buf))
 
-            data_return = (self.verbose, [])
-            if not self.hid.listen(-1, get_data_once, data_return, KBD_TIMEOUT):
-                raise RuntimeError("Failed to get macro name from device.")
+            if (yield (callback, data_return, self.latency.timeout(cmd))):
+                if lost[0]:
+                    continue
+                if len(data) == 0:
+                    # rejected
+                    raise RuntimeError(error)
+                end = time.perf_counter()
+                # a reply after sending again could be to either, so it
+                # doesn't say anything about the round trip time
+                if attempt == 0:
+                    self.latency.sample(cmd, end - start)
+                if trace.tracer is not None:
+                    trace.tracer.round_trip(cmd, start, end)
+                return data
+
+            self.latency.backoff(cmd)
+            if trace.tracer is not None:
+                trace.tracer.timeout(cmd)
+
+        raise RuntimeError(error)
+
+    def new_request_buf(self, cmd, key=0):
+        buf = array.array('B', itertools.repeat(0, self.packet_len))
+        buf[0] = cmd
+        buf[1] = key
+        return buf
+
+    # Getting the name and lists return the reply too, all of them together
+    # being the profile's fingerprint.
+    def do_get_name(self):
+        with trace.phase("get name"):
+            data = yield from self.request(self.new_request_buf(CMD_GET_NAME), get_data_once, [],
+                                           "Failed to get profile name from device.")
+
+            _, str_size = NAME_HDR.unpack(data[0][:NAME_HDR.size])
+            name = decode_name(data[0][NAME_HDR.size:NAME_HDR.size+str_size])
+
+        return name, b''.join(data)
+
+    def do_get_key_list(self):
+        # each mapped key's entry in the list
+        with trace.phase("get keys"):
+            data = yield from self.request(self.new_request_buf(CMD_GET_KEYS), get_data_list, [],
+                                           "Failed to get key mappings list from device.")
+
+            key_entries = {}
+            for item in data:
+                for i in range(1, len(item)-2, 2):
+                    key = item[i]
+                    if key == 0:
+                        break
+                    key_entries[key] = bytes(item[i:i+2])
+
+        return key_entries, b''.join(data)
+
+    def do_get_macro_list(self):
+        # each macro's entry in the list
+        with trace.phase("get macros"):
+            data = yield from self.request(self.new_request_buf(CMD_GET_MACROS), get_data_list, [],
+                                           "Failed to get key mappings list from device.")
+
+            macro_entries = {}
+            for item in data:
+                for i in range(1, len(item)-2, 4):
+                    macro = item[i]
+                    if macro == 0:
+                        break
+                    macro_entries[macro] = bytes(item[i:i+4])
+
+        return macro_entries, b''.join(data)
+
+    def do_get_lists(self):
+        name, name_reply = yield from self.do_get_name()
+        key_entries, keys_reply = yield from self.do_get_key_list()
+        macro_entries, macros_reply = yield from self.do_get_macro_list()
+        return name, key_entries, macro_entries, name_reply + keys_reply + macros_reply
+
+    def do_get_key(self, key):
+        data = yield from self.request(self.new_request_buf(CMD_GET_KEY, key), get_data_once, [],
+                                       "Failed to get key mapping from device.")
+
+        _, from_key, map_type = KEY_HDR.unpack(data[0][:KEY_HDR.size])
+
+        if from_key != key:
+            raise ValueError(f"Got mapping for key {from_key} instead of {key}?")
+        if map_type != SET_TYPE_KBD:
+            raise ValueError(f"Unrecognized mapping type {map_type}.")
+
+        mod_key, to_key = MAP_KEY.unpack(data[0][KEY_HDR.size:KEY_HDR.size+MAP_KEY.size])
+
+        return KeyMapping(to_key, mod_key)
+
+    def do_get_macro_name(self, macro):
+        data = yield from self.request(self.new_request_buf(CMD_GET_MACRO_NAME, macro), get_data_once, [],
+                                       "Failed to get macro name from device.")
+
+        _, from_key, str_size = MACRO_NAME_HDR.unpack(data[0][:MACRO_NAME_HDR.size])
+
+        if from_key != macro:
+            raise ValueError(f"Got macro for key {from_key} instead of {macro}?")
+
+        return decode_name(data[0][MACRO_NAME_HDR.size:MACRO_NAME_HDR.size+str_size])
+
+    def do_get_macro(self, macro, name):
+        data = yield from self.request(self.new_request_buf(CMD_GET_MACRO, macro), get_data_macrolist,
+                                       array.array('B'), "Failed to get macro definition from device.")
+
+        repeats, eventsbuf = decode_macro_data(data)
+        macro_obj = KeyboardMacro(name, repeats, self.packet_len)
+        macro_obj.add_events_buf(eventsbuf)
+        return macro_obj
+
+    def fetch_key(self, key):
+        with trace.phase("get key mapping"):
+            return self.run(self.do_get_key(key))
+
+    def fetch_macro(self, macro):
+        with trace.phase("get macro"):
+            name = self.run(self.do_get_macro_name(macro))
+            return self.run(self.do_get_macro(macro, name))
+
+    def get_known_entries(self):
+        # mappings and macros in the snapshot which needn't be gotten again
+        known_keys = {}
+        known_macros = {}
+        if self.snapshot is None:
+            return known_keys, known_macros
+
+        # with the same fingerprint nothing's changed, otherwise compare the
+        # entries in the lists
+        same = self.snapshot.fingerprint == self.fingerprint
+        for key, (entry, to_key, mod_key) in self.snapshot.keys.items():
+            if same or self.key_entries.get(key) == entry:
+                known_keys[key] = KeyMapping(to_key, mod_key)
+        for key, (entry, name, macrobuf) in self.snapshot.macros.items():
+            if same or self.macro_entries.get(key) == entry:
+                repeats, eventsbuf = decode_macro_data(macrobuf)
+                macro_obj = KeyboardMacro(name, repeats, self.packet_len)
+                macro_obj.add_events_buf(eventsbuf)
+                known_macros[key] = macro_obj
+        return known_keys, known_macros
+
+    def update_snapshot(self):
+        # record what's known to be on the device in the snapshot, to be
+        # saved and passed back next time
+        if self.snapshot is None:
+            return
+        self.snapshot.fingerprint = self.fingerprint
+        self.snapshot.keys = {}
+        self.snapshot.macros = {}
+        keys = self.profile.keys
+        macros = self.profile.macros
+        if isinstance(keys, LazyMapping):
+            keys = keys.get_fetched()
+        if isinstance(macros, LazyMapping):
+            macros = macros.get_fetched()
+        for key, mapping in keys.items():
+            if key in self.key_entries:
+                self.snapshot.keys[key] = (self.key_entries[key], mapping.to_key, mapping.mod_key)
+        for key, macro in macros.items():
+            if key in self.macro_entries:
+                self.snapshot.macros[key] = (self.macro_entries[key], macro.name,
+                                             bytes(macro.generate_macro_data()))
+
+    def do_get_profile_from_device(self, lazy=False):
+        name, self.key_entries, self.macro_entries, self.fingerprint = yield from self.do_get_lists()
 
-            _, from_key, str_size = MACRO_NAME_HDR.unpack(data_return[1][0][:MACRO_NAME_HDR.size])
+        self.profile = KeyboardProfile(name, self.packet_len)
+        known_keys, known_macros = self.get_known_entries()
+
+        if lazy:
+            # mappings and macros are only fetched when they're looked at,
+            # which needs a HIDDEV rather than an AsyncHIDDEV
+            self.profile.keys = LazyMapping(self.key_entries.keys(), self.fetch_key)
+            self.profile.keys.update(known_keys)
+            self.profile.macros = LazyMapping(self.macro_entries.keys(), self.fetch_macro)
+            self.profile.macros.update(known_macros)
+        else:
+            with trace.phase("get key mappings"):
+                for key in self.key_entries.keys():
+                    if key in known_keys:
+                        mapping = known_keys[key]
+                    else:
+                        mapping = yield from self.do_get_key(key)
+                    self.profile.set_key(key, mapping)
+
+            macros = [macro for macro in self.macro_entries.keys() if macro not in known_macros]
+
+            with trace.phase("get macro names"):
+                macronames = {}
+                for macro in macros:
+                    macronames[macro] = yield from self.do_get_macro_name(macro)
+
+            with trace.phase("get macro definitions"):
+                for macro in self.macro_entries.keys():
+                    if macro in known_macros:
+                        macro_obj = known_macros[macro]
+                    else:
+                        macro_obj = yield from self.do_get_macro(macro, macronames[macro])
+                    self.profile.set_macro(macro, macro_obj)
+
+        self.default_profile.set_all_default()
+        self.new_profile = KeyboardProfile(self.profile.name, self.packet_len)
 
-            if from_key != macro:
-                raise ValueError(f"Got macro for key {from_key} instead of {macro}?")
+    def get_profile_from_device(self, lazy=False):
+        self.run(self.do_get_profile_from_device(lazy))
 
-            macronames[macro] = decode_name(data_return[1][0][MACRO_NAME_HDR.size:MACRO_NAME_HDR.size+str_size])
+    def iter_profile_from_device(self):
+        # Gets the profile like get_profile_from_device(), but yields each
+        # part of it as soon as it's been gotten, the same as
+        # KeyboardProfile.iter_entries().  Only with a HIDDEV.
+        name, name_reply = self.run(self.do_get_name())
+        self.profile = KeyboardProfile(name, self.packet_len)
+        yield ("name", None, name)
 
-        # get macro definitions
-        buf[0] = CMD_GET_MACRO
+        self.key_entries, keys_reply = self.run(self.do_get_key_list())
+        self.macro_entries, macros_reply = self.run(self.do_get_macro_list())
+        self.fingerprint = name_reply + keys_reply + macros_reply
+        known_keys, known_macros = self.get_known_entries()
 
-        for macro in macros:
-            buf[1] = macro
-            if self.verbose:
-                print(self.hid.decode(OUT_ID, buf))
-            self.hid.write(self.hid.generate_report(OUT_ID, buf))
+        for key in self.key_entries.keys():
+            mapping = known_keys.get(key)
+            if mapping is None:
+                mapping = self.fetch_key(key)
+            self.profile.set_key(key, mapping)
+            yield ("key", key, mapping)
 
-            data_return = (self.verbose, array.array('B'))
-            if not self.hid.listen(-1, get_data_macrolist, data_return, KBD_TIMEOUT):
-                raise RuntimeError("Failed to get macro definition from device.")
+        for key in self.macro_entries.keys():
+            macro = known_macros.get(key)
+            if macro is None:
+                macro = self.fetch_macro(key)
+            self.profile.set_macro(key, macro)
+            yield ("macro", key, macro)
 
-            repeats, events = decode_macro_data(data_return[1])
-            macro_obj = KeyboardMacro(macronames[macro], repeats, self.packet_len)
-            macro_obj.add_events(events)
+        self.default_profile.set_all_default()
+        self.new_profile = KeyboardProfile(self.profile.name, self.packet_len)
 
-            self.profile.set_macro(macro, macro_obj)
+    async def async_get_profile_from_device(self):
+        await self.async_run(self.do_get_profile_from_device())
 
-    def __init__(self, hid, verbose=False, get_profile=True):
-        # get_profile == False to force all changes
+    def __init__(self, hid, verbose=False, get_profile=True, window=1, lazy=False, snapshot=None):
+        # get_profile == False to force all changes, lazy to only get each
+        # mapping or macro from the device when it's needed.  Mappings and
+        # macros in a ProfileSnapshot from lib.profilecache which are still
+        # on the device aren't gotten again.
         self.verbose = verbose
         self.hid = hid
+        # window == 1 waits for each acknowledgement before sending more
+        self.window = window
+        self.latency = LatencyModel()
         self.packet_len = bits_to_bytes(self.hid.get_reports()[OUT_ID].get_size())
         self.delete_macro = KeyboardMacro("", 0, self.packet_len)
+        self.default_profile = KeyboardProfile("", self.packet_len)
+        self.profile = KeyboardProfile("", self.packet_len)
+        self.new_profile = KeyboardProfile("", self.packet_len)
+        self.snapshot = snapshot
+        self.fingerprint = None
+        self.key_entries = {}
+        self.macro_entries = {}
+        # AsyncHIDDEV.listen() has to be awaited, so only async_run() works
+        self.is_async = inspect.iscoroutinefunction(hid.listen)
         if get_profile:
-            self.get_profile_from_device()
-            self.default_profile = KeyboardProfile("", self.packet_len)
-            self.default_profile.set_all_default()
-        else:
-            self.default_profile = KeyboardProfile("", self.packet_len)
-            self.profile = KeyboardProfile("", self.packet_len)
-        self.new_profile = KeyboardProfile(self.profile.name, self.packet_len)
-
-    def try_listen_success(self):
+            if self.is_async:
+                raise TypeError("With an AsyncHIDDEV, pass get_profile=False and await "
+                                "async_get_profile_from_device() instead.")
+            self.get_profile_from_device(lazy)
+
+    def listen_success(self, cmd):
+        # None if nothing came back in time.  Acknowledgements don't say what
+        # they're for, so rather than sending again and maybe taking a late
+        # one for the first as being for the second, wait longer each time.
         success = (self.verbose, [False])
-        if not self.hid.listen(-1, listen_response, success, KBD_TIMEOUT):
+        for attempt in range(ACK_WAITS):
+            if (yield (listen_response, success, self.latency.timeout(cmd))):
+                return success[1][0]
+            self.latency.backoff(cmd)
+            if trace.tracer is not None:
+                trace.tracer.timeout(cmd)
+        return None
+
+    def try_listen_success(self, cmd):
+        success = yield from self.listen_success(cmd)
+        if success is None:
             raise RuntimeError("Didn't get a response packet.")
-        elif not success[1][0]:
+        elif not success:
             raise RuntimeError("Device returned non-success.")
 
+    def flush_input(self):
+        yield (discard_input, self.verbose, 0)
+
+    def send_command(self, cmd):
+        # a command the device doesn't acknowledge
+        buf = self.hid.generate_report(OUT_ID, cmd)
+        if self.verbose:
+            output.write(self.hid.decode(OUT_ID, buf[1:]))
+        self.hid.write(buf)
+
+    def record_keys(self, recorder):
+        # keymap mode is always turned off again, however this ends
+        self.send_command(CMD_ENABLE_KEYMAP)
+        try:
+            yield (record_report, recorder, None)
+        finally:
+            self.send_command(CMD_DISABLE_KEYMAP)
+
+    def record(self, recorder):
+        # feed keymap mode reports to recorder until it's stopped or ctrl-c
+        # is pressed
+        self.run(self.record_keys(recorder))
+
+    def send_transaction(self, bufs):
+        for buf in bufs:
+            if self.verbose:
+                output.write(self.hid.decode(OUT_ID, buf))
+            self.hid.write(self.hid.generate_report(OUT_ID, buf))
+
     def set_name(self, name):
         self.new_profile.set_name(name)
 
-    def key_in_profile(self, from_key, mapping=None):
-        if mapping is None:
-            if (from_key in self.default_profile.keys and
-                self.default_profile.keys[from_key] != MAP_DISABLED) or \
-               (from_key in self.profile.keys and
-                self.profile.keys[from_key] != MAP_DISABLED) or \
-               (from_key in self.new_profile.keys and
-                self.new_profile.keys[from_key] != MAP_DISABLED):
-                return True
-        else:
-            if (from_key in self.default_profile.keys and
-                self.default_profile.keys[from_key] == mapping) or \
-               (from_key in self.profile.keys and
-                self.default_profile.keys[from_key] == mapping) or \
-               (from_key in self.new_profile.keys and
-                self.new_profile.keys[from_key] == mapping):
-                return True
-        return False
-
     def set_key(self, from_key, to_key, mod_key=0):
-        mapping = KeyMapping(to_key, mod_key)
-        # if the key mapping is in the old profile, don't apply it.
-        if not self.key_in_profile(from_key, mapping):
-            self.new_profile.set_key(from_key, mapping)
-            # if there's a macro set for this key, delete the macro
-            if from_key in self.profile.macros or \
-               from_key in self.new_profile.macros:
-                self.new_profile.set_macro(from_key, self.delete_macro)
+        self.new_profile.set_key(from_key, KeyMapping(to_key, mod_key))
+        # if there's a macro set for this key, delete the macro
+        if from_key in self.profile.macros or \
+           from_key in self.new_profile.macros:
+            self.new_profile.set_macro(from_key, self.delete_macro)
 
     def get_keys(self):
         return self.new_profile.keys.keys()
@@ -720,26 +1271,15 @@ class EightKeyboard:
 
     def set_macro(self, from_key, name, repeats, events):
         new_macro = KeyboardMacro(name, repeats, self.packet_len)
+        events = optimize_macro_events(events)
+        # long delays are split, so this can be more than were given
+        if len(events) > MAX_MACRO_EVENTS:
+            raise ValueError(f"Macro has {len(events)} events once long delays are split, "
+                             f"at most {MAX_MACRO_EVENTS} are allowed.")
         new_macro.add_events(events)
-        # if the macro is in the old profile, don't apply it.
-        # unless it's just a name change, as this can be sent in 1 packet
-        if from_key not in self.profile.macros or \
-           ((len(new_macro.events) != 0 and
-             self.profile.macros[from_key] != new_macro) or
-            (len(new_macro.events) == 0 and
-             self.profile.macros[from_key].name != new_macro.name)):
-            self.new_profile.set_macro(from_key, new_macro)
-            # the normal app disables keys which have a macro set
-            if self.key_in_profile(from_key):
-                self.new_profile.set_key(from_key, MAP_DISABLED)
-        elif from_key not in self.profile.macros or \
-             (len(new_macro.events) != 0 and
-              self.profile.macros[from_key] == new_macro and
-              self.profile.macros[from_key].name != new_macro.name):
-            # if the events would be the same but the name is just different
-            # remove the events
-            new_macro.clear_events()
-            self.new_profile.set_macro(from_key, new_macro)
+        self.new_profile.set_macro(from_key, new_macro)
+        # the normal app disables keys which have a macro set
+        self.new_profile.set_key(from_key, MAP_DISABLED)
 
     def get_macros(self):
         return self.new_profile.macros.keys()
@@ -759,26 +1299,139 @@ class EightKeyboard:
     def str_new_profile(self):
         return str(self.new_profile)
 
+    def plan_changes(self):
+        # only what changes something on the device, see lib.planner.  The
+        # defaults are only there if the profile was gotten.
+        from .planner import plan_changes
+        return plan_changes(self.profile, self.default_profile, self.new_profile,
+                            len(self.default_profile.keys) > 0)
+
+    def str_plan(self):
+        from .planner import str_plan
+        return str_plan(self.plan_changes())
+
     def get_all_packets(self):
-        # don't force set name as this sets the name to an empty string,
-        # disabling the profile completely
-        if self.new_profile.name != self.profile.name:
-            return self.new_profile.get_all_packets(True)
-        return self.new_profile.get_all_packets(False)
+        return [(buf, wait) for buf, wait, reason in self.plan_changes()]
 
     def set_all_default(self):
         # clear everything
         self.new_profile.set_all_default()
 
-    def submit(self, test=False):
-        packets = self.get_all_packets()
-        for packet in packets:
+    def discard_changes(self):
+        # forget everything not yet submitted
+        self.new_profile = KeyboardProfile(self.profile.name, self.packet_len)
+
+    def set_profile(self, profile):
+        # make the device match profile, with every key it doesn't map back
+        # to default and every macro it doesn't have on the device deleted
+        self.new_profile.set_name(profile.name)
+        self.new_profile.set_all_default()
+        for key in self.profile.macros.keys():
+            if key not in profile.macros:
+                self.new_profile.set_macro(key, KeyboardMacro("", 0, self.packet_len))
+        for key, mapping in profile.keys.items():
+            self.new_profile.set_key(key, mapping)
+        for key, macro in profile.macros.items():
+            self.new_profile.set_macro(key, macro)
+            # as with set_macro()
+            self.new_profile.set_key(key, MAP_DISABLED)
+
+    def apply_new_profile(self):
+        # the device now has everything in new_profile, so fold it in to
+        # profile and start over with nothing new.  What the lists look like
+        # now isn't known, so the changed keys and macros aren't kept in the
+        # snapshot.
+        self.fingerprint = None
+        for key in itertools.chain(self.new_profile.keys.keys(), self.new_profile.macros.keys()):
+            self.key_entries.pop(key, None)
+            self.macro_entries.pop(key, None)
+        self.profile.set_name(self.new_profile.name)
+        for key in self.new_profile.keys.keys():
+            if self.new_profile.keys.is_default(key):
+                # default mappings aren't in the list
+                if key in self.profile.keys:
+                    del self.profile.keys[key]
+            else:
+                self.profile.set_key(key, self.new_profile.keys[key])
+        for key in self.new_profile.macros.keys():
+            macro = self.new_profile.macros[key]
+            if macro.repeats == 0:
+                if key in self.profile.macros:
+                    del self.profile.macros[key]
+            elif len(macro.eventsbuf) == 0 and key in self.profile.macros:
+                # just a name change
+                self.profile.macros[key].set_name(macro.name)
+            else:
+                self.profile.set_macro(key, macro)
+        self.new_profile = KeyboardProfile(self.profile.name, self.packet_len)
+
+    def do_submit(self, test=False):
+        transactions = group_transactions(self.get_all_packets())
+
+        if test:
             if self.verbose:
-                print(self.hid.decode(OUT_ID, packet[0]))
-            if not test:
-                self.hid.write(self.hid.generate_report(OUT_ID, packet[0]))
-            if packet[1]:
+                for bufs, wait in transactions:
+                    for buf in bufs:
+                        output.write(self.hid.decode(OUT_ID, buf))
+                    if wait:
+                        output.write("Wait for response.")
+            return
+
+        # replies carry nothing to identify which packet they're for, but the
+        # device handles packets in order, so they're matched up first in,
+        # first out.
+        in_flight = collections.deque()
+        sent_at = {}
+        pos = 0
+        while pos < len(transactions) or len(in_flight) > 0:
+            if pos < len(transactions) and len(in_flight) < self.window:
+                bufs, wait = transactions[pos]
+                self.send_transaction(bufs)
+                if wait:
+                    in_flight.append(pos)
+                    sent_at[pos] = time.perf_counter()
+                pos += 1
+                continue
+
+            if self.verbose:
+                output.write(f"Wait for response to transaction {in_flight[0]}.")
+            cmd = transactions[in_flight[0]][0][-1][0]
+            success = yield from self.listen_success(cmd)
+            if success:
+                end = time.perf_counter()
+                self.latency.sample(cmd, end - sent_at[in_flight[0]])
+                if trace.tracer is not None:
+                    trace.tracer.round_trip(cmd, sent_at[in_flight[0]], end)
+                in_flight.popleft()
+            elif self.window > 1:
+                # a reply went missing or something unexpected came back so
+                # replies can't be matched to packets any more.  Resend
+                # whatever wasn't acknowledged one at a time.
                 if self.verbose:
-                    print("Wait for response.")
-                if not test:
-                    self.try_listen_success()
+                    output.write("Lost track of responses, falling back to lock-step.")
+                self.window = 1
+                yield from self.flush_input()
+                while len(in_flight) > 0:
+                    bufs = transactions[in_flight[0]][0]
+                    if trace.tracer is not None:
+                        trace.tracer.retry(bufs[-1][0])
+                        start = time.perf_counter()
+                    self.send_transaction(bufs)
+                    yield from self.try_listen_success(bufs[-1][0])
+                    if trace.tracer is not None:
+                        trace.tracer.round_trip(bufs[-1][0], start, time.perf_counter())
+                    in_flight.popleft()
+            elif success is None:
+                raise RuntimeError("Didn't get a response packet.")
+            else:
+                raise RuntimeError("Device returned non-success.")
+
+        self.apply_new_profile()
+
+    def submit(self, test=False):
+        with trace.phase("submit"):
+            self.run(self.do_submit(test))
+
+    async def async_submit(self, test=False):
+        with trace.phase("submit"):
+            await self.async_run(self.do_submit(test))
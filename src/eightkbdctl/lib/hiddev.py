@@ -1,20 +1,31 @@
 import os
+import stat
+import time
 import select
 import fcntl
 import ctypes
 import array
 import itertools
 import pathlib
+import hashlib
+import pickle
+import json
+from dataclasses import dataclass, asdict
 
-import pyudev
 from ioctl_opt import IOR as _IOR
 from ioctl_opt import IOC as _IOC
 from xdg_base_dirs import xdg_cache_home
 
-from .usb import HID, Endpoint
+from .usb import HID, Endpoint, DecodedReport
+from . import trace
+from . import output
 from .util import bits_to_bytes
 
 XDG_APPLICATION_NAME = "8kbdctl"
+SYSFS_ROOT = "/sys"
+DEV_ROOT = "/dev"
+# bump when anything pickled in the parsed descriptor cache changes
+PARSED_CACHE_VERSION = 3
 
 # include/linux/hid.h
 HID_MAX_DESCRIPTOR_SIZE = 4096
@@ -67,27 +78,165 @@ def HIDIOCSOUTPUT(length):
 def HIDIOCGOUTPUT(length):
     return _IOC(ioctl_opt.IRC_READ, ord('H'), 0x0C, length)
 
-def find_hidraw_by_ids(udev, vendor, product, interface):
-    vendor = f"{vendor:04x}"
-    product = f"{product:04x}"
-    for device in udev.list_devices(subsystem='hidraw'):
-        # up from hidraw to hid-generic, usb_interface up to usb_device
-        usbdev = device.parent.parent.parent
-        if 'ID_VENDOR_ID' in usbdev.properties and \
-           'ID_MODEL_ID' in usbdev.properties and \
-           usbdev.properties['ID_VENDOR_ID'] == vendor and \
-           usbdev.properties['ID_MODEL_ID'] == product:
-            # i don't know how reliable this will be in the future, but
-            # i could see no other way
-            usbinterface = device.parent.parent.properties['DEVPATH']
-            index = usbinterface.rindex(".")+1
-            if int(usbinterface[index:]) == interface:
-                return device
+@dataclass
+class HidrawLocation:
+    path : str
+    serial : str
+    port : str
+
+def read_sysfs_attr(path, name):
+    try:
+        return path.joinpath(name).read_text().strip()
+    except OSError:
+        return None
+
+def get_hidraw_usb_info(hidraw_dir):
+    # hidrawN/device is the HID device, up from there is the USB interface
+    # then the USB device.  Anything not on USB won't have these attributes.
+    try:
+        hiddev = hidraw_dir.joinpath("device").resolve(strict=True)
+    except OSError:
+        return None
+    usbinterface = hiddev.parent
+    usbdev = usbinterface.parent
+    interface = read_sysfs_attr(usbinterface, "bInterfaceNumber")
+    vendor = read_sysfs_attr(usbdev, "idVendor")
+    product = read_sysfs_attr(usbdev, "idProduct")
+    if interface is None or vendor is None or product is None:
+        return None
+    try:
+        return (int(vendor, base=16), int(product, base=16), int(interface, base=16),
+                read_sysfs_attr(usbdev, "serial"), usbdev.name)
+    except ValueError:
+        return None
+
+def find_hidraw_sysfs(vendor, product, interface, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT):
+    classdir = pathlib.Path(sysfs_root, "class", "hidraw")
+    try:
+        entries = sorted(classdir.iterdir())
+    except FileNotFoundError:
+        return None
+    for entry in entries:
+        info = get_hidraw_usb_info(entry)
+        if info is not None and info[:3] == (vendor, product, interface):
+            return HidrawLocation(str(pathlib.Path(dev_root, entry.name)), info[3], info[4])
     return None
 
+def check_hidraw_location(location, vendor, product, interface, sysfs_root=SYSFS_ROOT):
+    # every interface shares the vendor and product, so make sure this is
+    # still the same interface on the same device
+    usb_info = get_hidraw_usb_info(pathlib.Path(sysfs_root, "class", "hidraw",
+                                                pathlib.PurePath(location.path).name))
+    return usb_info == (vendor, product, interface, location.serial, location.port)
+
+def open_cached_hidraw(location, vendor, product):
+    # the node has to be what sysfs said it is
+    try:
+        if not stat.S_ISCHR(os.stat(location.path).st_mode):
+            return None
+        fd = os.open(location.path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+
+    info = hidraw_devinfo()
+    try:
+        fcntl.ioctl(fd, HIDIOCGRAWINFO, info, True)
+    except OSError:
+        os.close(fd)
+        return None
+
+    if info.vendor & 0xFFFF != vendor or info.product & 0xFFFF != product:
+        os.close(fd)
+        return None
+
+    return fd
+
+def generate_location_filename(vendor_id, product_id, interface_num):
+    return f"{vendor_id:04x}_{product_id:04x}_{interface_num}.location"
+
+def load_hidraw_location(filename):
+    try:
+        with filename.open("r") as locationfile:
+            return HidrawLocation(**json.load(locationfile))
+    except (OSError, ValueError, TypeError):
+        return None
+
+def save_hidraw_location(filename, location):
+    with filename.open("w") as locationfile:
+        json.dump(asdict(location), locationfile)
+
+def get_location_filename(vendor, product, interface, cache_dir):
+    return cache_dir.joinpath(pathlib.PurePath(generate_location_filename(vendor, product, interface)))
+
+def scan_hidraw(vendor, product, interface, cache_dir, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT):
+    location = find_hidraw_sysfs(vendor, product, interface, sysfs_root, dev_root)
+    if location is None:
+        raise RuntimeError(f"Couldn't find device {vendor:04x}:{product:04x} interface {interface}.")
+    if cache_dir is not None:
+        save_hidraw_location(get_location_filename(vendor, product, interface, cache_dir), location)
+    return location
+
+def locate_hidraw(vendor, product, interface, cache_dir, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT):
+    # (location, whether it's the one saved last time) going only by sysfs,
+    # nothing is opened
+    if cache_dir is not None:
+        location = load_hidraw_location(get_location_filename(vendor, product, interface, cache_dir))
+        if location is not None and \
+           check_hidraw_location(location, vendor, product, interface, sysfs_root):
+            return location, True
+    return scan_hidraw(vendor, product, interface, cache_dir, sysfs_root, dev_root), False
+
+def open_hidraw(vendor, product, interface, cache_dir, sysfs_root=SYSFS_ROOT, dev_root=DEV_ROOT):
+    location, cached = locate_hidraw(vendor, product, interface, cache_dir, sysfs_root, dev_root)
+    if cached:
+        fd = open_cached_hidraw(location, vendor, product)
+        if fd is not None:
+            return fd, location.path
+        # the node isn't what sysfs says, look again
+        location = scan_hidraw(vendor, product, interface, cache_dir, sysfs_root, dev_root)
+
+    fd = os.open(location.path, os.O_RDWR | os.O_NONBLOCK)
+    return fd, location.path
+
 def generate_filename(vendor_id, product_id, interface_num):
     return f"{vendor_id:04x}_{product_id:04x}_{interface_num}.bin"
 
+def generate_parsed_filename(desc):
+    return f"{hashlib.sha256(desc).hexdigest()}.parsed"
+
+def get_report_sizes(reports):
+    sizes = {}
+    for report in reports:
+        sizes[report] = reports[report].get_size()
+    return sizes
+
+def parse_desc(desc):
+    hid = HID()
+    hid.decode_desc(desc)
+    out_reports = hid.get_reports(Endpoint.ADDRESS_DIR_OUT)
+    in_reports = hid.get_reports(Endpoint.ADDRESS_DIR_IN)
+    report_sizes = get_report_sizes(out_reports)
+    report_sizes.update(get_report_sizes(in_reports))
+    return hid, out_reports, in_reports, report_sizes
+
+def load_parsed_desc(filename):
+    try:
+        with filename.open("rb") as parsedfile:
+            version, *parsed = pickle.load(parsedfile)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("WARNING: Failed to load parsed HID descriptor cache, reparsing.")
+        print(e)
+        return None
+    if version != PARSED_CACHE_VERSION:
+        return None
+    return tuple(parsed)
+
+def save_parsed_desc(filename, hid, out_reports, in_reports, report_sizes):
+    with filename.open("wb") as parsedfile:
+        pickle.dump((PARSED_CACHE_VERSION, hid, out_reports, in_reports, report_sizes), parsedfile)
+
 def get_xdg_cache_dir(appname=XDG_APPLICATION_NAME):
     cachedir = xdg_cache_home().joinpath(pathlib.PurePath(appname))
     # make sure it exists
@@ -100,6 +249,12 @@ def get_xdg_cache_dir(appname=XDG_APPLICATION_NAME):
         return None
     return cachedir
 
+def print_report(hid, cb_data, report_id, data):
+    # listen() without a callback.  Reports are dropped rather than falling
+    # behind the device when the output can't keep up.
+    output.write(hid.decode(report_id, data), drop=True)
+    return True
+
 class HIDDEV:
     def raise_report_id_exception(self, report_id, direction=None):
         reports = self.all_reports
@@ -142,22 +297,35 @@ class HIDDEV:
             except FileNotFoundError:
                 pass
 
-        if self.fd is not None:
+        if not fromfile:
+            if self.fd is None:
+                return
             desc = self.get_desc_from_device()
-        else:
-            return
 
-        if not fromfile and cache_dir is not None:
-            with filename.open("wb") as descfile:
-                desc.tofile(descfile)
+            if cache_dir is not None:
+                with filename.open("wb") as descfile:
+                    desc.tofile(descfile)
+
+        # the parsed cache is keyed on the descriptor contents so it can't
+        # go stale, a changed descriptor just gets a new file.
+        parsed = None
+        if cache_dir is not None:
+            parsed_filename = cache_dir.joinpath(pathlib.PurePath(generate_parsed_filename(desc)))
+            if cached:
+                parsed = load_parsed_desc(parsed_filename)
+
+        if parsed is None:
+            parsed = parse_desc(desc)
+            if cache_dir is not None:
+                save_parsed_desc(parsed_filename, *parsed)
 
-        self.hid.decode_desc(desc)
+        self.hid, self.out_reports, self.in_reports, self.report_sizes = parsed
         self.have_desc = True
 
     def generate_report(self, report_id, data):
         # convert to bytes and add 1 for report ID
         try:
-            bufsize = bits_to_bytes(self.all_reports[report_id].get_size()) + 1
+            bufsize = bits_to_bytes(self.report_sizes[report_id]) + 1
         except KeyError:
             self.raise_report_id_exception(report_id)
 
@@ -174,12 +342,30 @@ class HIDDEV:
 
     def read(self):
         size = os.readv(self.fd, (self.largest_buf,))
+        if trace.tracer is not None and size > 0:
+            trace.tracer.instant("read", trace.TID_TRANSPORT,
+                                 {"report_id": self.largest_buf[0], "size": size})
         return self.largest_buf[:size]
 
     def write(self, buf):
+        if trace.tracer is not None:
+            trace.tracer.instant("write", trace.TID_TRANSPORT,
+                                 {"report_id": buf[0], "size": len(buf)})
         return os.write(self.fd, buf)
 
     def listen(self, count=-1, callback=None, cb_data=None, timeout=None):
+        if trace.tracer is None:
+            return self.do_listen(count, callback, cb_data, timeout)
+        start = time.perf_counter()
+        ret = self.do_listen(count, callback, cb_data, timeout)
+        trace.tracer.complete("listen", trace.TID_TRANSPORT, start, time.perf_counter(),
+                              {"timeout": timeout, "timed_out": not ret})
+        return ret
+
+    def do_listen(self, count=-1, callback=None, cb_data=None, timeout=None):
+        if callback is None:
+            with output.report_dropped():
+                return self.do_listen(count, print_report, None, timeout)
         while count != 0:
             try:
                 if not self.select(timeout):
@@ -188,12 +374,8 @@ class HIDDEV:
                 return False
             buf = self.read()
             if len(buf) > 0:
-                report_id = buf[0]
-                if callback is None:
-                    print(self.decode(report_id, buf[1:]))
-                else:
-                    if not callback(self, cb_data, report_id, buf[1:]):
-                        break
+                if not callback(self, cb_data, buf[0], buf[1:]):
+                    break
             if count > 0:
                 count -= 1
 
@@ -214,43 +396,46 @@ class HIDDEV:
         self.raise_report_id_exception(report_id)
 
     def decode(self, report_id, data):
-        return self.hid.decode_interrupt(report_id, self.get_report_direction(report_id), data)
+        # decoded when it's turned in to text
+        return DecodedReport(self.hid, report_id, self.get_report_direction(report_id), data)
 
-    def __init__(self, vendor_id, product_id, interface_num, force_no_cache=False, try_no_open=False):
+    def __init__(self, vendor_id, product_id, interface_num, force_no_cache=False, try_no_open=False,
+                 fd=None, desc=None):
+        # fd and desc can be given to use something which acts like hidraw
+        # but isn't, like a simulated device.
         self.fd = None
+        self.path = None
         self.vendor_id = vendor_id
         self.product_id = product_id
         self.interface_num = interface_num
         self.hid = HID()
+        self.out_reports = {}
+        self.in_reports = {}
+        self.report_sizes = {}
 
         self.have_desc = False
 
-        if try_no_open:
+        if fd is not None:
+            self.fd = fd
+            self.hid, self.out_reports, self.in_reports, self.report_sizes = parse_desc(desc)
+            self.have_desc = True
+        elif try_no_open:
             # can't force disuse of cache
             self.get_hid_desc(True)
 
         # if cache loading failed, try to open
-        if not try_no_open or (try_no_open and not self.have_desc):
-            udev = pyudev.Context()
-            device = find_hidraw_by_ids(udev, vendor_id, product_id, interface_num)
-            self.fd = os.open(device.device_node, os.O_RDWR | os.O_NONBLOCK)
+        if fd is None and (not try_no_open or (try_no_open and not self.have_desc)):
+            self.fd, self.path = open_hidraw(vendor_id, product_id, interface_num, get_xdg_cache_dir())
             if force_no_cache:
                 self.get_hid_desc(False)
             else:
                 self.get_hid_desc(True)
 
-        self.out_reports = self.hid.get_reports(Endpoint.ADDRESS_DIR_OUT)
-        self.in_reports = self.hid.get_reports(Endpoint.ADDRESS_DIR_IN)
         self.all_reports = self.out_reports.copy()
         self.all_reports.update(self.in_reports)
 
-        largest = 0
-        for report in self.all_reports:
-            size = self.all_reports[report].get_size()
-            if size > largest:
-                largest = size
         # +1 for report id
-        self.largest_buf = array.array('B', itertools.repeat(0, bits_to_bytes(largest)+1))
+        self.largest_buf = array.array('B', itertools.repeat(0, bits_to_bytes(max(self.report_sizes.values(), default=0))+1))
 
     def __enter__(self):
         return self
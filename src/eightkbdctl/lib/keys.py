@@ -44,12 +44,14 @@ def get_is_modifier(code, disablable=False):
     return (disablable and code == NO_MODIFIER) or \
            (code >= 0xE0 and code <= 0xE7)
 
-def get_hut_code_from_name(name, disablable=False):
+def get_hut_code_from_name(name, disablable=False, numeric=True):
+    # with numeric False, names like "1" are always the key's name
     code = None
-    try:
-        code = arg_to_num(name)
-    except ValueError:
-        pass
+    if numeric:
+        try:
+            code = arg_to_num(name)
+        except ValueError:
+            pass
     if code is not None:
         if code < 0 or code > len(HUT_KEYS):
             raise ValueError(f"Numeric value {code} doesn't map to a named key.")
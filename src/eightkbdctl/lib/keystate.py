@@ -0,0 +1,145 @@
+import time
+
+from .keys import get_is_modifier
+from .eightkbd import KEY_VALUES, KEY_TABLE_SIZE, MacroEventAction, get_key_code_from_bitfield_code, \
+                      get_name_from_key_code, get_is_assignable, optimize_macro_events
+
+# Keymap mode reports give the keys being held as a bitfield following a
+# header, bit n of the bitfield as a little-endian int being bitfield code n
+# as for get_name_from_bitfield_code().  KeyState keeps the last bitfield as
+# an int and only looks at the bits which changed, so a report costs the
+# same however many keys are held.
+
+KEYMAP_BITFIELD_POS = 3
+KEYMAP_BITFIELD_BITS = KEYMAP_BITFIELD_POS * 8
+# recorded delays are rounded to this many milliseconds
+RECORD_DELAY_QUANTUM = 10
+
+def get_bitfield_name(code):
+    key = get_key_code_from_bitfield_code(code)
+    if key not in KEY_VALUES:
+        return None
+    return get_name_from_key_code(key)
+
+# name of each bitfield code, None for codes which aren't a key
+BITFIELD_NAMES = tuple(get_bitfield_name(code) for code in range(KEY_TABLE_SIZE))
+
+def get_name_from_bitfield(code):
+    if code < len(BITFIELD_NAMES):
+        return BITFIELD_NAMES[code]
+    return None
+
+def iter_bits(bits):
+    # the number of each set bit, lowest first
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def iter_changes(when, released, pressed):
+    for code in iter_bits(released):
+        yield (when, False, code, get_name_from_bitfield(code))
+    for code in iter_bits(pressed):
+        yield (when, True, code, get_name_from_bitfield(code))
+
+class KeyState:
+    def __init__(self):
+        self.held = 0
+
+    def update_held(self, held, when=None):
+        # the state is updated straight away, the events for it are an
+        # iterator of (when, pressed, code, name) for each key which changed,
+        # keys let go before keys pressed
+        if when is None:
+            when = time.monotonic()
+        changed = held ^ self.held
+        if changed == 0:
+            return ()
+        self.held = held
+        return iter_changes(when, changed & ~held, changed & held)
+
+    def update(self, bitfield, when=None):
+        return self.update_held(int.from_bytes(bitfield, 'little'), when)
+
+    def update_report(self, data, when=None):
+        # the whole report, the header is shifted off rather than sliced off
+        return self.update_held(int.from_bytes(data, 'little') >> KEYMAP_BITFIELD_BITS, when)
+
+    def iter_events(self, reports):
+        # events for each (when, data) in reports, data being a whole report
+        for when, data in reports:
+            yield from self.update_report(data, when)
+
+    def get_held(self):
+        return list(iter_bits(self.held))
+
+class MacroRecorder:
+    # Turns keymap mode reports in to macro events until stop_key is pressed.
+    # Each change is only kept with its time as it comes so nothing holds up
+    # reading reports, the events are made by get_events() after.  Letting go
+    # of a key which was held before recording started isn't recorded.
+    def __init__(self, stop_key=None, quantum=RECORD_DELAY_QUANTUM):
+        self.keystate = KeyState()
+        self.stop_key = stop_key
+        self.quantum = quantum
+        self.pressed = set()
+        self.stopped = False
+        # (when, pressed, key code)
+        self.changes = []
+
+    def feed(self, data, when=None):
+        # data is a whole report, False once the stop key is pressed
+        for when, pressed, code, name in self.keystate.update_report(data, when):
+            key = get_key_code_from_bitfield_code(code)
+            if key == self.stop_key:
+                if pressed:
+                    self.stopped = True
+                    return False
+                continue
+            if pressed:
+                self.pressed.add(code)
+            elif code in self.pressed:
+                self.pressed.discard(code)
+            else:
+                continue
+            self.changes.append((when, pressed, key))
+        return True
+
+    def get_events(self):
+        # delays are the time between changes rounded to quantum ms, going by
+        # the time since the first so rounding doesn't add up.  Anything still
+        # held at the end is let go of.  Keys which can't be in a macro are
+        # left out.
+        events = []
+        held = []
+        start = None
+        last = 0
+        for when, pressed, key in self.changes:
+            code = KEY_VALUES.get(key, 0)
+            if code == 0 or not get_is_assignable(code):
+                continue
+            if start is None:
+                start = when
+            at = round((when - start) * 1000 / self.quantum) * self.quantum
+            if at > last:
+                events.append((MacroEventAction.DELAY, at - last))
+                last = at
+            if pressed:
+                if get_is_modifier(code):
+                    events.append((MacroEventAction.MOD_PRESSED, code))
+                else:
+                    events.append((MacroEventAction.PRESSED, code))
+                held.append(code)
+            else:
+                if get_is_modifier(code):
+                    events.append((MacroEventAction.MOD_RELEASED, code))
+                else:
+                    events.append((MacroEventAction.RELEASED, code))
+                if code in held:
+                    held.remove(code)
+        for code in reversed(held):
+            if get_is_modifier(code):
+                events.append((MacroEventAction.MOD_RELEASED, code))
+            else:
+                events.append((MacroEventAction.RELEASED, code))
+        return optimize_macro_events(events)
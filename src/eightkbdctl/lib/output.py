@@ -0,0 +1,94 @@
+import sys
+import queue
+import atexit
+import threading
+import contextlib
+
+# Output from talking to the device goes through a thread which turns it in
+# to text and writes it, so slow terminal output doesn't hold up reading from
+# the device.  Each line is given as parts which are only passed to str() on
+# that thread, so a DecodedReport is only decoded there.  Lines which can be
+# dropped, like reports printed while listening, are counted instead of
+# waiting when the queue is full.
+
+OUTPUT_QUEUE_LEN = 1024
+
+class OutputWriter:
+    def __init__(self, stream=None, maxlen=OUTPUT_QUEUE_LEN):
+        # with no stream, whatever sys.stdout is when each line is written
+        self.stream = stream
+        self.queue = queue.Queue(maxlen)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="output", daemon=True)
+        self.thread.start()
+
+    def get_stream(self):
+        if self.stream is None:
+            return sys.stdout
+        return self.stream
+
+    def run(self):
+        while True:
+            parts = self.queue.get()
+            try:
+                if parts is None:
+                    return
+                stream = self.get_stream()
+                try:
+                    stream.write("".join(map(str, parts)) + "\n")
+                except Exception as e:
+                    stream.write(f"Failed to write output: {e}\n")
+                # only flush once there's nothing more to write
+                if self.queue.empty():
+                    stream.flush()
+            finally:
+                self.queue.task_done()
+
+    def write(self, *parts, drop=False):
+        if not drop:
+            self.queue.put(parts)
+            return
+        try:
+            self.queue.put_nowait(parts)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        # wait for everything so far to be written
+        self.queue.join()
+        self.get_stream().flush()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+# started the first time anything is written
+writer = None
+
+def get_writer():
+    global writer
+    if writer is None:
+        writer = OutputWriter()
+        atexit.register(writer.flush)
+    return writer
+
+def write(*parts, drop=False):
+    get_writer().write(*parts, drop=drop)
+
+def flush():
+    if writer is not None:
+        writer.flush()
+
+@contextlib.contextmanager
+def report_dropped():
+    # say how many lines were dropped while in the block, once the rest are
+    # written
+    dropped = get_writer().dropped
+    try:
+        yield
+    finally:
+        writer.flush()
+        if writer.dropped > dropped:
+            writer.write(f"{writer.dropped - dropped} lines of output dropped.")
+            writer.flush()
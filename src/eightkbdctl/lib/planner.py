@@ -0,0 +1,77 @@
+from .eightkbd import get_name_from_key_code
+
+# Works out what to send to get the device from profile to new_profile, only
+# sending what would change something.  A key's current mapping is what's in
+# profile, or the default if it's not there.  With known False, as when the
+# profile wasn't gotten from the device, what's on it isn't known so every
+# change is sent.
+#
+# The plan is a list of (buf, wait, reason) in the order to send them, with
+# wait being whether the device acknowledges the packet.
+
+def plan_name(profile, new_profile):
+    # even when what's on the device isn't known, an empty name disables the
+    # profile button so it's only sent when asked for
+    if new_profile.name == profile.name:
+        return []
+    buf, wait = new_profile.get_name_packet()
+    return [(buf, wait, f"name '{profile.name}' -> '{new_profile.name}'")]
+
+def plan_key(key, profile, default_profile, new_profile, known):
+    mapping = new_profile.keys[key]
+    keyname = get_name_from_key_code(key)
+    if not known:
+        reason = f"key {keyname} -> {mapping}"
+    else:
+        if key in profile.keys:
+            current = profile.keys[key]
+        else:
+            current = default_profile.keys[key]
+        if current == mapping:
+            return []
+        reason = f"key {keyname} {current} -> {mapping}"
+    return [(mapping.get_set_array(key, new_profile.packet_len), True, reason)]
+
+def plan_macro(key, profile, new_profile, known):
+    macro = new_profile.macros[key]
+    keyname = get_name_from_key_code(key)
+    current = None
+    if key in profile.macros:
+        current = profile.macros[key]
+
+    if macro.repeats == 0:
+        if known and current is None:
+            return []
+        buf, _ = macro.get_macro_packets(key)
+        return [(buf, True, f"macro {keyname} delete")]
+
+    namebuf, bufs = macro.get_macro_packets(key)
+    if current is not None and (len(macro.eventsbuf) == 0 or current == macro):
+        # the events are the same or weren't given, at most it's a rename
+        if current.name == macro.name:
+            return []
+        return [(namebuf, True, f"macro {keyname} rename '{current.name}' -> '{macro.name}'")]
+
+    plan = [(namebuf, True, f"macro {keyname} name '{macro.name}'")]
+    for num, buf in enumerate(bufs):
+        plan.append((buf, num == len(bufs) - 1,
+                     f"macro {keyname} events {num + 1}/{len(bufs)}"))
+    return plan
+
+def plan_changes(profile, default_profile, new_profile, known):
+    plan = plan_name(profile, new_profile)
+    if known:
+        keys = new_profile.keys.get_changed(profile.keys, default_profile.keys)
+    else:
+        keys = new_profile.keys.keys()
+    for key in keys:
+        plan.extend(plan_key(key, profile, default_profile, new_profile, known))
+    for key in new_profile.macros.keys():
+        plan.extend(plan_macro(key, profile, new_profile, known))
+    return plan
+
+def str_plan(plan):
+    ret = f"{len(plan)} packets:\n"
+    for buf, wait, reason in plan:
+        ret += f"{reason}\n"
+    return ret
@@ -0,0 +1,49 @@
+import pickle
+
+from .hiddev import get_xdg_cache_dir
+
+PROFILE_CACHE_VERSION = 1
+
+def generate_profile_filename(vendor_id, product_id, interface_num):
+    return f"{vendor_id:04x}_{product_id:04x}_{interface_num}.profile"
+
+class ProfileSnapshot:
+    # What was last seen on the device.  fingerprint is the name, key list
+    # and macro list replies it was seen with.  keys maps each key to its
+    # entry in the key list reply and its (to_key, mod_key), macros map each
+    # key to its entry in the macro list reply, its name and its data as
+    # sent to the device.  An entry whose list entry still matches doesn't
+    # need to be gotten again.
+    def __init__(self):
+        self.fingerprint = None
+        self.keys = {}
+        self.macros = {}
+
+def load_snapshot(filename):
+    try:
+        with filename.open("rb") as snapshotfile:
+            version, fingerprint, keys, macros = pickle.load(snapshotfile)
+    except FileNotFoundError:
+        return ProfileSnapshot()
+    except Exception as e:
+        print("WARNING: Failed to load profile cache, getting the profile from the device.")
+        print(e)
+        return ProfileSnapshot()
+    snapshot = ProfileSnapshot()
+    if version == PROFILE_CACHE_VERSION:
+        snapshot.fingerprint = fingerprint
+        snapshot.keys = keys
+        snapshot.macros = macros
+    return snapshot
+
+def save_snapshot(filename, snapshot):
+    with filename.open("wb") as snapshotfile:
+        pickle.dump((PROFILE_CACHE_VERSION, snapshot.fingerprint, snapshot.keys, snapshot.macros),
+                    snapshotfile)
+
+def get_snapshot_filename(vendor_id, product_id, interface_num):
+    # None if there's no cache dir to use
+    cachedir = get_xdg_cache_dir()
+    if cachedir is None:
+        return None
+    return cachedir.joinpath(generate_profile_filename(vendor_id, product_id, interface_num))
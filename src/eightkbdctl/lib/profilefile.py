@@ -0,0 +1,153 @@
+import json
+import array
+import struct
+
+from .keys import get_hut_code_from_name, get_name_from_hut_code, get_is_modifier
+from .eightkbd import KeyboardProfile, KeyboardMacro, KeyMapping, KeyTable, MacroEventAction, \
+                      KEY_TABLE_SIZE, DEFAULT_KEYS, MACRO_EVENT, get_is_assignable, \
+                      get_name_from_key_code, get_key_code_from_name
+
+# Profiles saved to a file, as JSON to be read and edited or as a compact
+# binary format which is quick to load.  The binary format is a header, the
+# profile name, the bitmap of mapped keys and their to_key and mod_key
+# tables as kept in a KeyTable, then each macro's header, name and events
+# as they're sent to the device.  Names are UTF-8.
+
+PROFILE_FILE_VERSION = 1
+PROFILE_FILE_MAGIC = b"8KBP"
+# magic, version, name length, macro count
+PROFILE_FILE_HDR = struct.Struct("<4sBBB")
+# key, repeats, name length, event count
+MACRO_FILE_HDR = struct.Struct("<BHBB")
+KEY_BITMAP_SIZE = KEY_TABLE_SIZE // 8
+
+# 1 for each code which may be in the to_key and mod_key tables
+TO_KEY_CODES = bytes(int(get_is_assignable(code, True) and not get_is_modifier(code))
+                     for code in range(KEY_TABLE_SIZE))
+MOD_KEY_CODES = bytes(int(get_is_modifier(code, True)) for code in range(KEY_TABLE_SIZE))
+
+def profile_to_bytes(profile):
+    keys = KeyTable()
+    for key, mapping in profile.keys.items():
+        keys[key] = mapping
+    name = profile.name.encode('utf-8')
+    buf = bytearray(PROFILE_FILE_HDR.pack(PROFILE_FILE_MAGIC, PROFILE_FILE_VERSION,
+                                          len(name), len(profile.macros)))
+    buf += name
+    buf += keys.present.to_bytes(KEY_BITMAP_SIZE, 'little')
+    buf += keys.to_keys
+    buf += keys.mod_keys
+    for key, macro in profile.macros.items():
+        name = macro.name.encode('utf-8')
+        buf += MACRO_FILE_HDR.pack(key, macro.repeats, len(name),
+                                   len(macro.eventsbuf) // MACRO_EVENT.size)
+        buf += name
+        buf += macro.eventsbuf
+    return bytes(buf)
+
+def profile_from_bytes(data, packet_len):
+    data = memoryview(data)
+    if len(data) < PROFILE_FILE_HDR.size:
+        raise ValueError("Profile file is too short.")
+    magic, version, name_len, macro_count = PROFILE_FILE_HDR.unpack_from(data)
+    if magic != PROFILE_FILE_MAGIC:
+        raise ValueError("Not a profile file.")
+    if version != PROFILE_FILE_VERSION:
+        raise ValueError(f"Unsupported profile file version {version}.")
+    pos = PROFILE_FILE_HDR.size
+
+    profile = KeyboardProfile(str(data[pos:pos+name_len], 'utf-8'), packet_len)
+    pos += name_len
+
+    tables = data[pos:pos+KEY_BITMAP_SIZE+KEY_TABLE_SIZE*2]
+    if len(tables) < KEY_BITMAP_SIZE + KEY_TABLE_SIZE * 2:
+        raise ValueError("Profile file is too short.")
+    keys = profile.keys
+    keys.present = int.from_bytes(tables[:KEY_BITMAP_SIZE], 'little')
+    to_keys = bytes(tables[KEY_BITMAP_SIZE:KEY_BITMAP_SIZE+KEY_TABLE_SIZE])
+    mod_keys = bytes(tables[KEY_BITMAP_SIZE+KEY_TABLE_SIZE:])
+    pos += len(tables)
+    # checked a table at a time, the way KeyMapping would check each
+    if keys.present & ~DEFAULT_KEYS.present != 0:
+        raise ValueError("Profile file maps keys the device doesn't have.")
+    if 0 in to_keys.translate(TO_KEY_CODES) or 0 in mod_keys.translate(MOD_KEY_CODES):
+        raise ValueError("Profile file maps keys to invalid codes.")
+    keys.to_keys = array.array('B', to_keys)
+    keys.mod_keys = array.array('B', mod_keys)
+
+    for num in range(macro_count):
+        if len(data) < pos + MACRO_FILE_HDR.size:
+            raise ValueError("Profile file is too short.")
+        key, repeats, name_len, count = MACRO_FILE_HDR.unpack_from(data, pos)
+        pos += MACRO_FILE_HDR.size
+        end = pos + name_len + count * MACRO_EVENT.size
+        if len(data) < end:
+            raise ValueError("Profile file is too short.")
+        if key not in DEFAULT_KEYS:
+            raise ValueError(f"Profile file has a macro on unknown key {key}.")
+        macro = KeyboardMacro(str(data[pos:pos+name_len], 'utf-8'), repeats, packet_len)
+        macro.add_events_buf(data[pos+name_len:end])
+        profile.set_macro(key, macro)
+        pos = end
+    return profile
+
+def profile_to_json(profile):
+    keys = {}
+    for key, mapping in profile.keys.items():
+        keys[get_name_from_key_code(key)] = {"to_key": get_name_from_hut_code(mapping.to_key, True),
+                                             "mod_key": get_name_from_hut_code(mapping.mod_key, True)}
+    macros = {}
+    for key, macro in profile.macros.items():
+        events = []
+        for action, arg in macro.events:
+            action = MacroEventAction(action)
+            if action != MacroEventAction.DELAY:
+                arg = get_name_from_hut_code(arg)
+            events.append([action.name.lower(), arg])
+        macros[get_name_from_key_code(key)] = {"name": macro.name, "repeats": macro.repeats,
+                                               "events": events}
+    return {"version": PROFILE_FILE_VERSION, "name": profile.name, "keys": keys, "macros": macros}
+
+def profile_from_json(obj, packet_len):
+    try:
+        if obj["version"] != PROFILE_FILE_VERSION:
+            raise ValueError(f"Unsupported profile file version {obj['version']}.")
+        profile = KeyboardProfile(obj["name"], packet_len)
+        for keyname, mapping in obj["keys"].items():
+            profile.set_key(get_key_code_from_name(keyname, False),
+                            KeyMapping(get_hut_code_from_name(mapping["to_key"], True, False),
+                                       get_hut_code_from_name(mapping["mod_key"], True, False)))
+        for keyname, value in obj["macros"].items():
+            macro = KeyboardMacro(value["name"], value["repeats"], packet_len)
+            for action, arg in value["events"]:
+                action = MacroEventAction[action.upper()]
+                if action != MacroEventAction.DELAY:
+                    arg = get_hut_code_from_name(arg, False, False)
+                macro.add_event(action, arg)
+            profile.set_macro(get_key_code_from_name(keyname, False), macro)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Profile file is missing or has a bad {e}.")
+    return profile
+
+def get_is_json(filename):
+    return str(filename).lower().endswith(".json")
+
+def save_profile(filename, profile):
+    # JSON if the filename ends in .json, otherwise binary
+    if get_is_json(filename):
+        with open(filename, 'w') as profilefile:
+            json.dump(profile_to_json(profile), profilefile, indent=1)
+    else:
+        with open(filename, 'wb') as profilefile:
+            profilefile.write(profile_to_bytes(profile))
+
+def load_profile(filename, packet_len):
+    if get_is_json(filename):
+        with open(filename, 'r') as profilefile:
+            try:
+                obj = json.load(profilefile)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Profile file isn't valid JSON: {e}")
+        return profile_from_json(obj, packet_len)
+    with open(filename, 'rb') as profilefile:
+        return profile_from_bytes(profilefile.read(), packet_len)
@@ -0,0 +1,313 @@
+import os
+import time
+import array
+import heapq
+import random
+import socket
+import select
+import itertools
+import threading
+
+from .eightkbd import VENDOR_ID, PRODUCT_ID, INTERFACE_NUM, OUT_ID, IN_ID, RESPONSE_CODE, RESPONSE_SUCCESS, \
+                      CMD_ENABLE_KEYMAP, CMD_DISABLE_KEYMAP, CMD_SET_KEY, SET_TYPE_KBD, CMD_SET_NAME, \
+                      CMD_SET_MACRO_NAME, CMD_SET_MACRO, CMD_MACRO_MORE, CMD_DELETE_MACRO, CMD_GET_NAME, \
+                      CMD_GET_KEYS, CMD_GET_MACROS, CMD_GET_KEY, CMD_GET_MACRO_NAME, CMD_GET_MACRO, KEY_VALUES, \
+                      NAME_HDR, KEY_HDR, KEY_SET_HDR, MAP_KEY, MACRO_NAME_HDR, MACRO_PKT_HDR, MACRO_HDR, \
+                      KeyboardMacro, try_encode_name
+
+PACKET_LEN = 32
+RESPONSE_INVALID = 0x09
+# guessed, read-keys.py only looks at what's after these
+KEYMAP_REPORT_HDR = (0x8A, 0x07, 0x00)
+
+# a boot keyboard input report plus the vendor reports, close enough to what
+# the keyboard reports on interface 2
+SIM_DESCRIPTOR = bytes((
+    0x05, 0x01, 0x09, 0x06, 0xA1, 0x01, 0x85, 0x01,
+    0x05, 0x07, 0x19, 0xE0, 0x29, 0xE7, 0x15, 0x00, 0x25, 0x01, 0x75, 0x01, 0x95, 0x08, 0x81, 0x02,
+    0x95, 0x01, 0x75, 0x08, 0x81, 0x01,
+    0x95, 0x06, 0x75, 0x08, 0x15, 0x00, 0x26, 0xFF, 0x00, 0x19, 0x00, 0x2A, 0xFF, 0x00, 0x81, 0x00,
+    0x05, 0x08, 0x19, 0x01, 0x29, 0x05, 0x95, 0x05, 0x75, 0x01, 0x91, 0x02,
+    0x95, 0x01, 0x75, 0x03, 0x91, 0x01,
+    0xC0,
+    0x06, 0x00, 0xFF, 0x09, 0x01, 0xA1, 0x01,
+    0x85, IN_ID, 0x09, 0x02, 0x15, 0x00, 0x26, 0xFF, 0x00, 0x75, 0x08, 0x95, PACKET_LEN, 0x81, 0x02,
+    0x85, OUT_ID, 0x09, 0x03, 0x91, 0x02,
+    0x85, 0xB1, 0x09, 0x04, 0x81, 0x02,
+    0x85, 0xB2, 0x09, 0x05, 0x91, 0x02,
+    0xC0
+))
+
+# entries in each reply to CMD_GET_KEYS and CMD_GET_MACROS, the last byte
+# says whether there's more
+KEYS_PER_LIST = (PACKET_LEN - 3) // 2
+MACROS_PER_LIST = (PACKET_LEN - 3) // 4
+
+class SimulatedMacro:
+    def __init__(self, name):
+        self.name = name
+        self.data = array.array('B', MACRO_HDR.pack(0, 0, 0))
+        self.incoming = array.array('B')
+
+class SimulatedKeyboard:
+    # Stands in for the keyboard's vendor interface, speaking the OUT_ID/
+    # IN_ID protocol over a SOCK_SEQPACKET socketpair so each report arrives
+    # whole, like from hidraw.  Replies are sent after latency +/- jitter
+    # seconds, but never before an earlier reply, and dropped with a
+    # probability of drop_rate.
+    def __init__(self, latency=0.0, jitter=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        self.name = array.array('B')
+        self.keys = {}
+        self.macros = {}
+        self.keymap = False
+
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        # packets which got any reply
+        self.round_trips = 0
+
+        self.pending = []
+        self.sequence = 0
+        self.last_due = 0.0
+        self.lock = threading.Lock()
+        self.sock, self.client_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.wake_r, self.wake_w = os.pipe()
+        self.running = False
+        self.thread = None
+
+    def set_name(self, name):
+        self.name = try_encode_name(name, PACKET_LEN - NAME_HDR.size)
+
+    def set_key(self, key, to_key, mod_key=0):
+        if (mod_key, to_key) == (0, KEY_VALUES[key]):
+            self.keys.pop(key, None)
+        else:
+            self.keys[key] = (mod_key, to_key)
+
+    def set_macro(self, key, name, repeats, events):
+        macro = KeyboardMacro(name, repeats, PACKET_LEN)
+        macro.add_events(events)
+        self.macros[key] = SimulatedMacro(macro.encoded_name)
+        self.macros[key].data = macro.generate_macro_data()
+
+    def reply(self, data):
+        buf = array.array('B', (IN_ID,))
+        buf.extend(data)
+        buf.extend(itertools.repeat(0, PACKET_LEN + 1 - len(buf)))
+        return buf
+
+    def ack(self, success=True):
+        if success:
+            return [self.reply((RESPONSE_CODE, RESPONSE_SUCCESS))]
+        return [self.reply((RESPONSE_CODE, RESPONSE_INVALID))]
+
+    def list_replies(self, cmd, entries, per_packet):
+        replies = []
+        for pos in range(0, max(len(entries), 1), per_packet):
+            buf = array.array('B', (cmd,))
+            for entry in entries[pos:pos+per_packet]:
+                buf.extend(entry)
+            buf.extend(itertools.repeat(0, PACKET_LEN - 1 - len(buf)))
+            # more to come
+            buf.append(int(pos + per_packet < len(entries)))
+            replies.append(self.reply(buf))
+        return replies
+
+    def macro_replies(self, key):
+        data = self.macros[key].data
+        replies = []
+        size = PACKET_LEN - MACRO_PKT_HDR.size
+        for pos in range(0, len(data), size):
+            chunk = data[pos:pos+size]
+            more = int(pos + size < len(data))
+            buf = array.array('B', MACRO_PKT_HDR.pack(CMD_GET_MACRO, key, more, pos, len(chunk)))
+            buf.extend(chunk)
+            replies.append(self.reply(buf))
+        return replies
+
+    def handle_set_macro(self, data):
+        _, key, more, pos, size = MACRO_PKT_HDR.unpack(data[:MACRO_PKT_HDR.size])
+        if key not in self.macros:
+            self.macros[key] = SimulatedMacro(array.array('B'))
+        macro = self.macros[key]
+        if pos == 0:
+            macro.incoming = array.array('B')
+        if pos != len(macro.incoming):
+            return self.ack(False)
+        macro.incoming.extend(data[MACRO_PKT_HDR.size:MACRO_PKT_HDR.size+size])
+        if more == CMD_MACRO_MORE:
+            # only acknowledged at the end
+            return []
+        macro.data = macro.incoming
+        macro.incoming = array.array('B')
+        return self.ack()
+
+    def handle(self, data):
+        # returns the replies to an OUT_ID report
+        cmd = data[0]
+        if tuple(data[:2]) == CMD_ENABLE_KEYMAP:
+            self.keymap = True
+            return []
+        elif tuple(data[:2]) == CMD_DISABLE_KEYMAP:
+            self.keymap = False
+            return []
+        elif tuple(data[:len(CMD_SET_KEY)]) == CMD_SET_KEY:
+            key, set_type = KEY_SET_HDR.unpack(data[len(CMD_SET_KEY):len(CMD_SET_KEY)+KEY_SET_HDR.size])
+            if key not in KEY_VALUES or set_type != SET_TYPE_KBD:
+                return self.ack(False)
+            mod_key, to_key = MAP_KEY.unpack(data[len(CMD_SET_KEY)+KEY_SET_HDR.size:
+                                                  len(CMD_SET_KEY)+KEY_SET_HDR.size+MAP_KEY.size])
+            self.set_key(key, to_key, mod_key)
+            return self.ack()
+        elif cmd == CMD_SET_NAME:
+            _, size = NAME_HDR.unpack(data[:NAME_HDR.size])
+            self.name = data[NAME_HDR.size:NAME_HDR.size+size]
+            return self.ack()
+        elif cmd == CMD_SET_MACRO_NAME:
+            _, key, size = MACRO_NAME_HDR.unpack(data[:MACRO_NAME_HDR.size])
+            name = data[MACRO_NAME_HDR.size:MACRO_NAME_HDR.size+size]
+            if key in self.macros:
+                self.macros[key].name = name
+            else:
+                self.macros[key] = SimulatedMacro(name)
+            return self.ack()
+        elif cmd == CMD_SET_MACRO:
+            return self.handle_set_macro(data)
+        elif cmd == CMD_DELETE_MACRO:
+            self.macros.pop(data[1], None)
+            return self.ack()
+        elif cmd == CMD_GET_NAME:
+            buf = array.array('B', NAME_HDR.pack(CMD_GET_NAME, len(self.name)))
+            buf.extend(self.name)
+            return [self.reply(buf)]
+        elif cmd == CMD_GET_KEYS:
+            entries = [(key, SET_TYPE_KBD) for key in sorted(self.keys.keys())]
+            return self.list_replies(CMD_GET_KEYS, entries, KEYS_PER_LIST)
+        elif cmd == CMD_GET_MACROS:
+            entries = []
+            for key in sorted(self.macros.keys()):
+                entries.append((key, len(self.macros[key].data) & 0xFF, len(self.macros[key].data) >> 8, 0))
+            return self.list_replies(CMD_GET_MACROS, entries, MACROS_PER_LIST)
+        elif cmd == CMD_GET_KEY:
+            if data[1] not in self.keys:
+                return self.ack(False)
+            buf = array.array('B', KEY_HDR.pack(CMD_GET_KEY, data[1], SET_TYPE_KBD))
+            buf.extend(MAP_KEY.pack(*self.keys[data[1]]))
+            return [self.reply(buf)]
+        elif cmd == CMD_GET_MACRO_NAME:
+            if data[1] not in self.macros:
+                return self.ack(False)
+            name = self.macros[data[1]].name
+            buf = array.array('B', MACRO_NAME_HDR.pack(CMD_GET_MACRO_NAME, data[1], len(name)))
+            buf.extend(name)
+            return [self.reply(buf)]
+        elif cmd == CMD_GET_MACRO:
+            if data[1] not in self.macros:
+                return self.ack(False)
+            return self.macro_replies(data[1])
+        return self.ack(False)
+
+    def queue_replies(self, replies):
+        now = time.monotonic()
+        with self.lock:
+            for reply in replies:
+                if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+                    self.dropped += 1
+                    continue
+                delay = self.latency
+                if self.jitter > 0:
+                    delay = max(0.0, delay + self.random.uniform(-self.jitter, self.jitter))
+                # the interrupt endpoint delivers in order
+                self.last_due = max(self.last_due, now + delay)
+                self.sequence += 1
+                heapq.heappush(self.pending, (self.last_due, self.sequence, reply))
+        os.write(self.wake_w, b'\0')
+
+    def press(self, codes):
+        # send the bitfield of pressed keys while keymap mode is enabled,
+        # codes being bit numbers as for get_name_from_bitfield_code()
+        if not self.keymap:
+            return
+        bitfield = 0
+        for code in codes:
+            bitfield |= 1 << code
+        buf = array.array('B', KEYMAP_REPORT_HDR)
+        buf.extend(bitfield.to_bytes(PACKET_LEN - len(KEYMAP_REPORT_HDR), 'little'))
+        self.queue_replies([self.reply(buf)])
+
+    def send_due(self):
+        # returns how long until the next reply is due
+        now = time.monotonic()
+        with self.lock:
+            while len(self.pending) > 0 and self.pending[0][0] <= now:
+                _, _, reply = heapq.heappop(self.pending)
+                # counted first so it's never behind what's been received
+                self.sent += 1
+                try:
+                    self.sock.send(reply)
+                except OSError:
+                    pass
+            if len(self.pending) > 0:
+                return self.pending[0][0] - now
+        return None
+
+    def serve(self):
+        while self.running:
+            timeout = self.send_due()
+            readable = select.select((self.sock, self.wake_r), (), (), timeout)[0]
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+            if self.sock in readable:
+                try:
+                    buf = self.sock.recv(PACKET_LEN + 1)
+                except OSError:
+                    break
+                if len(buf) == 0:
+                    break
+                self.received += 1
+                if buf[0] == OUT_ID:
+                    replies = self.handle(array.array('B', buf[1:]))
+                    if len(replies) > 0:
+                        self.round_trips += 1
+                    self.queue_replies(replies)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_w, b'\0')
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sock.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def open_hid(self):
+        # HIDDEV talking to this simulator, which takes ownership of the fd
+        from .hiddev import HIDDEV
+        return HIDDEV(VENDOR_ID, PRODUCT_ID, INTERFACE_NUM, fd=self.client_sock.detach(),
+                      desc=array.array('B', SIM_DESCRIPTOR))
+
+    def open_async_hid(self):
+        # the same as open_hid() but an AsyncHIDDEV, from a running event loop
+        from .asynchiddev import AsyncHIDDEV
+        return AsyncHIDDEV(VENDOR_ID, PRODUCT_ID, INTERFACE_NUM, fd=self.client_sock.detach(),
+                           desc=array.array('B', SIM_DESCRIPTOR))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
@@ -0,0 +1,112 @@
+import time
+import json
+import contextlib
+
+# None unless enable() was called, everything checks this first so tracing
+# costs next to nothing when it's off
+tracer = None
+
+# upper bounds of histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, float('inf'))
+
+TID_PHASE = 1
+TID_ROUND_TRIP = 2
+TID_TRANSPORT = 3
+
+NULL_CONTEXT = contextlib.nullcontext()
+
+class CommandStats:
+    def __init__(self):
+        self.round_trips = []
+        self.timeouts = 0
+        self.retries = 0
+
+    def histogram(self):
+        counts = [0] * len(HISTOGRAM_BUCKETS)
+        for seconds in self.round_trips:
+            ms = seconds * 1000
+            for num, bound in enumerate(HISTOGRAM_BUCKETS):
+                if ms < bound:
+                    counts[num] += 1
+                    break
+        return counts
+
+class Tracer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.commands = {}
+
+    def timestamp(self, when):
+        # chrome traces are in microseconds
+        return (when - self.start) * 1000000
+
+    def complete(self, name, tid, start, end, args=None):
+        event = {"name": name, "ph": "X", "pid": 1, "tid": tid,
+                 "ts": self.timestamp(start), "dur": (end - start) * 1000000}
+        if args is not None:
+            event["args"] = args
+        self.events.append(event)
+
+    def instant(self, name, tid, args=None):
+        event = {"name": name, "ph": "i", "s": "t", "pid": 1, "tid": tid,
+                 "ts": self.timestamp(time.perf_counter())}
+        if args is not None:
+            event["args"] = args
+        self.events.append(event)
+
+    def get_command(self, cmd):
+        if cmd not in self.commands:
+            self.commands[cmd] = CommandStats()
+        return self.commands[cmd]
+
+    def round_trip(self, cmd, start, end):
+        self.get_command(cmd).round_trips.append(end - start)
+        self.complete(f"0x{cmd:02X}", TID_ROUND_TRIP, start, end)
+
+    def timeout(self, cmd):
+        self.get_command(cmd).timeouts += 1
+        self.instant(f"timeout 0x{cmd:02X}", TID_ROUND_TRIP)
+
+    def retry(self, cmd):
+        self.get_command(cmd).retries += 1
+        self.instant(f"retry 0x{cmd:02X}", TID_ROUND_TRIP)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, TID_PHASE, start, time.perf_counter())
+
+    def save_chrome_trace(self, filename):
+        with open(filename, 'w') as tracefile:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, tracefile)
+
+    def str_summary(self):
+        ret = "cmd   count  min ms  p50 ms  max ms  timeouts  retries\n"
+        for cmd in sorted(self.commands.keys()):
+            stats = self.commands[cmd]
+            samples = sorted(stats.round_trips)
+            if len(samples) > 0:
+                ret += f"0x{cmd:02X}  {len(samples):5}  {samples[0]*1000:6.2f}  " \
+                       f"{samples[len(samples)//2]*1000:6.2f}  {samples[-1]*1000:6.2f}"
+            else:
+                ret += f"0x{cmd:02X}  {0:5}  {'-':>6}  {'-':>6}  {'-':>6}"
+            ret += f"  {stats.timeouts:8}  {stats.retries:7}\n"
+        ret += "Round trip histograms (ms):\n"
+        ret += "cmd  " + " ".join(f"{'<'+format(bound, 'g'):>6}" for bound in HISTOGRAM_BUCKETS) + "\n"
+        for cmd in sorted(self.commands.keys()):
+            ret += f"0x{cmd:02X} " + " ".join(f"{count:6}" for count in self.commands[cmd].histogram()) + "\n"
+        return ret
+
+def enable():
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+def phase(name):
+    if tracer is None:
+        return NULL_CONTEXT
+    return tracer.phase(name)
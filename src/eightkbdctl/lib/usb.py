@@ -1,9 +1,8 @@
 from dataclasses import dataclass
 import struct
 import errno
-import array
 
-from .util import chrbyte, strbcd, str_hex, SHIFT_MASKS_LOW, SHIFT_MASKS_HIGH, BIT_MASKS, MICROSECOND
+from .util import chrbyte, strbcd, str_hex, MICROSECOND
 
 class UninterpretableDataException(Exception):
     pass
@@ -104,6 +103,108 @@ class HIDIOItem:
                 usage_str += "]"
         return f"{direction} ID:{self.report_id} {flag_str}{usage_str} {self.size}bit x{self.count}"
 
+class HIDReportDecoder:
+    # Decodes one report, worked out once from the descriptor as where each
+    # data field is and how it's shown.  Fields are MSB first, bit 0 being
+    # the top bit of the first byte.  get_values() gets the value of each
+    # element of each field, render() makes the text decode_interrupt()
+    # shows, which is a template with each field's text put in.
+
+    # how a field is rendered
+    FIELD_HEX_ALIGNED = 0 # whole bytes on a byte boundary, straight from the data
+    FIELD_HEX = 1 # whole bytes anywhere else
+    FIELD_BITS = 2 # as # for each set bit and . for each clear one
+
+    BIT_CHARS = str.maketrans("01", ".#")
+
+    def __init__(self, collection, report_id, direction):
+        # fields are (kind, bit offset, size, count)
+        self.fields = []
+        template, bits = self.compile_collection(collection, report_id, direction, 0)
+        # None if nothing in this report is data
+        self.template = template
+        # a packet must have every data field in it
+        self.length = 0
+        for kind, bitoffset, size, count in self.fields:
+            self.length = max(self.length, (bitoffset + size * count + 7) // 8)
+        self.bits = self.length * 8
+        # (shift, mask) to get each element of each field from the packet as
+        # one big endian integer
+        self.elements = []
+        for kind, bitoffset, size, count in self.fields:
+            self.elements.append(tuple((self.bits - bitoffset - size * (num + 1), (1 << size) - 1)
+                                       for num in range(count)))
+
+    def compile_collection(self, collection, report_id, direction, bitoffset):
+        # the template for a collection and where the next field starts,
+        # the template is None if the collection has nothing for this report
+        ret = "("
+        for num, report in enumerate(collection):
+            if isinstance(report, HIDCollection):
+                new_str, bitoffset = self.compile_collection(report, report_id, direction, bitoffset)
+                if new_str is not None:
+                    ret += new_str
+                    if num < len(collection) - 1:
+                        ret += " "
+            elif report.direction == direction and report.report_id == report_id:
+                if not report.flags & HID.ITEM_MAIN_FLAG_CONSTANT:
+                    if report.size % 8 != 0:
+                        kind = self.FIELD_BITS
+                    elif bitoffset % 8 == 0:
+                        kind = self.FIELD_HEX_ALIGNED
+                    else:
+                        kind = self.FIELD_HEX
+                    self.fields.append((kind, bitoffset, report.size, report.count))
+                    ret += "[{}]"
+                bitoffset += report.size * report.count
+        if len(ret) == 1:
+            return None, bitoffset
+        ret += ")"
+        return ret, bitoffset
+
+    def get_values(self, data):
+        # a tuple of each field's element values
+        value = int.from_bytes(memoryview(data)[:self.length], 'big')
+        return [tuple((value >> shift) & mask for shift, mask in field) for field in self.elements]
+
+    def render(self, data):
+        data = memoryview(data)
+        value = None
+        texts = []
+        for kind, bitoffset, size, count in self.fields:
+            if kind == self.FIELD_HEX_ALIGNED:
+                start = bitoffset // 8
+                texts.append(data[start:start+size*count//8].hex(' ').upper())
+                continue
+            if value is None:
+                value = int.from_bytes(data[:self.length], 'big')
+            bits = size * count
+            field = (value >> (self.bits - bitoffset - bits)) & ((1 << bits) - 1)
+            if kind == self.FIELD_HEX:
+                texts.append(field.to_bytes(bits // 8, 'big').hex(' ').upper())
+            else:
+                text = format(field, f"0{bits}b").translate(self.BIT_CHARS)
+                if size == 1:
+                    texts.append(" ".join(text))
+                else:
+                    texts.append(" ".join(text[pos:pos+size] for pos in range(0, bits, size)))
+        return self.template.format(*texts)
+
+class DecodedReport:
+    # A report which is only decoded when it's turned in to text, so it can
+    # be passed around or queued for output without the cost of decoding it
+    # unless it's looked at.  data mustn't change after.
+    __slots__ = ("hid", "report_id", "direction", "data")
+
+    def __init__(self, hid, report_id, direction, data):
+        self.hid = hid
+        self.report_id = report_id
+        self.direction = direction
+        self.data = data
+
+    def __str__(self):
+        return self.hid.decode_interrupt(self.report_id, self.direction, self.data)
+
 class HID:
     hid : int
     country_code : int
@@ -120,6 +221,7 @@ class HID:
     ITEM_TYPE_GLOBAL = 0x04
     ITEM_TYPE_LOCAL = 0x08
     ITEM_TYPE_RESERVED = 0x0C
+    ITEM_TYPE_LONG = 0xFF # not in the item, given by iter_items() for long items
 
     ITEM_TAG_MASK = 0xF0
     ITEM_MAIN_INPUT = 0x80
@@ -150,6 +252,27 @@ class HID:
     ITEM_LOCAL_STRING_MAXIMUM = 0x90
     ITEM_LOCAL_DELIMITER = 0xA0
 
+    # largest a main item can be, as for linux
+    MAX_REPORT_SIZE = 256
+    MAX_REPORT_COUNT = 12288
+
+    # items which are shown as just their value
+    GLOBAL_SINT_TAGS = {ITEM_GLOBAL_LOGICAL_MINIMUM: "Logical-Minimum",
+                        ITEM_GLOBAL_LOGICAL_MAXIMUM: "Logical-Maximum",
+                        ITEM_GLOBAL_PHYSICAL_MINIMUM: "Physical-Minimum",
+                        ITEM_GLOBAL_PHYSICAL_MAXIMUM: "Physical-Maximum"}
+    GLOBAL_UINT_TAGS = {ITEM_GLOBAL_REPORT_SIZE: "Report-Size",
+                        ITEM_GLOBAL_REPORT_ID: "Report-ID",
+                        ITEM_GLOBAL_REPORT_COUNT: "Report-Count"}
+    LOCAL_UINT_TAGS = {ITEM_LOCAL_USAGE_MINIMUM: "Usage-Minimum",
+                       ITEM_LOCAL_USAGE_MAXIMUM: "Usage-Maximum",
+                       ITEM_LOCAL_DESIGNATOR_INDEX: "Designator-Index",
+                       ITEM_LOCAL_DESIGNATOR_MINIMUM: "Designator-Minimum",
+                       ITEM_LOCAL_DESIGNATOR_MAXIMUM: "Designator-Maximum",
+                       ITEM_LOCAL_STRING_INDEX: "String-Index",
+                       ITEM_LOCAL_STRING_MINIMUM: "String-Minimum",
+                       ITEM_LOCAL_STRING_MAXIMUM: "String-Maximum"}
+
     ITEM_MAIN_FLAG_CONSTANT = 0x01 # 0 - Data
     ITEM_MAIN_FLAG_VARIABLE = 0x02 # 0 - Array
     ITEM_MAIN_FLAG_RELATIVE = 0x04 # 0 - Absolute
@@ -171,7 +294,7 @@ class HID:
     ITEM_COLLECTION_TYPE_VENDOR = 0x80
 
     ITEM_LONG_HDR_SIZE = 3
-    ITEM_LONG_BYTE = 0xF7
+    ITEM_LONG_BYTE = 0xFE
     ITEM_LONG_SIZE = 1
     ITEM_LONG_TAG = 2
 
@@ -272,26 +395,13 @@ class HID:
 
     # default values are 0
     def data_uint(data, high_16=False):
-        value = 0
-        for pos in range(len(data)):
-            value |= data[pos] << (pos * 8)
+        value = int.from_bytes(data, 'little')
         if high_16 and value <= 0xFFFF:
             value <<= 16
         return value
 
     def data_sint(data):
-        match len(data):
-            case 0:
-                return 0
-            case 1:
-                return array.array('b', data)[0]
-            case 2:
-                return array.array('h', data)[0]
-            case 3:
-                return array.array('l', data+b'\0')[0] # top byte should be 0
-            case 4:
-                return array.array('l', data)[0]
-        raise ValueError("Unimplemented interpreting signed ints larger than 4 bytes!")
+        return int.from_bytes(data, 'little', signed=True)
 
     def str_usage(value):
         match value & HID.ITEM_USAGE_PAGE_MASK:
@@ -363,7 +473,35 @@ class HID:
                 return ret
         return "Unknown"
 
+    def iter_items(data):
+        # (type, tag, data) for each item in a report descriptor, data being a
+        # memoryview of the item's data.  Long items have type ITEM_TYPE_LONG
+        # and their own tag.
+        data = memoryview(data)
+        end = len(data)
+        pos = 0
+        while pos < end:
+            prefix = data[pos]
+            if prefix == HID.ITEM_LONG_BYTE:
+                if pos + HID.ITEM_LONG_HDR_SIZE > end:
+                    raise UninterpretableDataException(f"Long item at {pos} is cut off.")
+                item_type = HID.ITEM_TYPE_LONG
+                tag = data[pos+HID.ITEM_LONG_TAG]
+                start = pos + HID.ITEM_LONG_HDR_SIZE
+                size = data[pos+HID.ITEM_LONG_SIZE]
+            else:
+                item_type = prefix & HID.ITEM_TYPE_MASK
+                tag = prefix & HID.ITEM_TAG_MASK
+                start = pos + HID.ITEM_SHORT_HDR_SIZE
+                size = HID.ITEM_SIZE[prefix & HID.ITEM_SIZE_MASK]
+            if start + size > end:
+                raise UninterpretableDataException(f"Item at {pos} runs past the end of the descriptor.")
+            yield item_type, tag, data[start:start+size]
+            pos = start + size
+
     def decode_desc(self, data):
+        # only the structure is worked out here, the text for it is made by
+        # str_desc() when it's wanted
         usage_page = 0
         logical_minimum = 0
         logical_maximum = 0
@@ -375,315 +513,197 @@ class HID:
         report_id = 0
         report_count = 0
 
+        usage = 0
         usage_list = []
         usage_minimum = 0
         usage_maximum = 0
-        designator_list = []
-        designator_minimum = 0
-        designator_maximum = 0
-        string_list = []
-        string_minimum = 0
-        string_maximum = 0
 
         stack = []
 
         collections = [self.descriptors]
 
         collection_id = 1 # the "root" is already 0
-        pos = 0
+        for item_type, tag, item in HID.iter_items(data):
+            match item_type:
+                case self.ITEM_TYPE_MAIN:
+                    match tag:
+                        case self.ITEM_MAIN_INPUT | self.ITEM_MAIN_OUTPUT:
+                            if report_size > self.MAX_REPORT_SIZE or report_count > self.MAX_REPORT_COUNT:
+                                raise UninterpretableDataException(f"Report of {report_count} fields of"
+                                                                   f" {report_size} bits is too big.")
+                            direction = Endpoint.ADDRESS_DIR_IN
+                            if tag == self.ITEM_MAIN_OUTPUT:
+                                direction = Endpoint.ADDRESS_DIR_OUT
+                            # not 100% on this
+                            collection_usage = usage_list
+                            if len(usage_list) == 0:
+                                collection_usage = range(usage_minimum, usage_maximum)
+                            collections[-1].append(HIDIOItem(direction, report_id, HID.data_uint(item),
+                                                             collection_usage, report_size, report_count))
+                            # not 100% on this either but "locals" seem to reset?
+                            usage_list = []
+                            usage_minimum = 0
+                            usage_maximum = 0
+                        case self.ITEM_MAIN_COLLECTION:
+                            collections.append(HIDCollection(collection_id, HID.data_uint(item), usage))
+                            collection_id += 1
+                            collections[-2].append(collections[-1])
+                            usage_list = []
+                            usage_minimum = 0
+                            usage_maximum = 0
+                        case self.ITEM_MAIN_END_COLLECTION:
+                            if len(collections) == 1:
+                                raise UninterpretableDataException("End-Collection without a Collection.")
+                            collections.pop()
+                case self.ITEM_TYPE_GLOBAL:
+                    match tag:
+                        case self.ITEM_GLOBAL_USAGE_PAGE:
+                            # later usage values will overwrite at least the lower 16 bits
+                            usage_page = HID.data_uint(item, True) & self.ITEM_USAGE_PAGE_MASK
+                        case self.ITEM_GLOBAL_LOGICAL_MINIMUM:
+                            logical_minimum = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_LOGICAL_MAXIMUM:
+                            logical_maximum = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_PHYSICAL_MINIMUM:
+                            physical_minimum = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_PHYSICAL_MAXIMUM:
+                            physical_maximum = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_UNIT_EXPONENT:
+                            unit_exponent = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_UNIT:
+                            unit = HID.data_sint(item)
+                        case self.ITEM_GLOBAL_REPORT_SIZE:
+                            report_size = HID.data_uint(item)
+                        case self.ITEM_GLOBAL_REPORT_ID:
+                            report_id = HID.data_uint(item)
+                        case self.ITEM_GLOBAL_REPORT_COUNT:
+                            report_count = HID.data_uint(item)
+                        case self.ITEM_GLOBAL_PUSH:
+                            stack.append((usage_page, logical_minimum, logical_maximum,
+                                          physical_minimum, physical_maximum, unit_exponent,
+                                          unit, report_size, report_id, report_count))
+                        case self.ITEM_GLOBAL_POP:
+                            if len(stack) == 0:
+                                raise UninterpretableDataException("Pop without a Push.")
+                            usage_page, logical_minimum, logical_maximum, physical_minimum, \
+                                physical_maximum, unit_exponent, unit, report_size, \
+                                report_id, report_count = stack.pop()
+                case self.ITEM_TYPE_LOCAL:
+                    match tag:
+                        case self.ITEM_LOCAL_USAGE:
+                            usage = HID.data_uint(item)
+                            if usage <= self.ITEM_USAGE_MASK:
+                                usage |= usage_page
+                            usage_list.append(usage)
+                        case self.ITEM_LOCAL_USAGE_MINIMUM:
+                            usage_minimum = HID.data_uint(item)
+                        case self.ITEM_LOCAL_USAGE_MAXIMUM:
+                            usage_maximum = HID.data_uint(item)
+        if len(collections) > 1:
+            raise UninterpretableDataException("Collection without an End-Collection.")
+        self.desc_data += bytes(data)
+
+    def str_item(item_type, tag, item, usage_page):
+        # (type, tag, data text) for one item
+        match item_type:
+            case HID.ITEM_TYPE_MAIN:
+                match tag:
+                    case HID.ITEM_MAIN_INPUT:
+                        return "Main", "Input", HID.str_main_flags(HID.data_uint(item), True)
+                    case HID.ITEM_MAIN_OUTPUT:
+                        return "Main", "Output", HID.str_main_flags(HID.data_uint(item), False)
+                    case HID.ITEM_MAIN_FEATURE:
+                        return "Main", "Feature", HID.str_main_flags(HID.data_uint(item), False)
+                    case HID.ITEM_MAIN_COLLECTION:
+                        return "Main", "Collection", HID.str_collection_type(HID.data_uint(item))
+                    case HID.ITEM_MAIN_END_COLLECTION:
+                        return "Main", "End-Collection", ""
+                return "Main", "Unknown", ""
+            case HID.ITEM_TYPE_GLOBAL:
+                match tag:
+                    case HID.ITEM_GLOBAL_USAGE_PAGE:
+                        value = HID.data_uint(item, True)
+                        return "Global", "Usage-Page", f"{value:08X} {HID.str_usage(value)}"
+                    case HID.ITEM_GLOBAL_UNIT_EXPONENT:
+                        return "Global", "Unit-Exponent", f"*10^{HID.data_sint(item)}"
+                    case HID.ITEM_GLOBAL_UNIT:
+                        # not likely going to try...
+                        return "Global", "Unit", f"{HID.data_sint(item):08X}"
+                    case HID.ITEM_GLOBAL_PUSH:
+                        return "Global", "Push", ""
+                    case HID.ITEM_GLOBAL_POP:
+                        return "Global", "Pop", ""
+                if tag in HID.GLOBAL_SINT_TAGS:
+                    return "Global", HID.GLOBAL_SINT_TAGS[tag], HID.data_sint(item)
+                if tag in HID.GLOBAL_UINT_TAGS:
+                    return "Global", HID.GLOBAL_UINT_TAGS[tag], HID.data_uint(item)
+                return "Global", "Unknown", ""
+            case HID.ITEM_TYPE_LOCAL:
+                match tag:
+                    case HID.ITEM_LOCAL_USAGE:
+                        value = HID.data_uint(item)
+                        if value <= HID.ITEM_USAGE_MASK:
+                            value |= usage_page
+                        return "Local", "Usage", f"{value:08X} {HID.str_usage(value)}"
+                    case HID.ITEM_LOCAL_DELIMITER:
+                        # for now not implemented (not clear on how it works)
+                        if HID.data_uint(item):
+                            return "Local", "Delimiter", "Open-Set"
+                        return "Local", "Delimiter", "Closed-Set"
+                if tag in HID.LOCAL_UINT_TAGS:
+                    return "Local", HID.LOCAL_UINT_TAGS[tag], HID.data_uint(item)
+                return "Local", "Unknown", ""
+            case HID.ITEM_TYPE_RESERVED:
+                return "Reserved", "Unknown", ""
+
+    def str_desc(data):
+        # the items in a report descriptor one per line, indented by
+        # collection
+        ret = ""
+        usage_page = 0
+        stack = []
         padding = " "
-        while pos < len(data):
-            pad_change = 0
-            if data[pos] == self.ITEM_LONG_BYTE:
-                size = data[pos+self.ITEM_LONG_SIZE]
-                self.desc_str += f" Long {size}:{data[pos+self.ITEM_LONG_TAG]}"
-                pos += size + self.ITEM_LONG_HDR_SIZE
-            else:
-                size = self.ITEM_SIZE[data[pos] & self.ITEM_SIZE_MASK]
-                type_str = "Unknown"
-                tag_str = "Unknown"
-                data_str = ""
-                match data[pos] & self.ITEM_TYPE_MASK:
-                    case self.ITEM_TYPE_MAIN:
-                        type_str = "Main"
-                        match data[pos] & self.ITEM_TAG_MASK:
-                            case self.ITEM_MAIN_INPUT:
-                                tag_str = "Input"
-                                flags = HID.data_uint(data[pos+1:pos+1+size])
-                                # not 100% on this
-                                collection_usage = usage_list
-                                if len(usage_list) == 0:
-                                    collection_usage = range(usage_minimum, usage_maximum)
-                                collections[-1].append(HIDIOItem(Endpoint.ADDRESS_DIR_IN, report_id, flags,
-                                                                 collection_usage, report_size, report_count))
-                                # not 100% on this either but "locals" seem to reset?
-                                usage_list = []
-                                usage_minimum = 0
-                                usage_maximum = 0
-                                designator_list = []
-                                designator_minimum = 0
-                                designator_maximum = 0
-                                string_list = []
-                                string_minimum = 0
-                                string_maximum = 0
-                                data_str = HID.str_main_flags(flags, True)
-                            case self.ITEM_MAIN_OUTPUT:
-                                tag_str = "Output"
-                                flags = HID.data_uint(data[pos+1:pos+1+size])
-                                collection_usage = usage_list
-                                if len(usage_list) == 0:
-                                    collection_usage = range(usage_minimum, usage_maximum)
-                                collections[-1].append(HIDIOItem(Endpoint.ADDRESS_DIR_OUT, report_id, flags,
-                                                                 collection_usage, report_size, report_count))
-                                usage_list = []
-                                usage_minimum = 0
-                                usage_maximum = 0
-                                designator_list = []
-                                designator_minimum = 0
-                                designator_maximum = 0
-                                string_list = []
-                                string_minimum = 0
-                                string_maximum = 0
-                                data_str = HID.str_main_flags(flags, False)
-                            case self.ITEM_MAIN_FEATURE:
-                                tag_str = "Feature"
-                                # not implemented
-                                flags = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = HID.str_main_flags(flags, False)
-                            case self.ITEM_MAIN_COLLECTION:
-                                tag_str = "Collection"
-                                flags = HID.data_uint(data[pos+1:pos+1+size])
-                                collections.append(HIDCollection(collection_id, flags, usage))
-                                collection_id += 1
-                                collections[-2].append(collections[-1])
-                                usage_list = []
-                                usage_minimum = 0
-                                usage_maximum = 0
-                                designator_list = []
-                                designator_minimum = 0
-                                designator_maximum = 0
-                                string_list = []
-                                string_minimum = 0
-                                string_maximum = 0
-                                data_str = HID.str_collection_type(flags)
-                                pad_change = 1
-                            case self.ITEM_MAIN_END_COLLECTION:
-                                tag_str = "End-Collection"
-                                collections = collections[:-1]
-                                pad_change = -1
-                    case self.ITEM_TYPE_GLOBAL:
-                        type_str = "Global"
-                        match data[pos] & self.ITEM_TAG_MASK:
-                            case self.ITEM_GLOBAL_USAGE_PAGE:
-                                tag_str = "Usage-Page"
-                                usage_page = HID.data_uint(data[pos+1:pos+1+size], True)
-                                data_str = f"{usage_page:08X} {HID.str_usage(usage_page)}"
-                                # later usage values will overwrite at least the lower 16 bits
-                                usage_page &= self.ITEM_USAGE_PAGE_MASK
-                            case self.ITEM_GLOBAL_LOGICAL_MINIMUM:
-                                tag_str = "Logical-Minimum"
-                                logical_minimum = HID.data_sint(data[pos+1:pos+1+size])
-                                data_str = logical_minimum
-                            case self.ITEM_GLOBAL_LOGICAL_MAXIMUM:
-                                tag_str = "Logical-Maximum"
-                                logical_maximum = HID.data_sint(data[pos+1:pos+1+size])
-                                data_str = logical_maximum
-                            case self.ITEM_GLOBAL_PHYSICAL_MINIMUM:
-                                tag_str = "Physical-Minimum"
-                                physical_minimum = HID.data_sint(data[pos+1:pos+1+size])
-                                data_str = physical_minimum
-                            case self.ITEM_GLOBAL_PHYSICAL_MAXIMUM:
-                                tag_str = "Physical-Maximum"
-                                physical_maximum = HID.data_sint(data[pos+1:pos+1+size])
-                                data_str = physical_maximum
-                            case self.ITEM_GLOBAL_UNIT_EXPONENT:
-                                tag_str = "Unit-Exponent"
-                                unit_exponent = HID.data_sint(data[pos+1:pos+1+size])
-                                data_str = f"*10^{unit_exponent}"
-                            case self.ITEM_GLOBAL_UNIT:
-                                tag_str = "Unit"
-                                unit = HID.data_sint(data[pos+1:pos+1+size])
-                                # not likely going to try...
-                                data_str = f"{unit:08X}"
-                            case self.ITEM_GLOBAL_REPORT_SIZE:
-                                tag_str = "Report-Size"
-                                report_size = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = report_size
-                            case self.ITEM_GLOBAL_REPORT_ID:
-                                tag_str = "Report-ID"
-                                report_id = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = report_id
-                            case self.ITEM_GLOBAL_REPORT_COUNT:
-                                tag_str = "Report-Count"
-                                report_count = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = report_count
-                            case self.ITEM_GLOBAL_PUSH:
-                                # not confident this is how these work!
-                                tag_str = "Push"
-                                stack.append(usage_page, logical_minimum, logical_maximum,
-                                             physical_minimum, physical_maximum, unit_exponent,
-                                             unit, report_size, report_id, report_count)
-                            case self.ITEM_GLOBAL_POP:
-                                tag_str = "Pop"
-                                usage_page, logical_minimum, logical_maximum, physical_minimum, \
-                                    physical_maximum, unit_exponent, unit, report_size, \
-                                    report_id, report_count = stack.pop()
-                    case self.ITEM_TYPE_LOCAL:
-                        type_str = "Local"
-                        match data[pos] & self.ITEM_TAG_MASK:
-                            case self.ITEM_LOCAL_USAGE:
-                                tag_str = "Usage"
-                                usage = HID.data_uint(data[pos+1:pos+1+size])
-                                if usage <= self.ITEM_USAGE_MASK:
-                                    usage |= usage_page
-                                usage_list.append(usage)
-                                data_str = f"{usage:08X} {HID.str_usage(usage)}"
-                            case self.ITEM_LOCAL_USAGE_MINIMUM:
-                                tag_str = "Usage-Minimum"
-                                usage_minimum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = usage_minimum
-                            case self.ITEM_LOCAL_USAGE_MAXIMUM:
-                                tag_str = "Usage-Maximum"
-                                usage_maximum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = usage_maximum
-                            case self.ITEM_LOCAL_DESIGNATOR_INDEX:
-                                # not implemented (no examples)
-                                tag_str = "Designator-Index"
-                                designator_index = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = designator_index
-                            case self.ITEM_LOCAL_DESIGNATOR_MINIMUM:
-                                tag_str = "Designator-Minimum"
-                                designator_minimum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = designator_minimum
-                            case self.ITEM_LOCAL_DESIGNATOR_MAXIMUM:
-                                tag_str = "Designator-Maximum"
-                                designator_maximum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = designator_maximum
-                            case self.ITEM_LOCAL_STRING_INDEX:
-                                # same
-                                tag_str = "String-Index"
-                                string_index = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = string_index
-                            case self.ITEM_LOCAL_STRING_MINIMUM:
-                                tag_str = "String-Minimum"
-                                string_minimum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = string_minimum
-                            case self.ITEM_LOCAL_STRING_MAXIMUM:
-                                tag_str = "String-Maximum"
-                                string_maximum = HID.data_uint(data[pos+1:pos+1+size])
-                                data_str = string_maximum
-                            case self.ITEM_LOCAL_DELIMITER:
-                                # for now not implemented (not clear on how it works)
-                                tag_str = "Delimiter"
-                                data_str = "Closed-Set"
-                                if HID.data_uint(data[pos+1:pos+1+size]):
-                                    data_str = "Open-Set"
-                    case self.ITEM_TYPE_RESERVED:
-                        type_str = "Reserved"
-                if pad_change < 0:
-                    padding = padding[:-1]
-                self.desc_str += f"\n{padding}{type_str}/{tag_str} {data_str}"
-                if pad_change > 0:
-                    padding += " "
-                pos += size + self.ITEM_SHORT_HDR_SIZE
-
-    def value_bits_from_data(data, bytepos, bitpos, bits):
-        value = array.array('B')
-        byte = data[bytepos]
-
-        if bitpos > 0:
-            byte &= SHIFT_MASKS_LOW[bitpos]
-            byte <<= bitpos
-
-            for i in range(bits // 8):
-                byte2 = data[bytepos+1+i]
-                byte2 >>= 8-bitpos
-
-                value.append(byte | byte2)
-
-                byte = data[bytepos+1+i]
-                byte &= SHIFT_MASKS_LOW[bitpos]
-                byte <<= bitpos
-
-            if (bitpos + bits) % 8 > 0:
-                byte2 = data[bytepos+(bits // 8)]
-                byte2 >>= 8-bitpos
-            else:
-                byte2 = 0
-
-            value.append((byte | byte2) & SHIFT_MASKS_HIGH[(bitpos + bits) % 8])
-        else:
-            for i in range(bits // 8):
-                value.append(data[bytepos+i])
-
-            if bits % 8 > 0:
-                byte = data[bytepos+(bits // 8)]
-                byte &= SHIFT_MASKS_HIGH[bits % 8]
-
-                value.append(byte)
-
-        return value
-
-    def process_collection(data, report_id, direction, collection, bytepos=0, bitpos=0):
-        ret = "("
-        for num, report in enumerate(collection):
-            if isinstance(report, HIDCollection):
-                new_str = HID.process_collection(data, report_id, direction, report, bytepos, bitpos)
-                if new_str is not None:
-                    ret += new_str
-                    if num < len(collection) - 1:
-                        ret += " "
-            else:
-                if report.direction == direction and report.report_id == report_id:
-                    if not report.flags & HID.ITEM_MAIN_FLAG_CONSTANT:
-                        ret += "["
-                        for countnum, i in enumerate(range(report.count)):
-                            value = HID.value_bits_from_data(data, bytepos, bitpos, report.size)
-                            if report.size % 8 == 0:
-                                for bytenum, byte in enumerate(value):
-                                    ret += f"{byte:02X}"
-                                    if bytenum < len(value) - 1:
-                                        ret += " "
-                            else:
-                                for bytenum, byte in enumerate(value):
-                                    for bit in range(8):
-                                        if bytenum * 8 + bit >= report.size:
-                                            break
-                                        if byte & BIT_MASKS[bit]:
-                                            ret += "#"
-                                        else:
-                                            ret += "."
-                            if countnum < report.count - 1:
-                                ret += " "
-                            bytepos += report.size // 8
-                            bitpos += report.size % 8
-                            while bitpos >= 8:
-                                bytepos += 1
-                                bitpos -= 8
-                        ret += "]"
-                    else:
-                        bytepos += report.size * report.count // 8
-                        bitpos += report.size * report.count % 8
-                        while bitpos >= 8:
-                            bytepos += 1
-                            bitpos -= 8
-        if len(ret) == 1:
-            return None
-        ret += ")"
+        for item_type, tag, item in HID.iter_items(data):
+            if item_type == HID.ITEM_TYPE_LONG:
+                ret += f" Long {len(item)}:{tag}"
+                continue
+            if item_type == HID.ITEM_TYPE_MAIN and tag == HID.ITEM_MAIN_END_COLLECTION:
+                padding = padding[:-1]
+            elif item_type == HID.ITEM_TYPE_GLOBAL:
+                # the usage page is needed to show usages
+                match tag:
+                    case HID.ITEM_GLOBAL_USAGE_PAGE:
+                        usage_page = HID.data_uint(item, True) & HID.ITEM_USAGE_PAGE_MASK
+                    case HID.ITEM_GLOBAL_PUSH:
+                        stack.append(usage_page)
+                    case HID.ITEM_GLOBAL_POP:
+                        if len(stack) > 0:
+                            usage_page = stack.pop()
+            type_str, tag_str, data_str = HID.str_item(item_type, tag, item, usage_page)
+            ret += f"\n{padding}{type_str}/{tag_str} {data_str}"
+            if item_type == HID.ITEM_TYPE_MAIN and tag == HID.ITEM_MAIN_COLLECTION:
+                padding += " "
         return ret
 
-    def decode_interrupt(self, report_id, direction, data):
+    def get_decoder(self, report_id, direction):
+        # compiled the first time each report is decoded
         try:
-            ret = HID.process_collection(data, report_id, direction, self.descriptors)
-        except IndexError:
-            return f"Malformed packet!"
-        if ret is not None:
-            dir_str = "In"
-            if direction == Endpoint.ADDRESS_DIR_OUT:
-                dir_str = "Out"
-            return f"HID Report {dir_str} {report_id}: ({ret})"
-        else:
+            return self.decoders[(report_id, direction)]
+        except KeyError:
+            decoder = HIDReportDecoder(self.descriptors, report_id, direction)
+            self.decoders[(report_id, direction)] = decoder
+            return decoder
+
+    def decode_interrupt(self, report_id, direction, data):
+        decoder = self.get_decoder(report_id, direction)
+        if decoder.template is None:
             return f"Couldn't extract data from HID report!"
+        if len(data) < decoder.length:
+            return f"Malformed packet!"
+        dir_str = "In"
+        if direction == Endpoint.ADDRESS_DIR_OUT:
+            dir_str = "Out"
+        return f"HID Report {dir_str} {report_id}: ({decoder.render(data)})"
 
     def do_get_reports(reports, collections, direction):
         for report in collections[-1]:
@@ -729,13 +749,16 @@ class HID:
             self.num_descriptor = 0
             self.descriptor_type = 0
             self.descriptor_length = 0
-        self.desc_str = ""
+        # the report descriptor, only turned in to text when printed
+        self.desc_data = b""
         self.descriptors = HIDCollection(0)
+        # HIDReportDecoders by (report_id, direction)
+        self.decoders = {}
 
     def __str__(self):
         return f"HID  ID: {strbcd(self.hid)} Country Code: {self.country_code}" \
                f" Descriptors: {self.num_descriptor} Type: {self.descriptor_type}" \
-               f" Descriptor Length: {self.descriptor_length}{self.desc_str}\n" \
+               f" Descriptor Length: {self.descriptor_length}{HID.str_desc(self.desc_data)}\n" \
                f" Structure: {self.descriptors}"
 
 class Endpoint:
@@ -0,0 +1,1046 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import array
+import tempfile
+import pathlib
+import subprocess
+import statistics
+import json
+import platform
+import datetime
+import threading
+
+from lib.usb import HID, Endpoint
+from lib.eightkbd import EightKeyboard, KeyboardProfile, KeyboardMacro, KeyMapping, MacroEventAction, KEY_VALUES, \
+                         IN_ID, OUT_ID, optimize_macro_events, decode_macro_data, \
+                         get_name_from_bitfield_code, get_bitfield_code_from_key_code
+from lib.keys import KEY_DISABLE
+from lib.util import BIT_MASKS
+from lib.simkbd import SimulatedKeyboard, SIM_DESCRIPTOR, PACKET_LEN
+from lib import trace
+
+# rough guess, captures show ~0.1s between a packet and its acknowledgement
+# but most of that is waiting on the next USB poll
+DEFAULT_LATENCY = 0.01
+
+MANY_MACROS = 16
+
+def make_events(count):
+    events = []
+    for num in range(count):
+        key = 0x04 + (num % 26)
+        events.append((MacroEventAction.PRESSED, key))
+        events.append((MacroEventAction.DELAY, 20))
+        events.append((MacroEventAction.RELEASED, key))
+        events.append((MacroEventAction.DELAY, 20))
+    return events
+
+def remap_to(key):
+    # anything other than the default
+    if KEY_VALUES[key] == 0x2C:
+        return 0x04
+    return 0x2C
+
+def populate_sim(sim, key_count, macro_count):
+    all_keys = list(KEY_VALUES.keys())
+    for key in all_keys[:key_count]:
+        sim.set_key(key, remap_to(key))
+    for key in all_keys[len(all_keys)-macro_count:]:
+        sim.set_macro(key, f"macro {key}", 1, make_events(8))
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(name, samples, packets=0, round_trips=0):
+    # samples in seconds, packets and round_trips per iteration
+    total = sum(samples)
+    result = {"name": name,
+              "iterations": len(samples),
+              "p50_ms": percentile(samples, 0.5) * 1000,
+              "p99_ms": percentile(samples, 0.99) * 1000,
+              "round_trips": round_trips,
+              "packets": packets,
+              "packets_per_sec": 0.0}
+    if total > 0:
+        result["packets_per_sec"] = packets * len(samples) / total
+    return result
+
+def bench_device(name, sim, iterations, setup, func):
+    # time func(kbd) against the simulator, setup(kbd) isn't timed
+    samples = []
+    packets = 0
+    round_trips = 0
+    with sim.open_hid() as hid:
+        for i in range(iterations):
+            kbd = EightKeyboard(hid, False, False)
+            setup(kbd)
+            received = sim.received
+            sent = sim.sent
+            trips = sim.round_trips
+            start = time.perf_counter()
+            func(kbd)
+            samples.append(time.perf_counter() - start)
+            packets = sim.received - received + sim.sent - sent
+            round_trips = sim.round_trips - trips
+    return summarize(name, samples, packets, round_trips)
+
+def bench_cpu(name, iterations, func):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(name, samples)
+
+def no_setup(kbd):
+    pass
+
+def bench_suite(iterations):
+    from lib.profilecache import ProfileSnapshot
+
+    results = []
+
+    all_keys = len(KEY_VALUES)
+    for key_count, macro_count in ((0, 0), (10, 0), (all_keys, 0), (0, 4), (10, 4), (all_keys, MANY_MACROS)):
+        with SimulatedKeyboard() as sim:
+            populate_sim(sim, key_count, macro_count)
+            results.append(bench_device(f"get-profile keys={key_count} macros={macro_count}", sim, iterations,
+                                        no_setup, EightKeyboard.get_profile_from_device))
+
+    # how long until get-profile has something to print
+    with SimulatedKeyboard() as sim:
+        populate_sim(sim, all_keys, MANY_MACROS)
+        results.append(bench_device(f"get-profile first entry keys={all_keys} macros={MANY_MACROS}", sim,
+                                    iterations, no_setup, lambda kbd: next(kbd.iter_profile_from_device())))
+
+    # getting a full profile which is all in the snapshot from last time
+    with SimulatedKeyboard() as sim:
+        populate_sim(sim, all_keys, MANY_MACROS)
+        snapshot = ProfileSnapshot()
+
+        def use_snapshot(kbd):
+            kbd.snapshot = snapshot
+            if snapshot.fingerprint is None:
+                kbd.get_profile_from_device()
+                kbd.update_snapshot()
+
+        results.append(bench_device(f"get-profile keys={all_keys} macros={MANY_MACROS} cached", sim, iterations,
+                                    use_snapshot, EightKeyboard.get_profile_from_device))
+
+    def single_key(kbd):
+        kbd.set_key(0x04, 0x05)
+
+    # a one key change to a full profile, all of it gotten up front or just
+    # what's looked at
+    for lazy in (False, True):
+        def set_one_key(kbd, lazy=lazy):
+            kbd.get_profile_from_device(lazy)
+            single_key(kbd)
+            kbd.submit()
+
+        with SimulatedKeyboard() as sim:
+            populate_sim(sim, all_keys, MANY_MACROS)
+            results.append(bench_device(f"set-key full profile lazy={lazy}", sim, iterations,
+                                        no_setup, set_one_key))
+
+    def long_macro(kbd):
+        kbd.set_macro(0x6C, "long macro", 1, make_events(60))
+
+    for name, setup in (("single-key", single_key), ("full-default", EightKeyboard.set_all_default),
+                        ("long-macro", long_macro)):
+        with SimulatedKeyboard() as sim:
+            results.append(bench_device(f"submit {name}", sim, iterations, setup, EightKeyboard.submit))
+
+    # only what isn't default already is sent
+    with SimulatedKeyboard() as sim:
+        def mostly_default(kbd):
+            populate_sim(sim, 2, 0)
+            kbd.get_profile_from_device()
+            kbd.set_all_default()
+
+        results.append(bench_device("submit full-default to 2 mapped keys", sim, iterations,
+                                    mostly_default, EightKeyboard.submit))
+
+    macro = KeyboardMacro("long macro", 1, PACKET_LEN)
+    macro.add_events(make_events(60))
+    results.append(bench_cpu("get_macro_packets 240 events", iterations * 10,
+                             lambda: macro.get_macro_packets(0x6C)))
+    macrobuf = macro.generate_macro_data()
+    def decode_macro():
+        repeats, eventsbuf = decode_macro_data(macrobuf)
+        KeyboardMacro("long macro", repeats, PACKET_LEN).add_events_buf(eventsbuf)
+    results.append(bench_cpu("decode macro 240 events", iterations * 10, decode_macro))
+    other = KeyboardMacro("other macro", 1, PACKET_LEN)
+    other.add_events(make_events(60))
+    results.append(bench_cpu("compare macros 240 events", iterations * 10,
+                             lambda: macro == other))
+
+    # whole profiles: every key remapped against the defaults
+    from lib.planner import plan_changes
+    default = KeyboardProfile("", PACKET_LEN)
+    default.set_all_default()
+    remapped = KeyboardProfile("", PACKET_LEN)
+    for key in KEY_VALUES.keys():
+        remapped.set_key(key, KeyMapping(remap_to(key), KEY_DISABLE))
+    results.append(bench_cpu("build full profile", iterations * 10, default.set_all_default))
+    results.append(bench_cpu("diff full profile, unchanged", iterations * 10,
+                             lambda: plan_changes(default, default, default, True)))
+    results.append(bench_cpu("diff full profile, all changed", iterations * 10,
+                             lambda: remapped.keys.get_changed(default.keys, default.keys)))
+    results.append(bench_cpu("packetise full profile", iterations * 10,
+                             lambda: plan_changes(default, default, remapped, True)))
+
+    # loading a saved profile with every key remapped and some macros, and
+    # restoring it over the same profile
+    from lib import profilefile
+    for key in list(KEY_VALUES.keys())[-MANY_MACROS:]:
+        saved = KeyboardMacro(f"macro {key}", 1, PACKET_LEN)
+        saved.add_events(make_events(8))
+        remapped.set_macro(key, saved)
+    binary = profilefile.profile_to_bytes(remapped)
+    saved_json = profilefile.profile_to_json(remapped)
+    results.append(bench_cpu("load full profile, binary", iterations * 10,
+                             lambda: profilefile.profile_from_bytes(binary, PACKET_LEN)))
+    results.append(bench_cpu("load full profile, JSON", iterations * 10,
+                             lambda: profilefile.profile_from_json(saved_json, PACKET_LEN)))
+    def restore():
+        plan_changes(remapped, default, profilefile.profile_from_bytes(binary, PACKET_LEN), True)
+    results.append(bench_cpu("restore unchanged full profile", iterations * 10, restore))
+
+    desc = array.array('B', SIM_DESCRIPTOR)
+    results.append(bench_cpu("parse descriptor", iterations * 10, lambda: HID().decode_desc(desc)))
+    results.append(bench_cpu("format descriptor", iterations * 10, lambda: HID.str_desc(desc)))
+
+    hid = HID()
+    hid.decode_desc(desc)
+    report = array.array('B', range(PACKET_LEN))
+    results.append(bench_cpu("decode_interrupt", iterations * 10,
+                             lambda: hid.decode_interrupt(IN_ID, Endpoint.ADDRESS_DIR_IN, report)))
+    # the keyboard report, with bit fields
+    results.append(bench_cpu("decode_interrupt keyboard report", iterations * 10,
+                             lambda: hid.decode_interrupt(1, Endpoint.ADDRESS_DIR_IN, report)))
+    decoder = hid.get_decoder(1, Endpoint.ADDRESS_DIR_IN)
+    results.append(bench_cpu("keyboard report values", iterations * 10,
+                             lambda: decoder.get_values(report)))
+
+    return results
+
+def print_results(results):
+    print(f"{'benchmark':40}  {'p50 ms':>8}  {'p99 ms':>8}  {'trips':>5}  {'packets':>7}  {'pkt/s':>9}")
+    for result in results:
+        print(f"{result['name']:40}  {result['p50_ms']:8.3f}  {result['p99_ms']:8.3f}  "
+              f"{result['round_trips']:5}  {result['packets']:7}  {result['packets_per_sec']:9.0f}")
+
+def save_results(filename, results):
+    with open(filename, 'w') as outfile:
+        json.dump({"time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "results": results}, outfile, indent=1)
+
+def build_full_profile(kbd):
+    kbd.set_all_default()
+    events = []
+    for key in range(0x04, 0x1E):
+        events.append((MacroEventAction.PRESSED, key))
+        events.append((MacroEventAction.DELAY, 20))
+        events.append((MacroEventAction.RELEASED, key))
+        events.append((MacroEventAction.DELAY, 20))
+    kbd.set_macro(0x6C, "long macro", 1, events)
+    kbd.set_macro(0x6D, "short macro", 1, events[:4])
+
+def bench_submit_window(max_window):
+    print("window  seconds  packets")
+    for window in range(1, max_window + 1):
+        with SimulatedKeyboard(DEFAULT_LATENCY) as sim, sim.open_hid() as hid:
+            kbd = EightKeyboard(hid, False, False, window)
+            build_full_profile(kbd)
+            start = time.monotonic()
+            kbd.submit()
+            elapsed = time.monotonic() - start
+            print(f"{window:6}  {elapsed:7.3f}  {sim.received:7}")
+
+def submitted_right(kbd, sim):
+    return profile_matches(kbd, sim) and {0x6C, 0x6D} <= set(sim.macros.keys())
+
+def bench_async(iterations):
+    # get the profile, submit a full one and get it again through HIDDEV and
+    # AsyncHIDDEV on a simulated device with some latency, whether the
+    # device ended up right
+    import asyncio
+
+    def run_sync():
+        with SimulatedKeyboard(DEFAULT_LATENCY) as sim, sim.open_hid() as hid:
+            populate_sim(sim, 10, 4)
+            kbd = EightKeyboard(hid, False, False)
+            kbd.get_profile_from_device()
+            ok = profile_matches(kbd, sim)
+            build_full_profile(kbd)
+            kbd.submit()
+            kbd.get_profile_from_device()
+            return ok and submitted_right(kbd, sim)
+
+    async def run_async():
+        with SimulatedKeyboard(DEFAULT_LATENCY) as sim:
+            async with sim.open_async_hid() as hid:
+                populate_sim(sim, 10, 4)
+                kbd = EightKeyboard(hid, False, False)
+                await kbd.async_get_profile_from_device()
+                ok = profile_matches(kbd, sim)
+                build_full_profile(kbd)
+                await kbd.async_submit()
+                await kbd.async_get_profile_from_device()
+                return ok and submitted_right(kbd, sim)
+
+    ok = True
+    print("hid     p50 ms   p99 ms  right")
+    for name, func in (("sync", run_sync), ("async", lambda: asyncio.run(run_async()))):
+        samples = []
+        right = 0
+        for i in range(iterations):
+            start = time.perf_counter()
+            if func():
+                right += 1
+            samples.append(time.perf_counter() - start)
+        ok = ok and right == iterations
+        print(f"{name:5}  {percentile(samples, 0.5) * 1000:7.1f}  {percentile(samples, 0.99) * 1000:7.1f}  "
+              f"{right}/{iterations}")
+    return ok
+
+def time_repeated(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter() - start) / count
+
+def bench_startup(count):
+    from lib.hiddev import generate_filename, generate_parsed_filename, parse_desc, load_parsed_desc, save_parsed_desc
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_dir = pathlib.Path(cache_dir)
+        raw_filename = cache_dir.joinpath(generate_filename(0, 0, 0))
+        with raw_filename.open("wb") as descfile:
+            descfile.write(SIM_DESCRIPTOR)
+        parsed_filename = cache_dir.joinpath(generate_parsed_filename(SIM_DESCRIPTOR))
+        save_parsed_desc(parsed_filename, *parse_desc(array.array('B', SIM_DESCRIPTOR)))
+
+        def read_raw():
+            with raw_filename.open("rb") as descfile:
+                return array.array('B', descfile.read())
+
+        def cold():
+            parse_desc(array.array('B', SIM_DESCRIPTOR))
+
+        def warm_raw():
+            parse_desc(read_raw())
+
+        def warm_parsed():
+            desc = read_raw()
+            load_parsed_desc(cache_dir.joinpath(generate_parsed_filename(desc)))
+
+        print("startup      usec")
+        for name, func in (("cold", cold), ("warm-raw", warm_raw), ("warm-parsed", warm_parsed)):
+            print(f"{name:11}  {time_repeated(func, count) * 1000000:8.1f}")
+
+# a device with 3 interfaces, the one looked for being the last
+DISCOVERY_VENDOR = 0x2dc8
+DISCOVERY_PRODUCT = 0x5200
+DISCOVERY_INTERFACE = 2
+
+class FakeSysfs:
+    # class/hidraw/hidrawN/device links to a HID device under a USB interface
+    # under a USB device, as it is in /sys
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.classdir = self.root.joinpath("class", "hidraw")
+        self.classdir.mkdir(parents=True)
+        self.devices = self.root.joinpath("devices")
+
+    def add_interface(self, port, vendor, product, serial, interface):
+        usbdev = self.devices.joinpath(port)
+        usbdev.mkdir(parents=True, exist_ok=True)
+        usbdev.joinpath("idVendor").write_text(f"{vendor:04x}\n")
+        usbdev.joinpath("idProduct").write_text(f"{product:04x}\n")
+        usbdev.joinpath("serial").write_text(f"{serial}\n")
+        usbinterface = usbdev.joinpath(f"{port}:1.{interface}")
+        usbinterface.mkdir()
+        usbinterface.joinpath("bInterfaceNumber").write_text(f"{interface:02x}\n")
+        hiddev = usbinterface.joinpath(f"0003:{vendor:04X}:{product:04X}.{interface:04X}")
+        hiddev.mkdir()
+        return hiddev
+
+    def link(self, num, hiddev):
+        entry = self.classdir.joinpath(f"hidraw{num}")
+        entry.mkdir()
+        entry.joinpath("device").symlink_to(hiddev)
+
+    def unlink(self, num):
+        entry = self.classdir.joinpath(f"hidraw{num}")
+        entry.joinpath("device").unlink()
+        entry.rmdir()
+
+def bench_hidraw_discovery(others):
+    # find the device's hidraw node in a fake sysfs tree with others other
+    # devices in it, by scanning and from the saved location, then after
+    # it's been replugged and got different numbers
+    from lib.hiddev import locate_hidraw, find_hidraw_sysfs
+
+    ok = True
+    def check(name, got, path, cached):
+        nonlocal ok
+        matches = got == (path, cached)
+        ok = ok and matches
+        print(f"{name:26} {got[0]:14} {str(got[1]):6}  {matches}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sysfs = FakeSysfs(pathlib.Path(tmp, "sys"))
+        dev_root = pathlib.Path(tmp, "dev")
+        cache_dir = pathlib.Path(tmp, "cache")
+        cache_dir.mkdir()
+
+        for num in range(others):
+            sysfs.link(num, sysfs.add_interface(f"2-{num + 1}", 0x1234, 0x5678, f"other{num}", 0))
+        interfaces = [sysfs.add_interface("1-1", DISCOVERY_VENDOR, DISCOVERY_PRODUCT, "kbd", num)
+                      for num in range(3)]
+        for num, hiddev in enumerate(interfaces):
+            sysfs.link(others + num, hiddev)
+
+        def locate():
+            location, cached = locate_hidraw(DISCOVERY_VENDOR, DISCOVERY_PRODUCT, DISCOVERY_INTERFACE,
+                                             cache_dir, sysfs.root, dev_root)
+            return pathlib.PurePath(location.path).name, cached
+
+        print("case                       node           cached  right")
+        # the other interfaces of the same device come first and are passed over
+        check("scan", locate(), f"hidraw{others + 2}", False)
+        check("saved", locate(), f"hidraw{others + 2}", True)
+
+        # replugged with the interfaces numbered the other way around, what
+        # was saved is now a different interface
+        for num in range(3):
+            sysfs.unlink(others + num)
+        for num, hiddev in enumerate(reversed(interfaces)):
+            sysfs.link(others + num, hiddev)
+        check("other interface saved", locate(), f"hidraw{others}", False)
+        check("saved after rescan", locate(), f"hidraw{others}", True)
+
+        # unplugged then plugged in after something else took its numbers
+        for num in range(3):
+            sysfs.unlink(others + num)
+        for num, hiddev in enumerate(reversed(interfaces)):
+            sysfs.link(others + 3 + num, hiddev)
+        check("saved node gone", locate(), f"hidraw{others + 3}", False)
+
+        # on another port, same interface number but not the same device
+        moved = sysfs.add_interface("3-1", DISCOVERY_VENDOR, DISCOVERY_PRODUCT, "kbd", DISCOVERY_INTERFACE)
+        sysfs.unlink(others + 3)
+        sysfs.link(others + 3, moved)
+        check("other port saved", locate(), f"hidraw{others + 3}", False)
+
+        scan_time = time_repeated(lambda: find_hidraw_sysfs(DISCOVERY_VENDOR, DISCOVERY_PRODUCT,
+                                                            DISCOVERY_INTERFACE, sysfs.root, dev_root), 100)
+        saved_time = time_repeated(locate, 100)
+        print(f"scan {others + 4} nodes {scan_time * 1000000:.1f} usec, "
+              f"saved location {saved_time * 1000000:.1f} usec")
+    return ok
+
+# command, code run under -X importtime, modules it mustn't pull in and the
+# budget for everything it imports in milliseconds.  Commands which need a
+# device only import what they would before opening it.
+STARTUP_OFFLINE_FORBIDDEN = ("eightkbdctl.lib.hiddev", "eightkbdctl.lib.usb", "ioctl_opt", "xdg_base_dirs", "asyncio")
+STARTUP_COMMANDS = (
+    ("list-in-codes", "from eightkbdctl.eightkbdctl import main; main(['8kbdctl', 'list-in-codes'])",
+     STARTUP_OFFLINE_FORBIDDEN, 60),
+    ("list-out-codes", "from eightkbdctl.eightkbdctl import main; main(['8kbdctl', 'list-out-codes'])",
+     STARTUP_OFFLINE_FORBIDDEN, 60),
+    ("device", "from eightkbdctl.eightkbdctl import main; import eightkbdctl.lib.hiddev",
+     ("asyncio",), 150)
+)
+
+def parse_importtime(output):
+    # only count what was imported after the interpreter started up
+    total = 0
+    modules = set()
+    started = False
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not started:
+            if name.strip() == "site" and name.startswith(" site"):
+                started = True
+            continue
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total, modules
+
+def bench_imports(count):
+    srcdir = pathlib.Path(__file__).resolve().parent.parent
+    failed = False
+    print("command         median ms  budget ms")
+    for name, code, forbidden, budget in STARTUP_COMMANDS:
+        times = []
+        for i in range(count):
+            result = subprocess.run((sys.executable, "-X", "importtime", "-c", code), cwd=srcdir,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if result.returncode != 0:
+                # just the exception, not all the import times
+                print(f"{name:14}  failed: {result.stderr.splitlines()[-1]}")
+                failed = True
+                break
+            total, modules = parse_importtime(result.stderr)
+            times.append(total / 1000)
+        else:
+            median = statistics.median(times)
+            print(f"{name:14}  {median:9.2f}  {budget:9}")
+            if median > budget:
+                print(f"{name} is over budget!")
+                failed = True
+            for module in forbidden:
+                if module in modules:
+                    print(f"{name} imported {module}!")
+                    failed = True
+    return not failed
+
+def profile_matches(kbd, sim):
+    if set(kbd.profile.keys.keys()) != set(sim.keys.keys()) or \
+       set(kbd.profile.macros.keys()) != set(sim.macros.keys()):
+        return False
+    for key, (mod_key, to_key) in sim.keys.items():
+        mapping = kbd.profile.keys[key]
+        if (mapping.mod_key, mapping.to_key) != (mod_key, to_key):
+            return False
+    for key, simmacro in sim.macros.items():
+        macro = kbd.profile.macros[key]
+        if bytes(macro.encoded_name) != bytes(simmacro.name) or \
+           bytes(macro.generate_macro_data()) != bytes(simmacro.data):
+            return False
+    return True
+
+def time_dead_device(sim, kbd):
+    # how long until a device which stopped answering is given up on
+    sim.drop_rate = 1.0
+    start = time.perf_counter()
+    try:
+        kbd.get_profile_from_device()
+    except RuntimeError:
+        pass
+    return time.perf_counter() - start
+
+# replies which only come late, so ones to requests which were sent again
+# arrive while waiting on the next request
+DELAYED_LATENCY = 0.04
+DELAYED_ITERATIONS = 30
+
+def lossy_syncs(drop_rate, latency, iterations):
+    # get the profile over and over from a device which drops replies and
+    # delays them by latency +/- half that again, with one keyboard so it
+    # learns the round trip times.  A sync which fails other than by giving
+    # up is counted as wrong.
+    tracer = trace.enable()
+    samples = []
+    failures = 0
+    wrong = 0
+    with SimulatedKeyboard(latency, latency / 2, drop_rate, 1) as sim, sim.open_hid() as hid:
+        populate_sim(sim, 10, 4)
+        kbd = EightKeyboard(hid, False, False)
+        for i in range(iterations):
+            start = time.perf_counter()
+            try:
+                kbd.get_profile_from_device()
+            except RuntimeError:
+                failures += 1
+                continue
+            except ValueError as e:
+                print(f"sync {i} went wrong: {e}")
+                wrong += 1
+                continue
+            samples.append(time.perf_counter() - start)
+            if not profile_matches(kbd, sim):
+                wrong += 1
+        dropped = sim.dropped
+        trace.tracer = None
+        learned_dead = time_dead_device(sim, kbd)
+
+    timeouts = sum(stats.timeouts for stats in tracer.commands.values())
+    retries = sum(stats.retries for stats in tracer.commands.values())
+    print(f"syncs {len(samples)}, failed {failures}, wrong {wrong}")
+    if len(samples) > 0:
+        print(f"sync p50 {percentile(samples, 0.5) * 1000:.1f} ms, "
+              f"p99 {percentile(samples, 0.99) * 1000:.1f} ms")
+    print(f"replies dropped {dropped}, timeouts {timeouts}, retries {retries}")
+    return wrong, learned_dead
+
+def bench_lossy(drop_rate, latency, iterations):
+    # then again with nothing dropped but replies late enough to be sent
+    # again, which must not be taken as replies to later requests
+    wrong, learned_dead = lossy_syncs(drop_rate, latency, iterations)
+    print(f"delayed only, latency {DELAYED_LATENCY} s:")
+    delayed_wrong, _ = lossy_syncs(0.0, DELAYED_LATENCY, DELAYED_ITERATIONS)
+
+    with SimulatedKeyboard(drop_rate=1.0) as sim, sim.open_hid() as hid:
+        fresh_dead = time_dead_device(sim, EightKeyboard(hid, False, False))
+
+    print(f"dead device given up on after {learned_dead:.3f} s, "
+          f"{fresh_dead:.3f} s before any replies")
+    return wrong == 0 and delayed_wrong == 0
+
+class SlowStream:
+    # a terminal which takes a while to write each line
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        lines = text.count("\n")
+        self.lines += lines
+        time.sleep(self.delay * lines)
+
+    def flush(self):
+        pass
+
+def print_decoded(hid, stream, report_id, data):
+    # how listen() printed every report before output had its own thread
+    stream.write(f"{hid.decode(report_id, data)}\n")
+    return True
+
+def bench_listen(count, delay):
+    # read count keyboard reports sent as fast as the simulator can, printing
+    # them to output which takes delay seconds a line
+    from lib import output
+
+    print("output      seconds  reports/s  written  dropped")
+    for name in ("inline", "thread"):
+        stream = SlowStream(delay)
+        with SimulatedKeyboard() as sim, sim.open_hid() as hid:
+            sim.keymap = True
+            # sent from another thread since the simulator waits while the
+            # socket is full
+            def press_keys():
+                for num in range(count):
+                    sim.press((num % 64,))
+            presser = threading.Thread(target=press_keys)
+            start = time.perf_counter()
+            presser.start()
+            if name == "inline":
+                hid.listen(count, print_decoded, stream)
+                dropped = 0
+            else:
+                output.writer = output.OutputWriter(stream)
+                hid.listen(count)
+                dropped = output.writer.dropped
+                output.writer.close()
+                output.writer = None
+            elapsed = time.perf_counter() - start
+            presser.join()
+        print(f"{name:10}  {elapsed:7.3f}  {count / elapsed:9.0f}  {stream.lines:7}  {dropped:7}")
+
+def mutate_descriptor(rand, desc):
+    desc = bytearray(desc)
+    for num in range(rand.randint(1, 4)):
+        match rand.randrange(4):
+            case 0:
+                desc[rand.randrange(len(desc))] = rand.randrange(256)
+            case 1:
+                del desc[rand.randrange(len(desc)):]
+            case 2:
+                pos = rand.randrange(len(desc))
+                desc[pos:pos] = rand.randbytes(rand.randint(1, 4))
+            case 3:
+                pos = rand.randrange(len(desc))
+                del desc[pos:pos+rand.randint(1, 4)]
+        if len(desc) == 0:
+            desc.append(rand.randrange(256))
+    return desc
+
+def bench_descriptor_fuzz(count, seed):
+    # parse and print randomly broken descriptors, anything other than
+    # UninterpretableDataException is a failure
+    import random
+    import traceback
+    from lib.usb import UninterpretableDataException
+
+    rand = random.Random(seed)
+    report = bytes(PACKET_LEN)
+    samples = []
+    rejected = 0
+    failed = 0
+    for num in range(count):
+        desc = mutate_descriptor(rand, SIM_DESCRIPTOR)
+        start = time.perf_counter()
+        try:
+            hid = HID()
+            hid.decode_desc(desc)
+            for direction in (Endpoint.ADDRESS_DIR_IN, Endpoint.ADDRESS_DIR_OUT):
+                for report_id in hid.get_reports(direction):
+                    hid.decode_interrupt(report_id, direction, report)
+            str(hid)
+        except UninterpretableDataException:
+            rejected += 1
+        except Exception:
+            failed += 1
+            if failed <= 3:
+                print(f"failed on {desc.hex()}")
+                traceback.print_exc()
+        samples.append(time.perf_counter() - start)
+    print(f"descriptors {count}, rejected {rejected}, failed {failed}")
+    print(f"p50 {percentile(samples, 0.5) * 1000000:.1f} usec, "
+          f"p99 {percentile(samples, 0.99) * 1000000:.1f} usec")
+    return failed == 0
+
+def keymap_report(codes):
+    bitfield = 0
+    for code in codes:
+        bitfield |= 1 << code
+    return array.array('B', (0x8A, 0x07, 0x00)) + array.array('B', bitfield.to_bytes(PACKET_LEN - 3, 'little'))
+
+def key_report_streams(count):
+    # (name, reports) for typing one key at a time, one key going up and
+    # down with 20 others held and the same report over and over
+    typing = []
+    rollover = []
+    held = list(range(20, 40))
+    for num in range(count // 2):
+        typing.append(keymap_report((num % 40,)))
+        typing.append(keymap_report(()))
+        rollover.append(keymap_report(held + [num % 10]))
+        rollover.append(keymap_report(held))
+    return (("typing", typing), ("rollover 20 held", rollover),
+            ("unchanged", [keymap_report((4,)) for num in range(count)]))
+
+def old_key_scan(last_report, report_id, data):
+    # what read-keys did with each report before KeyState
+    pressed = []
+    if last_report[0] != (report_id, data):
+        for num, byte in enumerate(data[3:]):
+            for bit in range(8):
+                if byte & BIT_MASKS[bit]:
+                    val = (num * 8) + (7 - bit)
+                    pressed.append((val, get_name_from_bitfield_code(val)))
+        last_report[0] = (report_id, data)
+    return pressed
+
+def bench_key_events(count):
+    from lib.keystate import KeyState
+
+    print(f"{'stream':18}  {'scan usec':>9}  {'KeyState usec':>13}  {'events':>6}")
+    for name, reports in key_report_streams(count):
+        last_report = [None]
+        start = time.perf_counter()
+        for report in reports:
+            old_key_scan(last_report, IN_ID, report)
+        old = (time.perf_counter() - start) / len(reports)
+
+        keystate = KeyState()
+        events = 0
+        start = time.perf_counter()
+        for report in reports:
+            for event in keystate.update_report(report, 0):
+                events += 1
+        new = (time.perf_counter() - start) / len(reports)
+        print(f"{name:18}  {old * 1000000:9.2f}  {new * 1000000:13.2f}  {events:6}")
+
+# (hut code, shifted) for typing out text in a macro
+TYPED_KEYS = {' ': (0x2C, False), '\n': (0x28, False), '-': (0x2D, False),
+              ',': (0x36, False), '.': (0x37, False), '@': (0x1F, True),
+              '0': (0x27, False)}
+for num, char in enumerate("abcdefghijklmnopqrstuvwxyz"):
+    TYPED_KEYS[char] = (0x04 + num, False)
+    TYPED_KEYS[char.upper()] = (0x04 + num, True)
+for num, char in enumerate("123456789"):
+    TYPED_KEYS[char] = (0x1E + num, False)
+
+def typed_events(text, delay=10):
+    events = []
+    for char in text:
+        key, shifted = TYPED_KEYS[char]
+        if shifted:
+            events.append((MacroEventAction.MOD_PRESSED, 0xE1))
+        events.extend(((MacroEventAction.PRESSED, key),
+                       (MacroEventAction.DELAY, delay),
+                       (MacroEventAction.RELEASED, key),
+                       (MacroEventAction.DELAY, delay)))
+        if shifted:
+            events.append((MacroEventAction.MOD_RELEASED, 0xE1))
+    return events
+
+def macro_corpus():
+    copy = [(MacroEventAction.MOD_PRESSED, 0xE0),
+            (MacroEventAction.PRESSED, 0x06),
+            (MacroEventAction.DELAY, 10),
+            (MacroEventAction.RELEASED, 0x06),
+            (MacroEventAction.MOD_RELEASED, 0xE0)]
+    return (("copy", copy),
+            ("word", typed_events("hello")),
+            ("command", typed_events("git status\n")),
+            ("email", typed_events("someone@example.com")),
+            ("signature", typed_events("Regards,\nA. Person\n")),
+            ("sentence", typed_events("See you at the meeting tomorrow.\n")),
+            ("shout", typed_events("STOP THAT")),
+            ("wait", typed_events("build\n") + [(MacroEventAction.DELAY, 60000),
+                                                (MacroEventAction.DELAY, 30000)] +
+                     typed_events("y\n")))
+
+def baseline_macro_packets(data_len):
+    # how the baseline packetised macro data, a 6 byte header on every chunk
+    # and the 4 byte macro header in the first, whole events only, plus the
+    # name packet
+    packets = 1
+    pos = 0
+    while pos < data_len:
+        items_len = 0
+        if pos == 0:
+            items_len += 4
+        items_len += (PACKET_LEN - 6 - items_len) // 3 * 3
+        packets += 1
+        pos += items_len
+    return packets
+
+def bench_macro_packets():
+    # packets to set each macro in the corpus with the baseline packetiser
+    # and now, as a new macro, with only its events changed and only renamed,
+    # then with its events optimized
+    from lib.planner import plan_macro
+    key = list(KEY_VALUES.keys())[0]
+    totals = [0] * 7
+    print("                             new       events      rename")
+    print("macro      events  bytes  before now  before now  before now  optimized")
+    for name, events in macro_corpus():
+        macro = KeyboardMacro(name, 1, PACKET_LEN)
+        macro.add_events(events)
+        data_len = len(macro.generate_macro_data())
+        new = len(plan_macro(key, make_profile(key, None), make_profile(key, macro), True))
+        current = KeyboardMacro(name, 1, PACKET_LEN)
+        current.add_events(macro.events[:-1])
+        events_changed = len(plan_macro(key, make_profile(key, current),
+                                        make_profile(key, macro), True))
+        renamed = KeyboardMacro(name + " 2", 1, PACKET_LEN)
+        renamed.add_events(macro.events)
+        rename = len(plan_macro(key, make_profile(key, macro), make_profile(key, renamed), True))
+        optimized = KeyboardMacro(name, 1, PACKET_LEN)
+        optimized.add_events(optimize_macro_events(events))
+        optimized_new = len(plan_macro(key, make_profile(key, None),
+                                       make_profile(key, optimized), True))
+        before = baseline_macro_packets(data_len)
+        # the baseline sent a rename alone as the name packet too
+        counts = (before, new, before, events_changed, 1, rename, optimized_new)
+        print(f"{name:10} {len(events):6} {data_len:6}  {counts[0]:6} {counts[1]:3}  {counts[2]:6} {counts[3]:3}  "
+              f"{counts[4]:6} {counts[5]:3}  {counts[6]:9}")
+        for num, count in enumerate(counts):
+            totals[num] += count
+    count = len(macro_corpus())
+    means = [total / count for total in totals]
+    print(f"{'mean':10} {'':6} {'':6}  {means[0]:6.2f} {means[1]:3.1f}  {means[2]:6.2f} {means[3]:3.1f}  "
+          f"{means[4]:6.2f} {means[5]:3.1f}  {means[6]:9.2f}")
+    print("Chunks end on whole events and the name packet is always sent, as the vendor\n"
+          "app does, and a rename alone was already only the name packet, so\n"
+          "packetising saves nothing over the baseline.  Only optimizing the events\n"
+          "sends fewer packets.")
+
+def make_profile(key, macro):
+    profile = KeyboardProfile("", PACKET_LEN)
+    if macro is not None:
+        profile.macros[key] = macro
+    return profile
+
+def recorded_reports(events, rand):
+    # (when, report) as keymap mode would give them for someone typing out
+    # events, each change off by up to 2 ms either way so they still round
+    # to when they should be.  None if a key can't be seen in keymap mode.
+    codes = {}
+    for key, code in KEY_VALUES.items():
+        if code != 0 and code not in codes:
+            codes[code] = get_bitfield_code_from_key_code(key)
+    reports = []
+    held = set()
+    at = 1.0
+    jitter = 0
+    for action, arg in events:
+        if action == MacroEventAction.DELAY:
+            at += arg / 1000
+            jitter = rand.uniform(-0.002, 0.002)
+            continue
+        code = codes.get(arg)
+        if code is None:
+            return None
+        if action in (MacroEventAction.PRESSED, MacroEventAction.MOD_PRESSED):
+            held.add(code)
+        else:
+            held.discard(code)
+        reports.append((at + jitter, keymap_report(held)))
+    return reports
+
+def expected_recording(events):
+    # what should come back, delays at the end aren't seen
+    events = optimize_macro_events(events)
+    while len(events) > 0 and events[-1][0] == MacroEventAction.DELAY:
+        events.pop()
+    return events
+
+def bench_record(repeats):
+    # replay recorded keymap mode report streams for the macro corpus through
+    # MacroRecorder, checking every change is recorded
+    import random
+    from lib.keystate import MacroRecorder
+
+    rand = random.Random(1)
+    ok = True
+    print(f"{'macro':10}  {'reports':>7}  {'events':>6}  {'feed usec':>9}  {'events usec':>11}  matches")
+    for name, events in macro_corpus():
+        reports = recorded_reports(events, rand)
+        if reports is None:
+            print(f"{name:10}  has keys which can't be recorded")
+            continue
+        feed = 0
+        make = 0
+        for num in range(repeats):
+            recorder = MacroRecorder()
+            start = time.perf_counter()
+            for when, report in reports:
+                recorder.feed(report, when)
+            feed += time.perf_counter() - start
+            start = time.perf_counter()
+            recorded = recorder.get_events()
+            make += time.perf_counter() - start
+        matches = recorded == expected_recording(events)
+        ok = ok and matches
+        print(f"{name:10}  {len(reports):7}  {len(recorded):6}  {feed / repeats / len(reports) * 1000000:9.2f}  "
+              f"{make / repeats * 1000000:11.1f}  {matches}")
+    return ok
+
+def usage():
+    print(f"USAGE: {sys.argv[0]} <submit-window [max window]|startup [count]|imports [count]|\n"
+          f"    suite [iterations] [json file]|lossy [drop rate] [latency] [iterations]|\n"
+          f"    macro-packets|listen [reports] [line delay]|descriptor-fuzz [count] [seed]|\n"
+          f"    key-events [reports]|record [repeats]|hidraw-discovery [others]|\n"
+          f"    async [iterations]>\n\n"
+           "submit-window - Time writing a full profile to a simulated device with\n"
+           "    1 to max window (default 8) acknowledgements outstanding.\n"
+           "startup - Time getting report tables from a descriptor without any\n"
+           "    cache, from the raw descriptor cache and from the parsed cache.\n"
+           "imports - Time imports for each kind of command against a budget, exits\n"
+           "    with failure if any are over budget or import something they\n"
+           "    shouldn't.\n"
+           "suite - Time reading and writing profiles against a simulated device with\n"
+           "    no latency, and macro packetising and report decoding, default 100\n"
+           "    iterations.  Results are optionally saved to a JSON file.\n"
+           "lossy - Get the profile from a simulated device which drops (default 0.05)\n"
+          f"    and delays (default 0.01 s) replies, 50 times by default, then\n"
+          f"    {DELAYED_ITERATIONS} times with nothing dropped and replies delayed {DELAYED_LATENCY} s so\n"
+           "    they come after being sent again, then time giving up on a device\n"
+           "    which stops replying.  Exits with failure if any sync comes back\n"
+           "    wrong.\n"
+           "macro-packets - Count the packets to set each of a corpus of typical\n"
+           "    macros with the baseline packetiser and now, as a new macro, with\n"
+           "    only its events changed and only renamed, and with its events\n"
+           "    optimized.\n"
+           "listen - Time reading reports (default 5000) sent as fast as a simulated\n"
+           "    device can while printing them to output which takes a while to\n"
+           "    write each line (default 0.0002 s), printing them as they're read\n"
+           "    and from the output thread which drops what it can't keep up with.\n"
+           "descriptor-fuzz - Time parsing and printing randomly broken copies of the\n"
+           "    simulated device's report descriptor (default 10000, seed 1).  Exits\n"
+           "    with failure if any fail other than by being rejected.\n"
+           "key-events - Time turning streams of keymap mode reports (default 10000)\n"
+           "    in to key events, scanning every bit of changed reports as read-keys\n"
+           "    used to and with KeyState.\n"
+           "record - Replay keymap mode reports for typing out each of the macro\n"
+           "    corpus through MacroRecorder (default 100 times), timing each report\n"
+           "    and making the events.  Exits with failure if any recording doesn't\n"
+           "    match the macro.\n"
+           "hidraw-discovery - Find the device's hidraw node in a fake sysfs tree with\n"
+           "    other devices (default 64), by scanning, from the saved location and\n"
+           "    after replugs make that stale, and time scanning against using the\n"
+           "    saved location.  Exits with failure if the wrong node is found.\n"
+           "async - Get the profile, submit a full one and get it again on a simulated\n"
+           "    device through HIDDEV and AsyncHIDDEV (default 10 times each).  Exits\n"
+           "    with failure if the device doesn't end up with what was submitted.\n")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if sys.argv[1] == "submit-window":
+            max_window = 8
+            if len(sys.argv) > 2:
+                max_window = int(sys.argv[2])
+            bench_submit_window(max_window)
+        elif sys.argv[1] == "startup":
+            count = 1000
+            if len(sys.argv) > 2:
+                count = int(sys.argv[2])
+            bench_startup(count)
+        elif sys.argv[1] == "imports":
+            count = 10
+            if len(sys.argv) > 2:
+                count = int(sys.argv[2])
+            if not bench_imports(count):
+                sys.exit(1)
+        elif sys.argv[1] == "suite":
+            iterations = 100
+            if len(sys.argv) > 2:
+                iterations = int(sys.argv[2])
+            results = bench_suite(iterations)
+            print_results(results)
+            if len(sys.argv) > 3:
+                save_results(sys.argv[3], results)
+        elif sys.argv[1] == "lossy":
+            drop_rate = 0.05
+            latency = DEFAULT_LATENCY
+            iterations = 50
+            if len(sys.argv) > 2:
+                drop_rate = float(sys.argv[2])
+            if len(sys.argv) > 3:
+                latency = float(sys.argv[3])
+            if len(sys.argv) > 4:
+                iterations = int(sys.argv[4])
+            if not bench_lossy(drop_rate, latency, iterations):
+                sys.exit(1)
+        elif sys.argv[1] == "macro-packets":
+            bench_macro_packets()
+        elif sys.argv[1] == "listen":
+            count = 5000
+            delay = 0.0002
+            if len(sys.argv) > 2:
+                count = int(sys.argv[2])
+            if len(sys.argv) > 3:
+                delay = float(sys.argv[3])
+            bench_listen(count, delay)
+        elif sys.argv[1] == "descriptor-fuzz":
+            count = 10000
+            seed = 1
+            if len(sys.argv) > 2:
+                count = int(sys.argv[2])
+            if len(sys.argv) > 3:
+                seed = int(sys.argv[3])
+            if not bench_descriptor_fuzz(count, seed):
+                sys.exit(1)
+        elif sys.argv[1] == "key-events":
+            count = 10000
+            if len(sys.argv) > 2:
+                count = int(sys.argv[2])
+            bench_key_events(count)
+        elif sys.argv[1] == "record":
+            repeats = 100
+            if len(sys.argv) > 2:
+                repeats = int(sys.argv[2])
+            if not bench_record(repeats):
+                sys.exit(1)
+        elif sys.argv[1] == "hidraw-discovery":
+            others = 64
+            if len(sys.argv) > 2:
+                others = int(sys.argv[2])
+            if not bench_hidraw_discovery(others):
+                sys.exit(1)
+        elif sys.argv[1] == "async":
+            iterations = 10
+            if len(sys.argv) > 2:
+                iterations = int(sys.argv[2])
+            if not bench_async(iterations):
+                sys.exit(1)
+        else:
+            usage()
+    else:
+        usage()